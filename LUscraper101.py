@@ -1,143 +1,391 @@
 import os
 import re
 import zipfile
-from lxml import html
+import hashlib
+import json
+import argparse
+import queue
+import tempfile
+import zlib
+import io
+import tarfile
+import struct
+import subprocess
+import stat
+from lxml import etree, html
 import requests
-from urllib.parse import unquote, urlparse
+from urllib3.exceptions import TimeoutError as PoolTimeoutError
+from urllib3.util import Retry
+from urllib.parse import parse_qs, unquote, urljoin, urlparse
 import shutil
-from threading import Thread
+from threading import Condition, Event, Lock, Semaphore, Thread, local
+from concurrent.futures import ThreadPoolExecutor
 from getpass import getpass  
 import time
 import sys
-from PIL import Image  # For image processing
-import numpy as np
+import importlib
+import contextlib
+import heapq
+import fnmatch
 
 
 
-
-COURSE_LINKS = [
-    "https://estudijas.lu.lv/course/view.php?id=18902",
-    "https://estudijas.lu.lv/course/view.php?id=16482",
-    "https://estudijas.lu.lv/course/view.php?id=13607",
-    "https://estudijas.lu.lv/course/view.php?id=13889",
-    "https://estudijas.lu.lv/course/view.php?id=18858",
-    "https://estudijas.lu.lv/course/view.php?id=13603",
-    "https://estudijas.lu.lv/course/view.php?id=11551",
-]
-
-
-
-# Define MIME types for files
-FILE_MIME_TYPES = [
+# Define MIME types for files, with the extension a file of that type is saved under
+FILE_MIME_TYPES = {
     # Document Formats
-    "application/pdf",
-    "application/msword",
-    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-    "application/vnd.ms-excel",
-    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    "application/vnd.ms-powerpoint",
-    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
-    "application/vnd.oasis.opendocument.text",  # .odt
-    "application/vnd.oasis.opendocument.spreadsheet",  # .ods
-    "application/vnd.oasis.opendocument.presentation",  # .odp
-    "text/plain",  # .txt
-    "application/rtf",  # .rtf
-    "text/csv",  # .csv
-    "text/html",  # .html
-    "application/xml",  # .xml
+    "application/pdf": ".pdf",
+    "application/msword": ".doc",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
+    "application/vnd.ms-excel": ".xls",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx",
+    "application/vnd.ms-powerpoint": ".ppt",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation": ".pptx",
+    "application/vnd.oasis.opendocument.text": ".odt",
+    "application/vnd.oasis.opendocument.spreadsheet": ".ods",
+    "application/vnd.oasis.opendocument.presentation": ".odp",
+    "text/plain": ".txt",
+    "application/rtf": ".rtf",
+    "text/csv": ".csv",
+    "text/html": ".html",
+    "application/xml": ".xml",
 
     # Image Formats
-    "image/png",  # .png
-    "image/jpeg",  # .jpg, .jpeg
-    "image/gif",  # .gif
-    "image/bmp",  # .bmp
-    "image/tiff",  # .tiff
-    "image/svg+xml",  # .svg
+    "image/png": ".png",
+    "image/jpeg": ".jpg",  # also .jpeg
+    "image/gif": ".gif",
+    "image/bmp": ".bmp",
+    "image/tiff": ".tiff",
+    "image/svg+xml": ".svg",
 
     # Archive Formats
-    "application/zip",  # .zip
-    "application/x-rar-compressed",  # .rar
-    "application/x-tar",  # .tar
-    "application/gzip",  # .gz
-    "application/x-7z-compressed",  # .7z
+    "application/zip": ".zip",
+    "application/x-rar-compressed": ".rar",
+    "application/x-tar": ".tar",
+    "application/gzip": ".gz",
+    "application/x-7z-compressed": ".7z",
 
     # Audio Formats
-    "audio/mpeg",  # .mp3
-    "audio/wav",  # .wav
-    "audio/ogg",  # .ogg
-    "audio/flac",  # .flac
+    "audio/mpeg": ".mp3",
+    "audio/wav": ".wav",
+    "audio/ogg": ".ogg",
+    "audio/flac": ".flac",
 
     # Video Formats
-    "video/mp4",  # .mp4
-    "video/x-msvideo",  # .avi
-    "video/x-matroska",  # .mkv
-    "video/quicktime",  # .mov
-    "video/webm",  # .webm
+    "video/mp4": ".mp4",
+    "video/x-msvideo": ".avi",
+    "video/x-matroska": ".mkv",
+    "video/quicktime": ".mov",
+    "video/webm": ".webm",
 
     # Programming and Data Formats
-    "application/json",  # .json
-    "application/javascript",  # .js
-    "text/x-python",  # .py
-    "text/x-java-source",  # .java
-    "application/sql",  # .sql
+    "application/json": ".json",
+    "application/javascript": ".js",
+    "text/x-python": ".py",
+    "text/x-java-source": ".java",
+    "application/sql": ".sql",
 
     # Other Formats
-    "application/octet-stream",  # .exe, .bin
-    "application/x-apple-diskimage",  # .dmg
-    "application/x-iso9660-image",  # .iso
-]
+    "application/octet-stream": ".bin",  # also .exe and other binaries
+    "application/x-apple-diskimage": ".dmg",
+    "application/x-iso9660-image": ".iso",
+}
 
-# Define file extensions for files
-FILE_EXTENSIONS = [
+# Define file extensions for files, grouped into the classes --include-type/--exclude-type select
+FILE_CLASSES = {
     # Document Formats
-    ".pdf", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx",
-    ".odt", ".ods", ".odp", ".txt", ".rtf", ".csv", ".html", ".xml",
+    "document": {".pdf", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx",
+                 ".odt", ".ods", ".odp", ".txt", ".rtf", ".csv", ".html", ".xml"},
 
     # Image Formats
-    ".png", ".jpg", ".jpeg", ".gif", ".bmp", ".tiff", ".svg",
+    "image": {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".tiff", ".svg"},
 
     # Archive Formats
-    ".zip", ".rar", ".tar", ".gz", ".7z",
+    "archive": {".zip", ".rar", ".tar", ".gz", ".7z"},
 
     # Audio Formats
-    ".mp3", ".wav", ".ogg", ".flac",
+    "audio": {".mp3", ".wav", ".ogg", ".flac"},
 
     # Video Formats
-    ".mp4", ".avi", ".mkv", ".mov", ".webm",
+    "video": {".mp4", ".avi", ".mkv", ".mov", ".webm"},
 
     # Programming and Data Formats
-    ".json", ".js", ".py", ".java", ".sql",
+    "code": {".json", ".js", ".py", ".java", ".sql"},
 
     # Other Formats
-    ".exe", ".dmg", ".iso",
-]
+    "other": {".exe", ".dmg", ".iso"},
+}
+
+FILE_EXTENSIONS = set().union(*FILE_CLASSES.values())
+
+# Media types that are files even when missing from the tables above: whole main types, and
+# variants of a known type (application/vnd.ms-excel.sheet.macroEnabled.12 for .xlsm files)
+FILE_MAIN_TYPES = {"image", "audio", "video", "font"}
+FILE_MIME_VARIANTS = tuple(media_type + separator for media_type in FILE_MIME_TYPES for separator in ".+")
+EXTENSION_CLASSES = {extension: kind for kind, extensions in FILE_CLASSES.items() for extension in extensions}
+
+# Moodle shows a file resource with the icon of its type (.../f/pdf-24, .../f/video), so the class
+# of a file is known from the course page before the file is requested
+MOODLE_ICON_CLASSES = {
+    "pdf": "document", "document": "document", "writer": "document", "text": "document", "markup": "document",
+    "html": "document", "spreadsheet": "document", "calc": "document", "powerpoint": "document", "impress": "document",
+    "image": "image", "bmp": "image", "gif": "image", "jpeg": "image", "png": "image", "tiff": "image", "eps": "image",
+    "archive": "archive",
+    "audio": "audio", "mp3": "audio", "wav": "audio",
+    "video": "video", "avi": "video", "mov": "video", "mpeg": "video", "quicktime": "video", "wmv": "video",
+    "sourcecode": "code",
+}
+MOODLE_ICON_PATTERN = re.compile(r"/f/([a-z0-9]+?)(?:-\d+)?(?:\.\w+)?(?:\?|$)")
+
+# Formats from the tables above that are already compressed. Deflating them again burns CPU
+# time for next to no gain, so they are STORED in the ZIP archive.
+STORED_EXTENSIONS = {
+    ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp",  # ZIP based office documents
+    ".png", ".jpg", ".jpeg", ".gif",
+    ".zip", ".rar", ".gz", ".7z",
+    ".mp3", ".ogg", ".flac",
+    ".mp4", ".avi", ".mkv", ".mov", ".webm",
+    ".dmg",
+}
 
+STORED_MIME_TYPES = {media_type for media_type, extension in FILE_MIME_TYPES.items() if extension in STORED_EXTENSIONS}
 
 
-with open(os.devnull, 'w') as f:
-    # Redirect stdout to devnull
-    old_stdout = sys.stdout
-    sys.stdout = f
-    try:
-        from pygame import mixer
-    finally:
-        # Restore stdout
-        sys.stdout = old_stdout
 
+# The cosmetic extras (background music, farewell portrait) need pygame, Pillow and numpy.
+# They are imported on first use, so the downloader starts fast and runs without them.
+EXTRAS = {"enabled": True}
+_extra_modules = {}
+_extras_lock = Lock()
+
+def load_extra(module_name):
+    """
+    Imports an optional module for the cosmetic extras on first use.
+    Returns the module, or None if extras are disabled (--no-extras) or it cannot be imported.
+    """
+    if not EXTRAS["enabled"]:
+        return None
+    with _extras_lock:
+        if module_name not in _extra_modules:
+            try:
+                _extra_modules[module_name] = importlib.import_module(module_name)
+            except Exception as e:
+                print(f"[WARNING] {module_name} is not available, skipping extras that need it ({str(e)})")
+                _extra_modules[module_name] = None
+        return _extra_modules[module_name]
 
-def get_user_info(session):
-    profile_url = "https://estudijas.lu.lv/user/profile.php"
-    response = session.get(profile_url)
-    tree = html.fromstring(response.text)
 
-    # Find the <div> with class "page-header-image mr-2"
-    div_tag = tree.xpath('//div[contains(@class, "page-header-image mr-2")]')
-    if not div_tag:
+# Run instrumentation: JSON-lines events, an end-of-run summary and Prometheus text metrics
+SENSITIVE_PARAMS = re.compile(r"((?:^|[?&])(?:sesskey|wstoken|token)=)[^&#]*")
+
+def redact_url(url):
+    """Hides session keys and tokens in a URL before it is logged."""
+    return SENSITIVE_PARAMS.sub(r"\1***", url)
+
+class EventLog:
+    """
+    Structured record of a run. Every emit() becomes one JSON line in the events file, if one
+    is open, with the event name and "t" (seconds since the run started), and feeds the
+    aggregates behind summary() and prometheus().
+    Events: login/download/zip phases, request (status, ttfb, retries), page, transfer
+    (bytes, seconds), file (result), retry, course and archive.
+    """
+
+    def __init__(self, slowest=5):
+        self._lock = Lock()
+        self._file = None
+        self.start = time.monotonic()
+        self.phases = {}
+        self.requests = {}
+        self.files = {}
+        self.ttfb = [0.0, 0]
+        self.retries = 0
+        self.pages = [0.0, 0]
+        self.transferred = [0, 0.0, 0]  # bytes, seconds, transfers
+        self.slowest = []  # heap of the slowest transfers: (seconds, bytes, url)
+        self.keep_slowest = slowest
+
+    def open(self, path):
+        """Starts appending events to the JSON-lines file at path."""
+        self._file = open(path, "a", encoding="utf-8")
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def emit(self, event, **fields):
+        record = {"event": event, "t": round(time.monotonic() - self.start, 4)}
+        record.update(fields)
+        with self._lock:
+            self._aggregate(record)
+            if self._file:
+                self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _aggregate(self, record):
+        event = record["event"]
+        if event == "phase":
+            self.phases[record["phase"]] = self.phases.get(record["phase"], 0) + record["seconds"]
+        elif event == "request":
+            status = str(record.get("status") or "error")
+            self.requests[status] = self.requests.get(status, 0) + 1
+            self.retries += record.get("retries", 0)
+            if record.get("ttfb") is not None:
+                self.ttfb[0] += record["ttfb"]
+                self.ttfb[1] += 1
+        elif event == "page":
+            self.pages[0] += record["seconds"]
+            self.pages[1] += 1
+        elif event == "transfer":
+            self.transferred[0] += record["bytes"]
+            self.transferred[1] += record["seconds"]
+            self.transferred[2] += 1
+            entry = (record["seconds"], record["bytes"], record["url"])
+            if len(self.slowest) < self.keep_slowest:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+        elif event == "file":
+            self.files[record["result"]] = self.files.get(record["result"], 0) + 1
+        elif event == "retry":
+            self.retries += 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the enclosed block as phase name."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.emit("phase", phase=name, seconds=round(time.monotonic() - start, 4))
+
+    def summary(self):
+        """Returns the end-of-run report as printable lines."""
+        with self._lock:
+            elapsed = time.monotonic() - self.start
+            wall = self.phases.get("download") or elapsed
+            size, _, count = self.transferred
+            lines = [
+                f"{size / (1024 * 1024):.1f} MB in {count} transfers, {size / (1024 * 1024) / wall:.2f} MB/s, "
+                f"{self.files.get('downloaded', 0) / wall:.2f} files/s over {wall:.1f}s of downloading",
+                "Files: " + (", ".join(f"{n} {result}" for result, n in sorted(self.files.items())) or "none"),
+                f"Requests: {sum(self.requests.values())} "
+                f"({', '.join(f'{n}x {status}' for status, n in sorted(self.requests.items()))}), "
+                f"{self.retries} retried, mean time to first byte "
+                f"{self.ttfb[0] / self.ttfb[1] if self.ttfb[1] else 0:.3f}s",
+                "Phases: " + ", ".join(f"{name} {seconds:.1f}s" for name, seconds in self.phases.items())
+                + f", total {elapsed:.1f}s",
+            ]
+            for seconds, size, url in sorted(self.slowest, reverse=True):
+                lines.append(f"Slow: {seconds:.2f}s for {size / (1024 * 1024):.1f} MB from {url}")
+            return lines
+
+    def prometheus(self):
+        """Returns the run's metrics in the Prometheus text exposition format."""
+        def metric(name, kind, help_text, samples):
+            out = [f"# HELP luscraper_{name} {help_text}", f"# TYPE luscraper_{name} {kind}"]
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                out.append(f"luscraper_{name}{{{label_text}}} {value}" if label_text else f"luscraper_{name} {value}")
+            return out
+
+        with self._lock:
+            lines = []
+            lines += metric("requests_total", "counter", "HTTP requests by final status.",
+                            [({"status": status}, n) for status, n in sorted(self.requests.items())])
+            lines += metric("request_retries_total", "counter", "Retried request attempts.", [({}, self.retries)])
+            lines += metric("request_ttfb_seconds", "summary", "Time to response headers.", [])
+            lines += [f"luscraper_request_ttfb_seconds_sum {self.ttfb[0]:.4f}",
+                      f"luscraper_request_ttfb_seconds_count {self.ttfb[1]}"]
+            lines += metric("transferred_bytes_total", "counter", "Body bytes received.", [({}, self.transferred[0])])
+            lines += metric("files_total", "counter", "Resources by result.",
+                            [({"result": result}, n) for result, n in sorted(self.files.items())])
+            lines += metric("pages_total", "counter", "Course and resource pages parsed.", [({}, self.pages[1])])
+            lines += metric("phase_seconds", "gauge", "Wall time per phase of the run.",
+                            [({"phase": name}, round(seconds, 4)) for name, seconds in self.phases.items()])
+            lines += metric("run_seconds", "gauge", "Wall time of the run so far.",
+                            [({}, round(time.monotonic() - self.start, 4))])
+            return "\n".join(lines) + "\n"
+
+EVENTS = EventLog()
+
+def finish_instrumentation(metrics_path=None):
+    """Prints the run summary, writes the Prometheus metrics file and closes the event log."""
+    for line in EVENTS.summary():
+        print(f"[SUMMARY] {line}")
+    if metrics_path:
+        try:
+            # Written atomically, so a textfile collector never reads half a file
+            with open(metrics_path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(EVENTS.prometheus())
+            os.replace(metrics_path + ".tmp", metrics_path)
+        except Exception as e:
+            print(f"[ERROR] Failed to write metrics {metrics_path}: {str(e)}")
+    EVENTS.close()
+
+
+# Subtrees dropped as soon as they have been handed out by iter_html: a course page is a list of
+# activities (<li>), so memory stays bounded by the largest activity instead of the whole page
+DISCARDED_TAGS = {"li", "script", "style", "noscript", "svg"}
+
+def iter_html(response, chunk_size=64 * 1024, window=1024 * 1024):
+    """
+    Parses a streamed HTML response incrementally and yields each element once it is complete
+    (its children are still attached). The bytes are fed to lxml as they arrive, without
+    decoding the page into one string or keeping its whole tree.
+
+    libxml2 keeps every byte pushed into one parser, so once a parser has been fed `window`
+    bytes the stream is cut after the next </li> (the end of an activity) and parsing goes on
+    in a fresh parser. Pages smaller than the window are parsed in one piece.
+    """
+    encoding = parse_header_value(response.headers.get("Content-Type"))[1].get("charset") or "utf-8"
+    parser = etree.HTMLPullParser(events=("end",), encoding=encoding)
+    fed = 0
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        cut = chunk.rfind(b"</li>") if fed + len(chunk) >= window else -1
+        if cut == -1:
+            parser.feed(chunk)
+            fed += len(chunk)
+            yield from read_html_events(parser)
+            continue
+        cut += len(b"</li>")
+        parser.feed(chunk[:cut])
+        parser.close()
+        yield from read_html_events(parser)
+        parser = etree.HTMLPullParser(events=("end",), encoding=encoding)
+        fed = len(chunk) - cut
+        if fed:
+            parser.feed(chunk[cut:])
+            yield from read_html_events(parser)
+    if fed:
+        parser.close()
+        yield from read_html_events(parser)
+
+def read_html_events(parser):
+    """Yields the elements the parser has completed and drops the subtrees in DISCARDED_TAGS."""
+    for _, element in parser.read_events():
+        yield element
+        if element.tag in DISCARDED_TAGS:
+            element.clear(keep_tail=True)
+            # Also drop the finished siblings before it, or every activity leaves an empty node behind
+            parent = element.getparent()
+            while parent is not None and element.getprevious() is not None:
+                del parent[0]
+
+def get_user_info(session, base_url):
+    profile_url = f"{base_url}/user/profile.php"
+    div_tag = None
+    with session.get(profile_url, stream=True) as response:
+        # Find the <div> with class "page-header-image mr-2"
+        for element in iter_html(response):
+            if element.tag == "div" and "page-header-image mr-2" in (element.get("class") or ""):
+                div_tag = element
+                break
+    if div_tag is None:
         print("[ERROR] Could not find user profile div!")
         return None, None
 
     # Find the <img> tag with the structure "user/icon/maker/" inside the div
-    img_tag = div_tag[0].xpath('.//img[contains(@src, "user/icon/maker/")]')
+    img_tag = div_tag.xpath('.//img[contains(@src, "user/icon/maker/")]')
     if not img_tag:
         print("[ERROR] Could not find user image tag!")
         return None, None
@@ -164,6 +412,10 @@ def download_user_image(session, image_url):
         return None    
 
 def display_image_in_console(image_path, width=50):
+    Image = load_extra("PIL.Image")  # For image processing
+    np = load_extra("numpy")
+    if not Image or not np:
+        return
     try:
         # Open the image
         img = Image.open(image_path)
@@ -229,9 +481,162 @@ def login_to_moodle(session, login_url, username, password):
     except Exception as e:
         print(f"[ERROR] Login failed: {str(e)}")
         return False
-    
-#def get_course_links():
-    #return COURSE_LINKS
+
+class SessionCache:
+    """
+    Encrypted store of logged-in Moodle sessions (cookies, sesskey, web-service token), one per
+    username and site, shared by later runs and by other processes using the same file.
+    The key comes from LUSCRAPER_CACHE_KEY or is generated once into <path>.key (readable
+    only by the owner). Needs the cryptography package; without it nothing is cached.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fernet = None
+        try:
+            from cryptography.fernet import Fernet
+        except ImportError:
+            print("[WARNING] The cryptography package is not installed, so sessions will not be cached")
+            return
+        try:
+            self.fernet = Fernet(os.environ.get("LUSCRAPER_CACHE_KEY") or self._read_key(Fernet))
+        except Exception as e:
+            print(f"[WARNING] Cannot use session cache key: {str(e)}")
+
+    def _read_key(self, fernet_class):
+        key_path = self.path + ".key"
+        directory = os.path.dirname(os.path.abspath(key_path))
+        os.makedirs(directory, exist_ok=True)
+        try:
+            fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            # Another process may have created the file and not written the key yet
+            for _ in range(20):
+                with open(key_path, "rb") as f:
+                    key = f.read().strip()
+                if key:
+                    return key
+                time.sleep(0.05)
+            return key
+        key = fernet_class.generate_key()
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+        return key
+
+    def _read_all(self):
+        try:
+            with open(self.path, "rb") as f:
+                return json.loads(self.fernet.decrypt(f.read()))
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"[WARNING] Ignoring unreadable session cache {self.path}: {type(e).__name__}")
+            return {}
+
+    def _write_all(self, entries):
+        # Written to a private temporary file and renamed, so other processes never read half a cache
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix=".session-", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.fernet.encrypt(json.dumps(entries).encode("utf-8")))
+            os.replace(temp_path, self.path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    @contextlib.contextmanager
+    def _locked(self, timeout=10.0):
+        """Serialises updates of the cache between processes with an exclusive lock file."""
+        lock_path = self.path + ".lock"
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                break
+            except FileExistsError:
+                if time.monotonic() > deadline:
+                    # Left behind by a process that died while holding it
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(lock_path)
+                    deadline = time.monotonic() + timeout
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            os.close(fd)
+            os.remove(lock_path)
+
+    def load(self, base_url, username):
+        """Returns the cached entry for username on base_url, or None."""
+        if not self.fernet:
+            return None
+        return self._read_all().get(f"{username}@{base_url}")
+
+    def store(self, base_url, username, session, **fields):
+        """Saves the session's cookies and fields (sesskey, token, user) for username on base_url."""
+        if not self.fernet:
+            return
+        cookies = [
+            {"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path,
+             "secure": cookie.secure, "expires": cookie.expires}
+            for cookie in session.cookies if not cookie.is_expired()
+        ]
+        try:
+            with self._locked():
+                entries = self._read_all()
+                entries[f"{username}@{base_url}"] = dict(fields, cookies=cookies, saved=time.time())
+                self._write_all(entries)
+        except Exception as e:
+            print(f"[WARNING] Failed to save session cache {self.path}: {str(e)}")
+
+    def discard(self, base_url, username):
+        if not self.fernet:
+            return
+        try:
+            with self._locked():
+                entries = self._read_all()
+                if entries.pop(f"{username}@{base_url}", None) is not None:
+                    self._write_all(entries)
+        except Exception as e:
+            print(f"[WARNING] Failed to update session cache {self.path}: {str(e)}")
+
+def probe_session(session, base_url, sesskey=None):
+    """
+    Checks cheaply whether session is still logged in: a core_session_time_remaining call when the
+    sesskey is known, else whether /my/ answers without redirecting to the login page.
+    """
+    try:
+        if sesskey:
+            # Moodle answers this call without a login too, for an expired session with userid 0
+            remaining = MoodleAPI(session, base_url, sesskey=sesskey).call("core_session_time_remaining")
+            return bool(remaining.get("userid")) and (remaining.get("timeremaining") or 0) > 0
+        with session.get(f"{base_url}/my/", allow_redirects=False, stream=True) as response:
+            return response.status_code == 200
+    except Exception:
+        return False
+
+def resume_session(session, cache, base_url, username):
+    """
+    Loads username's cached login into session and probes it.
+    Returns the cache entry if it is still valid, else None with the stale entry removed.
+    """
+    entry = cache.load(base_url, username)
+    if not entry:
+        return None
+    for cookie in entry["cookies"]:
+        session.cookies.set(cookie["name"], cookie["value"], domain=cookie["domain"], path=cookie["path"],
+                            secure=cookie["secure"], expires=cookie["expires"])
+    with EVENTS.phase("login"):
+        valid = probe_session(session, base_url, entry.get("sesskey"))
+    EVENTS.emit("session", result="reused" if valid else "expired", age=round(time.time() - entry["saved"]))
+    if valid:
+        print(f"[INFO] Reusing the saved session of {username}")
+        return entry
+    print("[INFO] The saved session has expired, logging in again")
+    session.cookies.clear()
+    cache.discard(base_url, username)
+    return None
 
 def get_course_links():
     print("Enter the course links (one per line). Press Enter twice to finish:")
@@ -244,173 +649,2409 @@ def get_course_links():
             break
     return course_links
 
-def download_files_from_course(session, course_url, output_dir):
-    """Downloads all files from a course page using the mod/resource links."""
-    try:
-        response = session.get(course_url)
-        tree = html.fromstring(response.text)
-        
-        # Extract course name (updated XPath)
-        course_name = tree.xpath('//*[contains(@class, "page-header-headings")]//text()')
-        if not course_name:
-            print(f"[ERROR] Could not extract course name from {course_url}")
-            return False
-        course_name = " ".join(course_name).strip()  # Join all text nodes and strip whitespace
-        
-        # Create course directory
-        course_path = os.path.join(output_dir, sanitize_filename(course_name))
-        os.makedirs(course_path, exist_ok=True)
-        
-        # Find all file links with the structure https://estudijas.lu.lv/mod/resource
-        file_links = tree.xpath('//a[contains(@href, "mod/resource")]')
-        
-        download_count = 0
-        for link in file_links:
-            file_url = link.get("href")
-            file_name = link.xpath('.//span[@class="instancename"]/text()')
-            
+def parse_course_ids(spec, base_url):
+    """
+    Expands a course list such as "11674,13600-13605" (ids, inclusive id ranges or full course
+    links, separated by commas or spaces) into course/view.php links on base_url.
+    """
+    course_links = []
+    for item in re.split(r"[,\s]+", spec.strip()):
+        if not item:
+            continue
+        if "://" in item:
+            course_links.append(item)
+            continue
+        match = re.fullmatch(r"(\d+)(?:-(\d+))?", item)
+        if not match or int(match.group(2) or match.group(1)) < int(match.group(1)):
+            raise ValueError(f"Invalid course id or range: {item}")
+        first, last = int(match.group(1)), int(match.group(2) or match.group(1))
+        course_links += [f"{base_url}/course/view.php?id={course_id}" for course_id in range(first, last + 1)]
+    return course_links
+
+def get_enrolled_courses(session, base_url, api=None):
+    """
+    Lists the course/view.php links of every course the logged-in user is enrolled in:
+    through the web-service API when available, otherwise from the dashboard and profile pages.
+    """
+    if api:
+        try:
+            result = api.call("core_course_get_enrolled_courses_by_timeline_classification",
+                              classification="all", limit=0, offset=0)
+            course_ids = [course["id"] for course in result.get("courses", [])]
+            if course_ids:
+                return [f"{base_url}/course/view.php?id={course_id}" for course_id in course_ids]
+        except Exception as e:
+            print(f"[WARNING] Could not list enrolled courses through the Moodle API ({str(e)})")
+
+    course_ids = []
+    for page in ("/my/courses.php", "/my/", "/user/profile.php"):
+        try:
+            with session.get(base_url + page, stream=True) as response:
+                if response.status_code != 200:
+                    continue
+                for element in iter_html(response):
+                    href = (element.get("href") or "") if element.tag == "a" else ""
+                    if "course/view.php" in href:
+                        course_ids.append(course_id_from_url(urljoin(response.url, href)))
+                    elif "user/view.php" in href:
+                        # The profile lists enrolments as "Course profiles" (user/view.php?id=<user>&course=<course>)
+                        course_id = parse_qs(urlparse(href).query).get("course", [""])[0]
+                        course_ids.append(int(course_id) if course_id.isdigit() else None)
+        except Exception as e:
+            print(f"[WARNING] Failed to read {page}: {str(e)}")
+            continue
+    # Course 1 is the site front page, not an enrolment
+    course_ids = [course_id for course_id in dict.fromkeys(course_ids) if course_id and course_id != 1]
+    return [f"{base_url}/course/view.php?id={course_id}" for course_id in course_ids]
+
+def parse_course_page(session, course_url):
+    """
+    Fetches a course page and returns its name and a list of (file_name, file_url, details)
+    resources (see parse_course_html).
+    """
+    with session.get(course_url, stream=True) as response:
+        start = time.monotonic()
+        course_name, resources = parse_course_html(response)
+    if not course_name:
+        print(f"[ERROR] Could not extract course name from {course_url}")
+        return None, []
+    EVENTS.emit("page", kind="course", url=redact_url(course_url), links=len(resources),
+                seconds=round(time.monotonic() - start, 4))
+    return course_name, resources
+
+def parse_course_html(response):
+    """
+    Reads the course name and (file_name, file_url, details) resources from a streamed course page
+    while it downloads (see iter_html). Returns (None, resources) if the page has no course name.
+    details holds what the page tells about a file before it is requested, for FileFilter.check():
+    its "section" (number, name), its "kind" from the activity's file type icon and its "size" when
+    the course shows resource sizes.
+    """
+    course_name = None
+    resources = []
+    section = None
+    icon = None  # File class of the icon of the activity being read
+    activity_resource = None  # The resource of that activity, for its size shown after the link
+    for element in iter_html(response):
+        if element.tag == "a":
+            # Find all file links with the structure https://estudijas.lu.lv/mod/resource
+            file_url = element.get("href")
+            if not file_url or "mod/resource" not in file_url:
+                continue
+            file_name = element.xpath('.//span[@class="instancename"]/text()')
             if not file_name:
                 print(f"[WARNING] Skipping link {file_url}: No filename found")
                 continue
             file_name = file_name[0].strip()  # Extract the filename from the span
-            
+
             # Handle relative URLs
-            if not file_url.startswith("http"):
-                file_url = "https://estudijas.lu.lv" + file_url
-                
+            details = {"section": section, "kind": icon}
+            resources.append((file_name, urljoin(response.url, file_url), details))
+            activity_resource = details
+        elif element.tag == "img":
+            # The icon is inside the link up to Moodle 3.11 and just before it since 4.0
+            if "activityicon" in (element.get("class") or ""):
+                icon = moodle_icon_class(element.get("src"))
+        elif element.tag == "li":
+            icon = activity_resource = None
+        elif "resourcelinkdetails" in (element.get("class") or ""):
+            # "1.2MB PDF document", shown when the resource's size display is enabled
+            if activity_resource is not None:
+                activity_resource["size"] = parse_size(" ".join(element.xpath(".//text()")))
+        elif "sectionname" in (element.get("class") or "").split():
+            section = (section_number(element), " ".join(element.xpath(".//text()")).strip())
+        elif course_name is None and "page-header-headings" in (element.get("class") or ""):
+            # Join all text nodes and strip whitespace
+            course_name = " ".join(element.xpath(".//text()")).strip() or None
+    return course_name, resources
+
+def section_number(heading):
+    """Returns the number of the course section a sectionname heading belongs to, or None."""
+    number = heading.get("data-number")
+    if number and number.isdigit():
+        return int(number)
+    for ancestor in heading.iterancestors("li"):
+        match = re.fullmatch(r"section-(\d+)", ancestor.get("id") or "")
+        if match:
+            return int(match.group(1))
+    return None
+
+class MoodleAPIError(Exception):
+    """Raised when a Moodle web-service call fails or the service is disabled."""
+
+class MoodleAPI:
+    """
+    Client for Moodle's JSON web services, used to discover course files without scraping HTML.
+    Calls go through the REST endpoint when a token is available, otherwise through the AJAX
+    endpoint authorised by the logged-in session's sesskey.
+    """
+
+    def __init__(self, session, base_url, token=None, sesskey=None):
+        self.session = session
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.sesskey = sesskey
+
+    @classmethod
+    def connect(cls, session, base_url, username=None, password=None, service="moodle_mobile_app",
+                token=None, sesskey=None):
+        """
+        Returns an API client for an already logged-in session: with a web-service token if the
+        site issues one for service, else with the session's sesskey. Returns None if neither works.
+        A token or sesskey remembered from an earlier run is used as is.
+        """
+        base_url = base_url.rstrip("/")
+        if token or sesskey:
+            return cls(session, base_url, token=token, sesskey=sesskey)
+        if username and password:
             try:
-                print(f"[downloading] {file_name} from {file_url}")
-
-                response_head = session.get(file_url, stream=True)
-                content_type = response_head.headers.get("Content-Type", "").lower()
-                
-                # Check if the link is a file or a page
-                is_file = (
-                    any(ct in content_type for ct in FILE_MIME_TYPES)
-                    or any(file_url.lower().endswith(ext) for ext in FILE_EXTENSIONS)
-                )
-
-                if is_file and "text/html" not in content_type:
-                    file_response = session.get(file_url, stream=True)
-                    file_response.raise_for_status()
-                    
-                    # Extract file extension from the URL or Content-Disposition header
-                    file_extension = get_file_extension(file_response, file_url)
-                    file_name_with_extension = f"{file_name}{file_extension}"
-                    
-                    file_path = os.path.join(course_path, sanitize_filename(file_name_with_extension))
-                    
-                    with open(file_path, "wb") as f:
-                        for chunk in file_response.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-                    download_count += 1
-                    print("[SUCCESS] Downloaded", file_name_with_extension)
-                else:
-                    print(f"[INFO] {file_name} is not a direct file link.")
-                    print(f"[INFO] Attempting to scrape embedded files from {file_url}")
-                    # Treat it as a page and scrape for embedded files
-                    embedded_files = scrape_php_page(session, file_url)
-                    if not embedded_files:
-                        print(f"[WARNING] No embedded files found in {file_url}")
-                        continue
-                    
-                    # Download each embedded file
-                    for embedded_url in embedded_files:
-                        embedded_response = session.get(embedded_url, stream=True)
-                        embedded_response.raise_for_status()
-                        
-                        # Extract the filename from the URL
-                        embedded_filename = os.path.basename(urlparse(embedded_url).path)
-                        file_path = os.path.join(course_path, sanitize_filename(file_name + "_" + embedded_filename))
-                        
-                        with open(file_path, "wb") as f:
-                            for chunk in embedded_response.iter_content(chunk_size=8192):
-                                if chunk:
-                                    f.write(chunk)
-                        print("[SUCCESS] Downloaded", sanitize_filename(file_name + "_" + embedded_filename))
-                        download_count += 1
-                        
+                response = session.post(f"{base_url}/login/token.php",
+                                        data={"username": username, "password": password, "service": service})
+                token = response.json().get("token")
+                if token:
+                    return cls(session, base_url, token=token)
+            except Exception:
+                pass
+        try:
+            response = session.get(f"{base_url}/my/")
+            sesskey = re.search(r'"sesskey":"([^"]+)"', response.text)
+            if sesskey:
+                return cls(session, base_url, sesskey=sesskey.group(1))
+        except Exception:
+            pass
+        return None
+
+    def call(self, function, **args):
+        """Calls a web-service function and returns its decoded result."""
+        if self.token:
+            params = {"wstoken": self.token, "wsfunction": function, "moodlewsrestformat": "json"}
+            params.update(flatten_ws_args(args))
+            response = self.session.post(f"{self.base_url}/webservice/rest/server.php", data=params)
+            response.raise_for_status()
+            result = response.json()
+            if isinstance(result, dict) and "exception" in result:
+                raise MoodleAPIError(f"{function}: {result.get('errorcode')} {result.get('message', '')}".strip())
+            return result
+
+        response = self.session.post(
+            f"{self.base_url}/lib/ajax/service.php",
+            params={"sesskey": self.sesskey, "info": function},
+            json=[{"index": 0, "methodname": function, "args": args}],
+        )
+        response.raise_for_status()
+        result = response.json()
+        if isinstance(result, dict):
+            raise MoodleAPIError(f"{function}: {result.get('errorcode', result.get('error'))}")
+        if result[0].get("error"):
+            exception = result[0].get("exception") or {}
+            raise MoodleAPIError(f"{function}: {exception.get('errorcode')} {exception.get('message', '')}".strip())
+        return result[0]["data"]
+
+    def file_url(self, fileurl):
+        """Turns a web-service file URL into one the logged-in session can download."""
+        return fileurl.replace("/webservice/pluginfile.php/", "/pluginfile.php/")
+
+    def discover(self, course_ids, sections=False):
+        """
+        Lists the name and files of every course in two bulk calls.
+        Returns {course_id: (course_name, [(file_name, file_url, details), ...])}, where details
+        holds the file's "extension", "kind" and "size" for FileFilter.check(), and with sections
+        its "section" (number, name), which takes one more call per course.
+        """
+        ids = sorted(set(course_ids))
+        courses = self.call("core_course_get_courses_by_field", field="ids", value=",".join(map(str, ids)))
+        names = {course["id"]: course["fullname"] for course in courses.get("courses", [])}
+        result = {course_id: (name, []) for course_id, name in names.items()}
+        course_sections = {}
+        if sections:
+            for course_id in list(result):
+                try:
+                    contents = self.call("core_course_get_contents", courseid=course_id,
+                                         options=[{"name": "excludemodules", "value": 1}])
+                    course_sections.update({section["id"]: (section.get("section"), section.get("name"))
+                                            for section in contents})
+                except Exception as e:
+                    # Left to the scraper, which reads the sections from the course page
+                    print(f"[WARNING] Could not list the sections of course {course_id} ({str(e)})")
+                    del result[course_id]
+
+        resources = self.call("mod_resource_get_resources_by_courses", courseids=ids)
+        for resource in resources.get("resources", []):
+            if resource["course"] not in result:
+                continue
+            files = sorted(resource.get("contentfiles", []), key=lambda f: f.get("sortorder", 0), reverse=True)
+            for index, content in enumerate(files):
+                # The main file keeps the resource name, extra files are named like embedded ones
+                name = resource["name"] if index == 0 else f"{resource['name']}_{os.path.splitext(content['filename'])[0]}"
+                extension = os.path.splitext(content["filename"])[1].lower()
+                details = {"extension": extension or None, "kind": file_class(extension, content.get("mimetype")),
+                           "size": content.get("filesize")}
+                if sections:
+                    details["section"] = course_sections.get(resource.get("section"))
+                result[resource["course"]][1].append((name, self.file_url(content["fileurl"]), details))
+        return result
+
+def flatten_ws_args(args, prefix=""):
+    """Encodes nested arguments the way Moodle's REST endpoint expects (courseids[0]=1&...)."""
+    flat = {}
+    for key, value in args.items():
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        if isinstance(value, dict):
+            flat.update(flatten_ws_args(value, name))
+        elif isinstance(value, (list, tuple)):
+            flat.update(flatten_ws_args(dict(enumerate(value)), name))
+        else:
+            flat[name] = value
+    return flat
+
+def course_id_from_url(course_url):
+    """Returns the numeric id of a course/view.php?id=... link, or None."""
+    course_id = parse_qs(urlparse(course_url).query).get("id", [None])[0]
+    return int(course_id) if course_id and course_id.isdigit() else None
+
+def discover_courses(api, course_links, sections=False):
+    """
+    Discovers the files of all course_links through the web-service API (with sections, also
+    the course section of each file).
+    Returns {course_url: (course_name, resources)}; courses missing from it (or all of them,
+    when the API is disabled) are left to the HTML scraper.
+    """
+    ids = {course_url: course_id_from_url(course_url) for course_url in course_links}
+    try:
+        found = api.discover([course_id for course_id in ids.values() if course_id], sections)
+    except Exception as e:
+        print(f"[WARNING] Moodle API unavailable ({str(e)}), falling back to page scraping")
+        return {}
+    print(f"[INFO] Discovered {len(found)} of {len(course_links)} courses through the Moodle API")
+    return {course_url: found[course_id] for course_url, course_id in ids.items() if course_id in found}
+
+SIZE_PATTERN = re.compile(r"(\d+(?:[.,]\d+)?)\s*([KMGT]?)(?:I?B|BYTES?)\b", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+def parse_size(text):
+    """Returns the bytes of the first size in text ("2.3MB PDF document", "512 KB", "10 bytes"), or None."""
+    match = SIZE_PATTERN.search(text or "")
+    if not match:
+        return None
+    return int(float(match.group(1).replace(",", ".")) * SIZE_UNITS[match.group(2).upper()])
+
+def size_argument(value):
+    """argparse type for a size in bytes with an optional K/M/G/T unit ("500000", "200M", "1.5GB")."""
+    size = value.strip()
+    if size.isdigit():
+        return int(size)
+    if size[-1:].upper() in ("K", "M", "G", "T"):
+        size += "B"
+    if not SIZE_PATTERN.fullmatch(size):
+        raise argparse.ArgumentTypeError(f"invalid size: {value}")
+    return parse_size(size)
+
+def split_list(value):
+    """Splits a comma or space separated option value ("pdf,docx") into its items."""
+    return [item for item in re.split(r"[,\s]+", value or "") if item]
+
+def file_class(extension=None, media_type=None):
+    """
+    Returns the FILE_CLASSES group of a file by its extension, else by its media type
+    ("video/x-flv" -> "video"), or None if neither tells.
+    """
+    kind = EXTENSION_CLASSES.get(extension) or EXTENSION_CLASSES.get(FILE_MIME_TYPES.get(media_type))
+    if kind or not media_type:
+        return kind
+    main_type = media_type.partition("/")[0]
+    if main_type in ("image", "audio", "video"):
+        return main_type
+    return "document" if main_type == "text" else None
+
+def moodle_icon_class(icon_url):
+    """Returns the file class shown by a Moodle file icon (.../f/pdf-24 -> "document"), or None."""
+    match = MOODLE_ICON_PATTERN.search(icon_url or "")
+    return MOODLE_ICON_CLASSES.get(match.group(1)) if match else None
+
+class FileFilter:
+    """
+    The file selection of --include-ext, --exclude-ext, --include-type, --exclude-type, --max-size,
+    --section, --name and --exclude-name.
+    check() is called with whatever is known about a file so far: first what the course page
+    (name, section, type icon, shown size) or the API listing (name, section, file name, size)
+    says, then what the headers of its response add. A rule only rejects a file on facts it has,
+    so a file is skipped as soon as it is known to be excluded, and always before its body is read.
+    """
+
+    def __init__(self, include_ext=(), exclude_ext=(), include_type=(), exclude_type=(),
+                 max_size=None, sections=(), names=(), exclude_names=()):
+        self.include_ext = {"." + extension.lower().lstrip(".") for extension in include_ext}
+        self.exclude_ext = {"." + extension.lower().lstrip(".") for extension in exclude_ext}
+        self.include_type = set(include_type)
+        self.exclude_type = set(exclude_type)
+        self.max_size = max_size
+        self.sections = [section.lower() for section in sections]
+        self.names = [name.lower() for name in names]
+        self.exclude_names = [name.lower() for name in exclude_names]
+        # The classes of the included extensions: a video icon rules a file out before its extension is known
+        self.include_ext_types = {EXTENSION_CLASSES.get(extension) for extension in self.include_ext}
+
+    @classmethod
+    def from_args(cls, args):
+        """Returns the filter the command line asks for, or None if it sets no rules."""
+        file_filter = cls(split_list(args.include_ext), split_list(args.exclude_ext),
+                          split_list(args.include_type), split_list(args.exclude_type),
+                          args.max_size, args.section or (), args.name or (), args.exclude_name or ())
+        rules = (file_filter.include_ext, file_filter.exclude_ext, file_filter.include_type, file_filter.exclude_type,
+                 file_filter.sections, file_filter.names, file_filter.exclude_names)
+        return file_filter if any(rules) or args.max_size is not None else None
+
+    def check(self, name=None, extension=None, kind=None, size=None, section=None):
+        """
+        Returns why a file is excluded (e.g. "video files are excluded"), or None if nothing known
+        about it so far excludes it. section is the (number, name) of its course section.
+        """
+        if name is not None:
+            lowered = name.lower()
+            if self.names and not any(fnmatch.fnmatchcase(lowered, pattern) for pattern in self.names):
+                return "name does not match --name"
+            if any(fnmatch.fnmatchcase(lowered, pattern) for pattern in self.exclude_names):
+                return "name matches --exclude-name"
+        if section is not None and self.sections:
+            number, title = section
+            if not any(pattern == str(number) or fnmatch.fnmatchcase((title or "").lower(), pattern)
+                       for pattern in self.sections):
+                return f"section {title or number} is not selected"
+        if extension:
+            if self.include_ext and extension not in self.include_ext:
+                return f"{extension} files are not included"
+            if extension in self.exclude_ext:
+                return f"{extension} files are excluded"
+        elif kind and self.include_ext and None not in self.include_ext_types and kind not in self.include_ext_types:
+            return f"{kind} files are not included"
+        if kind:
+            if self.include_type and kind not in self.include_type:
+                return f"{kind} files are not included"
+            if kind in self.exclude_type:
+                return f"{kind} files are excluded"
+        if size is not None and self.max_size is not None and size > self.max_size:
+            return f"{size / (1024 * 1024):.1f} MB is over --max-size"
+        return None
+
+    def check_response(self, name, response, extension):
+        """check() with what the headers of a file's response add: its media type and Content-Length."""
+        kind = file_class(extension, media_type_of(response.headers.get("Content-Type"))) or "other"
+        return self.check(name, extension, kind, response_length(response))
+
+def report_excluded(label, url, reason):
+    """Prints and records a file the filters leave out."""
+    print(f"[INFO] Skipping {label}: {reason}")
+    EVENTS.emit("file", result="excluded", url=redact_url(url), reason=reason)
+
+class DownloadEstimate:
+    """
+    Per-course totals of a --dry-run: the files a real run would download and their size, as far
+    as the course listing or the response headers tell it. A URL listed twice is counted once.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._urls = set()
+        self.courses = {}
+
+    def add_course(self, course_path, course_name):
+        with self._lock:
+            self.courses.setdefault(course_path, {"course": course_name, "files": 0, "bytes": 0,
+                                                  "unknown_size": 0, "unchanged": 0, "excluded": 0})
+
+    def add(self, course_path, result, size=None, url=None):
+        """Counts a file of a course by its result: "downloaded" (size None if unknown), "linked", "unchanged" or "excluded"."""
+        with self._lock:
+            totals = self.courses[course_path]
+            if result in ("unchanged", "excluded"):
+                totals[result] += 1
+                return
+            totals["files"] += 1
+            if result == "linked" or url in self._urls:
+                return
+            if url:
+                self._urls.add(url)
+            if size is None:
+                totals["unknown_size"] += 1
+            else:
+                totals["bytes"] += size
+
+    @staticmethod
+    def describe(totals):
+        text = f"{totals['files']} files, {totals['bytes'] / (1024 * 1024):.1f} MB"
+        if totals["unknown_size"]:
+            text += f" + {totals['unknown_size']} files of unknown size"
+        if totals["unchanged"]:
+            text += f", {totals['unchanged']} unchanged"
+        if totals["excluded"]:
+            text += f", {totals['excluded']} excluded"
+        return text
+
+    def report(self):
+        """Prints the estimate of every course and the total. Returns the per-course totals."""
+        with self._lock:
+            courses = sorted((dict(totals) for totals in self.courses.values()), key=lambda totals: totals["course"])
+        for totals in courses:
+            print(f"[ESTIMATE] {totals['course']}: {self.describe(totals)}")
+        total = {key: sum(totals[key] for totals in courses)
+                 for key in ("files", "bytes", "unknown_size", "unchanged", "excluded")}
+        print(f"[ESTIMATE] Total for {len(courses)} courses: {self.describe(total)}")
+        return courses
+
+MANIFEST_NAME = ".luscraper_manifest.json"
+PARTIAL_SUFFIX = ".part"
+CHECKPOINT_SUFFIX = ".part.json"
+ARCHIVE_STATE_NAME = ".luscraper_archives.json"
+ARCHIVE_EXTENSIONS = {"zip": ".zip", "tar.zst": ".tar.zst"}
+
+# Retries per file after a dropped connection, waiting RETRY_BACKOFF * 2**attempt seconds
+DOWNLOAD_RETRIES = 4
+RETRY_BACKOFF = 1.0
+
+# Bodies are read in about 64 pieces, between these sizes (or TRANSFER_CHUNK_DEFAULT without a length)
+TRANSFER_CHUNK_MIN = 64 * 1024
+TRANSFER_CHUNK_MAX = 1024 * 1024
+TRANSFER_CHUNK_DEFAULT = 256 * 1024
+
+# Free space a run leaves untouched on every file system it writes to
+DISK_HEADROOM = 64 * 1024 * 1024
+
+def transfer_chunk_size(content_length):
+    """Picks the read size for a body of content_length bytes: fewer, larger reads for larger files."""
+    if not content_length:
+        return TRANSFER_CHUNK_DEFAULT
+    return min(TRANSFER_CHUNK_MAX, max(TRANSFER_CHUNK_MIN, content_length // 64))
+
+def is_encoded(response):
+    """Whether the body of response is sent compressed (Content-Encoding: gzip, br, ...)."""
+    return response.headers.get("Content-Encoding", "identity").lower() != "identity"
+
+def response_length(response):
+    """
+    Returns the Content-Length of a response as an int, or None. A compressed transfer
+    (Content-Encoding: gzip) is decoded as it is read, so its Content-Length says nothing
+    about the size of the file and None is returned too.
+    """
+    if is_encoded(response):
+        return None
+    content_length = response.headers.get("Content-Length", "")
+    return int(content_length) if content_length.isdigit() else None
+
+def preallocate(f, length):
+    """Reserves length bytes for the open file f up front where the platform allows it."""
+    if not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), 0, length)
+        return True
+    except OSError:
+        # Not supported by this file system, the writes allocate as they go
+        return False
+
+def fsync_path(path):
+    """Flushes a written file (or, on POSIX, a directory entry) to disk."""
+    try:
+        fd = os.open(path, os.O_RDONLY if os.path.isdir(path) else os.O_RDWR)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def fsync_files(paths, workers=4):
+    """Flushes many finished files at once on a small thread pool, then their directories."""
+    paths = list(dict.fromkeys(paths))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(fsync_path, paths))
+        list(pool.map(fsync_path, set(os.path.dirname(path) for path in paths)))
+
+def existing_parent(path):
+    """Returns path, or its nearest ancestor that exists."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+class DiskSpaceError(Exception):
+    """Raised when a file or archive would not fit in the free disk space."""
+
+class DiskBudget:
+    """
+    Keeps a run from filling its disks half-way. Every file's size is reserved before its body is
+    written: once in the staging directory (unless files stream into the archive) and once more
+    in the archive that will hold it. A reservation that does not fit raises DiskSpaceError.
+    Free space is measured when the run starts, keeping DISK_HEADROOM spare.
+    """
+
+    def __init__(self, staging_dir, zip_name, staged=True, archived_bytes=0):
+        self._lock = Lock()
+        self.free = {}
+        self.copies = {}
+        self.paths = {}
+        zip_dir = existing_parent(os.path.dirname(os.path.abspath(zip_name)))
+        for directory in ([existing_parent(staging_dir)] if staged else []) + [zip_dir]:
+            device = os.stat(directory).st_dev
+            self.free[device] = shutil.disk_usage(directory).free - DISK_HEADROOM
+            self.copies[device] = self.copies.get(device, 0) + 1
+            self.paths.setdefault(device, directory)
+        self.reserved = dict.fromkeys(self.free, 0)
+        # Files kept from an earlier --sync run need no download, but the archive still holds them
+        self.reserved[os.stat(zip_dir).st_dev] += archived_bytes
+
+    def check(self, size, label="file"):
+        """Raises DiskSpaceError if size more bytes would not fit, without claiming them."""
+        with self._lock:
+            self._check(size, label)
+
+    def reserve(self, size, label="file"):
+        """Claims the space for a file of size bytes, or raises DiskSpaceError if it does not fit."""
+        if not size:
+            return
+        with self._lock:
+            self._check(size, label)
+            for device in self.free:
+                self.reserved[device] += size * self.copies[device]
+
+    def _check(self, size, label):
+        for device, free in self.free.items():
+            needed = size * self.copies[device]
+            if self.reserved[device] + needed > free:
+                raise DiskSpaceError(
+                    f"Not enough disk space for {label}: it needs {needed / (1024 * 1024):.1f} MB on "
+                    f"{self.paths[device]}, {max(0, free - self.reserved[device]) / (1024 * 1024):.1f} MB are left")
+
+RETRYABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+# Defaults of the session's transport (see TransportAdapter)
+HTTP_TIMEOUT = (10, 60)  # Seconds to connect, and to wait for each read of a response
+HTTP_RETRIES = 3  # Retries of a request that failed to connect or was answered with a status below
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class SyncManifest:
+    """
+    Persistent record of downloaded resources keyed by URL, used by --sync mode.
+    Stores the saved filename, ETag, Last-Modified, Content-Length and SHA-256 of every file,
+    so the next run can send conditional requests and skip files that did not change.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        self._lock = Lock()
+        self.entries = {}
+        self.unsynced = []  # Files recorded since the last save, flushed together by save()
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
             except Exception as e:
-                print(f"[ERROR] Failed to download {file_name}: {str(e)}")
-                
-        print(f"[INFO] Downloaded {download_count} files for {course_name}")
-        if download_count == 0:
-            os.rmdir(course_path) 
-            return False 
+                print(f"[WARNING] Ignoring unreadable manifest {path}: {str(e)}")
+        # Interrupted transfers of earlier runs, keyed by URL
+        self.partials = {}
+        for root, _, files in os.walk(self.root):
+            for file in files:
+                if file.endswith(CHECKPOINT_SUFFIX):
+                    checkpoint = read_checkpoint(os.path.join(root, file))
+                    # A preallocated .part left by a killed run may end in zeros that never arrived
+                    if checkpoint and not checkpoint.get("preallocated"):
+                        self.partials[checkpoint["url"]] = checkpoint
+
+    def request_headers(self, url, consume=True):
+        """
+        Returns the headers for the first request of url and the .part path it would resume:
+        a Range/If-Range request for an interrupted transfer, otherwise conditional headers.
+        With consume=False (a --dry-run) the interrupted transfer stays there for the real run.
+        """
+        checkpoint = self.partials.pop(url, None) if consume else self.partials.get(url)
+        if checkpoint and os.path.exists(checkpoint["part_path"]):
+            offset = os.path.getsize(checkpoint["part_path"])
+            return checkpoint["part_path"], {"Range": f"bytes={offset}-", "If-Range": checkpoint["validator"],
+                                             "Accept-Encoding": "identity"}
+        return None, self.conditional_headers(url)
+
+    def conditional_headers(self, url):
+        """Returns If-None-Match/If-Modified-Since headers for url if its file is still on disk."""
+        with self._lock:
+            entry = self.entries.get(url)
+        if not entry or not os.path.exists(os.path.join(self.root, entry["filename"])):
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def filename(self, url):
+        """Returns the path (relative to the manifest) previously saved for url."""
+        with self._lock:
+            return self.entries[url]["filename"]
+
+    def record(self, url, file_path, response, size, sha256):
+        """Remembers the validators of a freshly downloaded file."""
+        entry = {
+            "filename": os.path.relpath(os.path.abspath(file_path), self.root),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_length": size,
+            "sha256": sha256,
+        }
+        with self._lock:
+            self.entries[url] = entry
+            self.unsynced.append(file_path)
+
+    def record_link(self, url, file_path, original):
+        """
+        Remembers file_path, saved as a link to the recorded file original, under url with the
+        original's validators, so the next run revalidates it instead of downloading it again.
+        """
+        original_name = os.path.relpath(os.path.abspath(original), self.root)
+        with self._lock:
+            source_url = next((key for key, entry in self.entries.items() if entry["filename"] == original_name), None)
+            if source_url is None or source_url == url:
+                return
+            self.entries[url] = dict(self.entries[source_url],
+                                     filename=os.path.relpath(os.path.abspath(file_path), self.root))
+
+    def stored_bytes(self):
+        """
+        Returns the size of the recorded files still on disk, each counted once: entries from
+        record_link name hardlinks to a file another entry already counts.
+        """
+        with self._lock:
+            filenames = {entry["filename"] for entry in self.entries.values()}
+        stored = {}
+        for filename in filenames:
+            try:
+                file_stat = os.stat(os.path.join(self.root, filename))
+            except OSError:
+                continue  # Deleted since, it will be downloaded again
+            stored[(file_stat.st_dev, file_stat.st_ino)] = file_stat.st_size
+        return sum(stored.values())
+
+    def save(self):
+        """
+        Writes the manifest to disk atomically, after flushing the files recorded since the last
+        save, so it never lists a file whose data a crash could still lose.
+        """
+        with self._lock:
+            data = json.dumps(self.entries, indent=2, ensure_ascii=False)
+            unsynced, self.unsynced = self.unsynced, []
+        fsync_files([path for path in unsynced if os.path.exists(path)])
+        os.makedirs(self.root, exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        fsync_path(self.root)
+
+class ContentStore:
+    """
+    Run-wide deduplication of downloads.
+    Each pluginfile URL is fetched at most once per run, and bodies with the same SHA-256 are
+    downloaded once: later copies become hardlinks on disk, and in an archive written during the
+    download (--no-staging) entries copied from the first one, or linking to it (see ZipVolumes).
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._urls = {}
+        self._hashes = {}
+        self.linked_bytes = 0
+
+    def claim(self, url, wait=True):
+        """
+        Reserves url for the calling download. Returns (owner, path): the owner fetches url and must
+        call release(); everyone else gets the path an earlier download of url was saved to, waiting
+        for it if necessary (path is None if that download failed and the caller should fetch itself).
+        With wait=False, a download of url that is still running returns (None, None) instead.
+        """
+        with self._lock:
+            pending = self._urls.get(url)
+            if pending is None:
+                self._urls[url] = {"done": Event(), "path": None}
+                return True, None
+        if not wait and not pending["done"].is_set():
+            return None, None
+        pending["done"].wait()
+        return False, pending["path"]
+
+    def release(self, url, file_path=None):
+        """Publishes where a claimed url was saved, or None if its download failed."""
+        with self._lock:
+            pending = self._urls[url]
+            if file_path is None:
+                # Let a later occurrence of the URL try again
+                del self._urls[url]
+        pending["path"] = file_path
+        pending["done"].set()
+
+    def add(self, file_path, size, sha256):
+        """Registers a saved body. Returns the path of an identical earlier body, or None if it is new."""
+        with self._lock:
+            original = self._hashes.setdefault(sha256, file_path)
+            if original == file_path:
+                return None
+            self.linked_bytes += size
+            return original
+
+def link_duplicate(original, file_path, archive=None):
+    """Makes file_path refer to the already stored original instead of holding a second copy."""
+    if os.path.abspath(original) == os.path.abspath(file_path):
+        return
+    if archive:
+        archive.write_link(file_path, original)
+        return
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    try:
+        os.link(original, file_path)
+    except OSError:
+        # No hardlinks on this filesystem
+        shutil.copyfile(original, file_path)
+
+def write_link_entry(zipf, arcname, target_arcname):
+    """Adds arcname to the archive as a symbolic link to target_arcname (relative, as unzip expects)."""
+    target = os.path.relpath(target_arcname, os.path.dirname(arcname) or ".").replace(os.sep, "/")
+    zinfo = zipfile.ZipInfo(arcname.replace(os.sep, "/"), date_time=time.localtime()[:6])
+    zinfo.create_system = 3  # Unix, so the mode bits below are honoured
+    zinfo.external_attr = (stat.S_IFLNK | 0o777) << 16
+    zipf.writestr(zinfo, target, compress_type=zipfile.ZIP_STORED)
+
+# zipfile has no public call to take back a member that is being written (discard_entry) or to
+# append data that is already compressed (write_raw_member), so both use ZipFile internals. They
+# are the same in CPython 3.6 to 3.13; elsewhere bodies are only added to a ZIP once they are
+# complete, and members are compressed by ZipFile itself.
+ZIPFILE_INTERNALS = sys.implementation.name == "cpython" and (3, 6) <= sys.version_info[:2] <= (3, 13) and \
+    hasattr(zipfile, "_ZipWriteFile") and hasattr(zipfile.ZipFile, "_writecheck")
+
+def discard_entry(zipf, entry):
+    """
+    Drops a member still open for writing (from ZipFile.open(name, "w")) as if it had never been
+    started. Only with ZIPFILE_INTERNALS.
+    """
+    # zipfile can only commit an open member, so this undoes what ZipFile.open wrote so far
+    header_offset = entry._zinfo.header_offset
+    io.BufferedIOBase.close(entry)  # Marks the entry closed without writing its sizes and CRC
+    zipf._writing = False
+    zipf.fp.seek(header_offset)
+    zipf.fp.truncate()
+    zipf.start_dir = header_offset
+
+def volume_path(name, number, archive_format="zip"):
+    """
+    Returns the path of volume number (from 1) of an archive split by --volume-size: every ZIP
+    volume is an archive of its own (Courses_Data.part1.zip), a tar.zst is one stream cut into
+    pieces that are joined with cat before extracting (Courses_Data.tar.zst.001).
+    """
+    if archive_format == "zip":
+        base, extension = split_archive_name(name)
+        return f"{base}.part{number}{extension}"
+    return f"{name}.{number:03d}"
+
+class ZipVolumes:
+    """
+    The ZipFile the members of an archive go to. Without volume_size that is zip_name itself.
+    With it, a new volume is started whenever the next member would push the current one over
+    volume_size, so every volume stays under it (a single larger member gets a volume of its own)
+    and can be uploaded, copied and opened on its own.
+    Duplicates are stored as full copies unless links is set (--zip-links): symbolic link entries
+    are restored by unzip and 7-Zip on Linux and macOS, but Windows Explorer and Python's zipfile
+    extract them as small files holding the target's path.
+    """
+
+    def __init__(self, zip_name, volume_size=None, links=False):
+        self.zip_name = zip_name
+        self.volume_size = volume_size
+        self.links = links
+        self.paths = []
+        self.zipf = None
+        self._next()
+
+    def _next(self):
+        if self.zipf:
+            self.zipf.close()
+        path = volume_path(self.zip_name, len(self.paths) + 1) if self.volume_size else self.zip_name
+        self.paths.append(path)
+        self.zipf = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        self._directory_size = 22 + 76  # End of central directory records, with ZIP64
+
+    def for_member(self, arcname, size=None):
+        """Returns the ZipFile to add a member of about size stored bytes to."""
+        # Local header, data descriptor and central directory entry, each with ZIP64 fields
+        overhead = 2 * len(arcname.encode("utf-8")) + 180
+        if self.volume_size and self.zipf.filelist and \
+                self.zipf.start_dir + self._directory_size + overhead + (size or 0) > self.volume_size:
+            self._next()
+        self._directory_size += overhead
+        return self.zipf
+
+    def add_link(self, arcname, target):
+        """
+        Adds arcname as a copy of the member target, or with links as a link entry to it. A link
+        can't reach into another volume, so if target went to an earlier one its data is copied.
+        """
+        name = target.replace(os.sep, "/")
+        if name in self.zipf.NameToInfo and self.links:
+            zipf = self.for_member(arcname)
+            if name in zipf.NameToInfo:
+                write_link_entry(zipf, arcname, target)
+                return
+        if name in self.zipf.NameToInfo:
+            # The volume can't be read while an entry of it is open for writing, so the data is spooled first
+            member = self.zipf.getinfo(name)
+            with tempfile.SpooledTemporaryFile(max_size=32 * 1024 * 1024) as spool:
+                with self.zipf.open(member) as data:
+                    shutil.copyfileobj(data, spool, 1024 * 1024)
+                spool.seek(0)
+                zinfo = zipfile.ZipInfo(arcname.replace(os.sep, "/"), member.date_time)
+                zinfo.compress_type = member.compress_type
+                zinfo.external_attr = member.external_attr
+                zipf = self.for_member(arcname, member.compress_size)
+                with zipf.open(zinfo, "w", force_zip64=member.file_size >= zipfile.ZIP64_LIMIT) as entry:
+                    shutil.copyfileobj(spool, entry, 1024 * 1024)
+            return
+        for path in reversed(self.paths[:-1]):
+            with zipfile.ZipFile(path) as source, open(path, "rb") as raw:
+                if name in source.NameToInfo:
+                    member = source.getinfo(name)
+                    copy_raw_member(self.for_member(arcname, member.compress_size), source, raw, member, arcname)
+                    return
+        raise KeyError(f"{target} is not in the archive")
+
+    def close(self):
+        self.zipf.close()
+        for path in self.paths:
+            fsync_path(path)
+
+class VolumeFile:
+    """
+    Binary file that, given a volume_size, cuts what is written to it into pieces of that size
+    (see volume_path). Without one it is simply the file name.
+    """
+
+    def __init__(self, name, volume_size=None, archive_format="tar.zst"):
+        self.name = name
+        self.volume_size = volume_size
+        self.archive_format = archive_format
+        self.paths = []
+        self._file = None
+        self._left = 0
+        self._next()
+
+    def _next(self):
+        if self._file:
+            self._file.close()
+        path = volume_path(self.name, len(self.paths) + 1, self.archive_format) if self.volume_size else self.name
+        self.paths.append(path)
+        self._file = open(path, "wb")
+        self._left = self.volume_size
+
+    def write(self, data):
+        if not self.volume_size:
+            return self._file.write(data)
+        view = memoryview(data).cast("B")
+        while view:
+            if not self._left:
+                self._next()
+            piece = view[:self._left]
+            self._file.write(piece)
+            self._left -= len(piece)
+            view = view[len(piece):]
+        return len(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+            for path in self.paths:
+                fsync_path(path)
+
+def open_tar_zst(tar_name, compresslevel=6, volume_size=None):
+    """
+    Opens a tar stream compressed with zstd on all cores (--format tar.zst) for writing.
+    Needs the zstandard package, which parse_args checks for. Returns the TarFile, whose close()
+    finishes the archive, and the VolumeFile it is written to.
+    """
+    import zstandard
+    output = VolumeFile(tar_name, volume_size)
+    compressor = zstandard.ZstdCompressor(level=max(1, compresslevel), threads=-1)
+    stream = compressor.stream_writer(output)
+    tarf = tarfile.open(fileobj=stream, mode="w|", format=tarfile.PAX_FORMAT)
+    close_tar = tarf.close
+
+    def close():
+        # The TarFile leaves a file object it was given open, but the zstd frame must end too
+        close_tar()
+        stream.close()
+    tarf.close = close
+    return tarf, output
+
+class ArchiveStreamWriter:
+    """
+    Writes downloaded bodies straight into an archive instead of a staging directory.
+    An archive can only have one entry open for writing, so a download that finds the archive free
+    streams its chunks directly into a new entry (if the format allows, see streams()); downloads
+    that arrive while it is busy are spooled (in memory up to spool_limit, then to a temporary
+    file) and appended in order by a single writer thread. A body that fails while it is spooled
+    never reaches the archive. The format is up to the subclass: ZipStreamWriter or TarStreamWriter.
+    """
+
+    def __init__(self, archive_name, root, spool_limit=32 * 1024 * 1024):
+        self.archive_name = archive_name
+        self.root = root
+        self.spool_limit = spool_limit
+        self.file_count = 0
+        self._lock = Lock()
+        self._queue = queue.Queue()
+        self._writer = Thread(target=self._drain, daemon=True)
+        self._writer.start()
+
+    def arcname(self, file_path):
+        """Maps a would-be staging path to its name inside the archive."""
+        return os.path.relpath(file_path, self.root)
+
+    def streams(self, size):
+        """Whether a body of size bytes (None if unknown) may be written to the archive as it arrives."""
         return True
-    except Exception as e:
-        print(f"[ERROR] Course processing failed: {str(e)}")
+
+    def _write_entry(self, arcname, chunks, size, content_type=None):
+        raise NotImplementedError
+
+    def _write_spooled(self, arcname, spool, size, content_type=None):
+        """Adds a complete body of size bytes, read from the file object spool."""
+        self._write_entry(arcname, iter(lambda: spool.read(1024 * 1024), b""), size, content_type)
+
+    def _write_link(self, arcname, target):
+        raise NotImplementedError
+
+    def _finish(self):
+        """Finalises the archive and returns the paths of the files it was written to."""
+        raise NotImplementedError
+
+    def write_stream(self, file_path, chunks, size=None, content_type=None):
+        """Stores an iterable of byte chunks as file_path's entry."""
+        arcname = self.arcname(file_path)
+        if self.streams(size) and self._lock.acquire(blocking=False):
+            try:
+                self._write_entry(arcname, chunks, size, content_type)
+                self.file_count += 1
+            finally:
+                self._lock.release()
+            return
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_limit)
+        for chunk in chunks:
+            spool.write(chunk)
+
+        def write_spooled():
+            with spool:
+                size = spool.seek(0, os.SEEK_END)
+                spool.seek(0)
+                self._write_spooled(arcname, spool, size, content_type)
+                self.file_count += 1
+        self._queue.put((arcname, write_spooled))
+
+    def write_link(self, file_path, target_path):
+        """Stores file_path as a reference to the entry of target_path instead of a second copy."""
+        arcname = self.arcname(file_path)
+        target = self.arcname(target_path)
+
+        def write_reference():
+            self._write_link(arcname, target)
+            self.file_count += 1
+        self._queue.put((arcname, write_reference))
+
+    def _drain(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            arcname, write = item
+            try:
+                with self._lock:
+                    write()
+            except Exception as e:
+                print(f"[ERROR] Failed to add {arcname} to the archive: {str(e)}")
+
+    def close(self):
+        """Flushes queued entries and finalises the archive."""
+        self._queue.put(None)
+        self._writer.join()
+        self.paths = self._finish()
+        EVENTS.emit("archive", path=self.archive_name, members=self.file_count,
+                    bytes=sum(os.path.getsize(path) for path in self.paths))
+
+class ZipStreamWriter(ArchiveStreamWriter):
+    """
+    ArchiveStreamWriter for ZIP archives, split into volumes of volume_size if one is given
+    (see ZipVolumes, also for links). A member that fails while it is streamed is dropped again.
+    """
+
+    def __init__(self, zip_name, root, spool_limit=32 * 1024 * 1024, compresslevel=6, volume_size=None,
+                 links=False):
+        self.compresslevel = compresslevel
+        self.volumes = ZipVolumes(zip_name, volume_size, links)
+        self.paths = self.volumes.paths
+        super().__init__(zip_name, root, spool_limit)
+
+    def streams(self, size):
+        # A volume is picked by the member's size, so a body of unknown length is measured first.
+        # A stream that fails can only be dropped with discard_entry, so without it every body is spooled.
+        return ZIPFILE_INTERNALS and (size is not None or not self.volumes.volume_size)
+
+    def _write_entry(self, arcname, chunks, size, content_type=None):
+        zipf = self.volumes.for_member(arcname, size)
+        # Entries of unknown or large size need ZIP64 headers up front
+        force_zip64 = size is None or size >= zipfile.ZIP64_LIMIT
+        # ZipFile.open(name, "w") takes the method and level of the archive itself
+        zipf.compression, zipf.compresslevel = compression_for(arcname, content_type, self.compresslevel)
+        entry = zipf.open(arcname, "w", force_zip64=force_zip64)
+        try:
+            for chunk in chunks:
+                entry.write(chunk)
+        except BaseException:
+            if not ZIPFILE_INTERNALS:
+                # Only complete, spooled bodies get here (see streams()), so reading them failed locally
+                entry.close()
+                raise
+            # Closing the entry would commit the truncated body as a valid member
+            discard_entry(zipf, entry)
+            raise
+        entry.close()
+
+    def _write_link(self, arcname, target):
+        self.volumes.add_link(arcname, target)
+
+    def _finish(self):
+        self.volumes.close()
+        return self.volumes.paths
+
+class TarStreamWriter(ArchiveStreamWriter):
+    """
+    ArchiveStreamWriter for a zstd-compressed tar (--format tar.zst), compressed on all cores while
+    the downloads go on. A tar header carries the entry's exact size and nothing can be taken back
+    out of the compressed stream, so every body is spooled and only added once it is complete.
+    Duplicates become tar hard links.
+    """
+
+    def __init__(self, tar_name, root, spool_limit=32 * 1024 * 1024, compresslevel=6, volume_size=None):
+        self.tarf, self.output = open_tar_zst(tar_name, compresslevel, volume_size)
+        self.paths = self.output.paths
+        super().__init__(tar_name, root, spool_limit)
+
+    def streams(self, size):
         return False
 
-def scrape_php_page(session, php_url):
-    """Scrapes a .php page for embedded files with the structure .../mod_resource/content/."""
+    def _write_spooled(self, arcname, spool, size, content_type=None):
+        info = tarfile.TarInfo(arcname.replace(os.sep, "/"))
+        info.size, info.mtime, info.mode = size, time.time(), 0o644
+        self.tarf.addfile(info, spool)
+
+    def _write_link(self, arcname, target):
+        info = tarfile.TarInfo(arcname.replace(os.sep, "/"))
+        info.type, info.linkname, info.mtime, info.mode = tarfile.LNKTYPE, target.replace(os.sep, "/"), time.time(), 0o644
+        self.tarf.addfile(info)
+
+    def _finish(self):
+        self.tarf.close()
+        return self.output.paths
+
+def range_validator(response):
+    """Returns the validator usable in If-Range: a strong ETag, else Last-Modified."""
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+def content_range_start(response):
+    """Returns the first byte offset of a 206 response (from "Content-Range: bytes start-end/total")."""
+    content_range = response.headers.get("Content-Range", "")
+    match = re.match(r"bytes (\d+)-", content_range)
+    return int(match.group(1)) if match else None
+
+def write_checkpoint(part_path, url, response, preallocated=False):
+    """
+    Records how to resume part_path, if the server lets us (byte ranges and a validator).
+    A preallocated .part is as long as the whole file, so its size says nothing about what
+    arrived; such a checkpoint is only resumable once it has been rewritten without the flag.
+    """
+    validator = range_validator(response)
+    ranges = response.status_code == 206 or response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    # A range counts bytes of the encoded body, the .part holds decoded ones
+    if not validator or not ranges or is_encoded(response):
+        return
+    checkpoint = {"url": url, "validator": validator}
+    if preallocated:
+        checkpoint["preallocated"] = True
+    with open(part_path + ".json", "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+
+def read_checkpoint(checkpoint_path):
+    """Loads a checkpoint written by write_checkpoint, or returns None if it is unusable."""
     try:
-        response = session.get(php_url)
-        tree = html.fromstring(response.text)
-        
-        # Find all embedded files with the structure .../mod_resource/content/
-        embedded_files = tree.xpath('//img[contains(@src, "mod_resource/content")]/@src')
-        embedded_files += tree.xpath('//a[contains(@href, "mod_resource/content")]/@href')
-        
-        # Ensure URLs are absolute
-        embedded_files = [
-            "https://estudijas.lu.lv" + url if not url.startswith("http") else url
-            for url in embedded_files
-        ]
-        
-        return embedded_files
+        with open(checkpoint_path, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        checkpoint["part_path"] = checkpoint_path[:-len(".json")]
+        return checkpoint
+    except Exception:
+        return None
+
+def iter_resumable(session, url, response, offset=0, retries=None, chunk_size=TRANSFER_CHUNK_DEFAULT):
+    """
+    Yields the body of response, which starts at byte offset of the file.
+    When the connection drops mid-body the rest is requested again after an exponential backoff:
+    with Range/If-Range when the server advertises Accept-Ranges, otherwise as a full request
+    whose already received prefix is skipped. offset counts decoded bytes, so a compressed body
+    (Content-Encoding) is always restarted in full; ranges ask for the unencoded file.
+    """
+    retries = DOWNLOAD_RETRIES if retries is None else retries
+    validator = range_validator(response)
+    supports_ranges = (response.status_code == 206 or response.headers.get("Accept-Ranges", "").lower() == "bytes") \
+        and not is_encoded(response)
+    skip = 0
+    attempt = 0
+    try:
+        while True:
+            try:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if skip:
+                        # A restarted full body: drop the bytes we already have
+                        dropped = min(skip, len(chunk))
+                        chunk = chunk[dropped:]
+                        skip -= dropped
+                    if chunk:
+                        offset += len(chunk)
+                        yield chunk
+                return
+            except RETRYABLE_ERRORS as e:
+                error = e
+
+            while True:
+                response.close()
+                if attempt >= retries:
+                    raise error
+                delay = RETRY_BACKOFF * 2 ** attempt
+                attempt += 1
+                print(f"[WARNING] Transfer of {url} interrupted at {offset} bytes, "
+                      f"retry {attempt}/{retries} in {delay:g}s")
+                EVENTS.emit("retry", url=redact_url(url), offset=offset, attempt=attempt, error=type(error).__name__)
+                time.sleep(delay)
+
+                headers = {}
+                if supports_ranges:
+                    headers["Range"] = f"bytes={offset}-"
+                    headers["Accept-Encoding"] = "identity"
+                    if validator:
+                        headers["If-Range"] = validator
+                try:
+                    response = session.get(url, stream=True, headers=headers)
+                except RETRYABLE_ERRORS as e:
+                    error = e
+                    continue
+                if response.status_code == 429 or response.status_code >= 500:
+                    error = requests.exceptions.HTTPError(f"{response.status_code} from {url}", response=response)
+                    continue
+                response.raise_for_status()
+                break
+
+            if response.status_code == 206:
+                # A compressed range would be spliced onto decoded bytes
+                if is_encoded(response) or content_range_start(response) != offset:
+                    raise ValueError(f"Server resumed {url} at the wrong offset")
+            elif validator and range_validator(response) != validator:
+                raise ValueError(f"{url} changed on the server during the transfer")
+            else:
+                skip = offset
+    finally:
+        response.close()
+
+def save_stream(session, url, response, file_path, archive=None, resume=False):
+    """
+    Writes a streamed response body to file_path, or into the archive entry for file_path.
+    On disk the body goes to a .part file that is renamed once complete; a checkpoint next to it
+    lets a later --sync run resume it with a Range request. resume=True appends response
+    (a 206) to the existing .part file. The read size follows the Content-Length, which is
+    also preallocated for a new .part file.
+    Returns the byte count and SHA-256 of the whole file.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    part_path = file_path + PARTIAL_SUFFIX
+    if resume:
+        with open(part_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+                size += len(block)
+        if is_encoded(response) or content_range_start(response) != size:
+            raise ValueError(f"Server resumed {url} at the wrong offset")
+    length = response_length(response)
+    body = iter_resumable(session, url, response, size, chunk_size=transfer_chunk_size(length))
+    offset = size
+    start = time.monotonic()
+
+    def chunks():
+        nonlocal size
+        for chunk in body:
+            digest.update(chunk)
+            size += len(chunk)
+            yield chunk
+
+    if archive:
+        archive.write_stream(file_path, chunks(), length, response.headers.get("Content-Type"))
+        EVENTS.emit("transfer", url=redact_url(url), path=file_path, bytes=size - offset, size=size,
+                    seconds=round(time.monotonic() - start, 4), resumed=resume)
+        return size, digest.hexdigest()
+
+    preallocated = False
+    with open(part_path, "ab" if resume else "wb") as f:
+        if not resume and length:
+            # Flagged first, in case the run is killed while the file is longer than what arrived
+            write_checkpoint(part_path, url, response, preallocated=True)
+            preallocated = preallocate(f, length)
+        if not preallocated:
+            write_checkpoint(part_path, url, response)
+        try:
+            for chunk in chunks():
+                f.write(chunk)
+        finally:
+            if preallocated:
+                # Cut the reserved tail back to what arrived (all of it, unless the transfer failed)
+                f.flush()
+                f.truncate(size)
+                write_checkpoint(part_path, url, response)
+    os.replace(part_path, file_path)
+    if os.path.exists(part_path + ".json"):
+        os.remove(part_path + ".json")
+    EVENTS.emit("transfer", url=redact_url(url), path=file_path, bytes=size - offset, size=size,
+                seconds=round(time.monotonic() - start, 4), resumed=resume)
+    return size, digest.hexdigest()
+
+def request_file(session, url, manifest=None, method="GET"):
+    """
+    Sends the first GET (or, for a --dry-run, HEAD) for url. With a manifest this either resumes
+    an interrupted .part file or revalidates a complete one (see SyncManifest.request_headers).
+    Returns the streamed response and, when the server agreed to resume, the final file path.
+    """
+    part_path, headers = manifest.request_headers(url, consume=method != "HEAD") if manifest else (None, {})
+    response = session.request(method, url, stream=True, headers=headers)
+    if method == "HEAD" and response.status_code in (405, 501):
+        # No HEAD support, the body of the GET is simply never read
+        response.close()
+        response = session.get(url, stream=True, headers=headers)
+    if part_path and response.status_code == 206:
+        return response, part_path[:-len(PARTIAL_SUFFIX)]
+    if part_path and response.status_code == 200 and method != "HEAD":
+        # The file changed since the interruption, the old part is useless (many servers ignore
+        # Range on a HEAD, so a dry run's 200 proves nothing and must not touch the files)
+        for stale in (part_path, part_path + ".json"):
+            if os.path.exists(stale):
+                os.remove(stale)
+    return response, None
+
+def save_unique(session, url, response, file_path, manifest=None, archive=None, store=None, resume=False):
+    """
+    Saves the body of response (requested as url) at file_path and records it in the manifest.
+    With a ContentStore, a body identical to one saved earlier in the run is replaced by a hardlink.
+    Returns "downloaded" or "linked".
+    """
+    size, sha256 = save_stream(session, url, response, file_path, archive, resume)
+    if manifest:
+        manifest.record(url, file_path, response, size, sha256)
+    # Archive entries are already written by now, so the ZIP only deduplicates by URL
+    original = store.add(file_path, size, sha256) if store and not archive else None
+    if original:
+        link_duplicate(original, file_path)
+        return "linked"
+    return "downloaded"
+
+class Transfer:
+    """A requested file whose response is open and whose body still has to be saved."""
+
+    def __init__(self, label, url, response, file_path, resume=False, claimed_url=None):
+        self.label = label
+        self.url = url
+        self.response = response
+        self.file_path = file_path
+        self.resume = resume
+        self.claimed_url = claimed_url  # URL this transfer owns in the ContentStore
+        self.course_path = None
+
+def complete_transfer(session, transfer, manifest=None, archive=None, store=None, budget=None):
+    """
+    Saves the body of a Transfer and closes its response. Returns True if the file was stored.
+    With a DiskBudget, the file's Content-Length is reserved before anything is written.
+    """
+    saved_path = None
+    try:
+        with transfer.response:
+            if budget:
+                budget.reserve(response_length(transfer.response), transfer.label)
+            status = save_unique(session, transfer.url, transfer.response, transfer.file_path,
+                                 manifest, archive, store, transfer.resume)
+        saved_path = transfer.file_path
+        if transfer.resume:
+            print("[SUCCESS] Resumed", transfer.label)
+            status = "resumed"
+        elif status == "linked":
+            print(f"[SUCCESS] Linked {transfer.label} (identical content already downloaded)")
+        else:
+            print("[SUCCESS] Downloaded", transfer.label)
+        EVENTS.emit("file", result=status, url=redact_url(transfer.url), path=transfer.file_path)
+        return True
     except Exception as e:
-        print(f"[ERROR] Failed to scrape {php_url}: {str(e)}")
-        return []
+        print(f"[ERROR] Failed to download {transfer.label}: {str(e)}")
+        EVENTS.emit("file", result="failed", url=redact_url(transfer.url), error=str(e))
+        return False
+    finally:
+        if transfer.claimed_url:
+            store.release(transfer.claimed_url, saved_path)
+
+def open_resource(session, file_name, file_url, course_path, manifest=None, archive=None, store=None,
+                  file_filter=None, method="GET"):
+    """
+    Requests one mod/resource link and classifies it by the headers of that same response.
+    Yields a Transfer for every file whose body still has to be saved, and "unchanged", "linked"
+    or "excluded" for files that need no transfer (a --sync 304, a URL already fetched in this
+    run, or a file the FileFilter rules out by its headers or, for embedded files, by its URL).
+    A page is parsed right away and its embedded files are requested one after another.
+    With method="HEAD" (--dry-run) files are only requested for their headers.
+    """
+    response, resume_path = request_file(session, file_url, manifest, method)
+    try:
+        if response.status_code == 304:
+            print(f"[INFO] {file_name} is unchanged, skipping")
+            yield "unchanged"
+            return
+        response.raise_for_status()
+        if resume_path:
+            # An interrupted transfer of an earlier run picks up where it stopped
+            transfer, response = Transfer(os.path.basename(resume_path), file_url, response, resume_path, True), None
+            yield transfer
+            return
+
+        # Check if the link is a file or a page (redirects resolve to the pluginfile URL)
+        if is_file_response(response):
+            # Extract file extension from the URL or Content-Disposition header
+            file_extension = get_file_extension(response, response.url)
+            file_name_with_extension = f"{file_name}{file_extension}"
+            file_path = os.path.join(course_path, sanitize_filename(file_name_with_extension))
+            reason = file_filter.check_response(file_name, response, file_extension.lower()) if file_filter else None
+            if reason:
+                report_excluded(file_name_with_extension, file_url, reason)
+                yield "excluded"
+                return
+
+            # Several modules may point at the same pluginfile URL
+            owner, original = store.claim(response.url, wait=False) if store else (False, None)
+            if owner is None:
+                # Another download has the file. Its connection may need our slot to retry a dropped
+                # transfer, so the response is closed before waiting for it
+                response.close()
+                owner, original = store.claim(response.url)
+                if not original:
+                    response = session.request(method, response.url, stream=True)
+                    response.raise_for_status()
+            if original:
+                link_duplicate(original, file_path, archive)
+                if manifest:
+                    manifest.record_link(file_url, file_path, original)
+                print(f"[SUCCESS] Linked {file_name_with_extension} (same file as {os.path.basename(original)})")
+                yield "linked"
+                return
+            transfer = Transfer(file_name_with_extension, file_url, response, file_path,
+                                claimed_url=response.url if owner else None)
+            response = None
+            yield transfer
+            return
+
+        print(f"[INFO] {file_name} is not a direct file link.")
+        print(f"[INFO] Attempting to scrape embedded files from {file_url}")
+        if method == "HEAD":
+            response.close()
+            response = session.get(response.url, stream=True)
+            response.raise_for_status()
+        # Treat the body we already have as a page and scrape it for embedded files
+        embedded_files = extract_embedded_files(response)
+    finally:
+        if response is not None:
+            response.close()
+
+    if not embedded_files:
+        print(f"[WARNING] No embedded files found in {file_url}")
+        return
+
+    # Request each embedded file
+    for embedded_url in embedded_files:
+        # Extract the filename from the URL
+        embedded_filename = os.path.basename(urlparse(embedded_url).path)
+        embedded_name = sanitize_filename(file_name + "_" + embedded_filename)
+        file_path = os.path.join(course_path, embedded_name)
+        if file_filter:
+            extension = url_extension(embedded_url)
+            reason = file_filter.check(file_name, extension or None, file_class(extension))
+            if reason:
+                report_excluded(embedded_name, embedded_url, reason)
+                yield "excluded"
+                continue
+
+        owner, original = store.claim(embedded_url) if store else (False, None)
+        if original:
+            link_duplicate(original, file_path, archive)
+            if manifest:
+                manifest.record_link(embedded_url, file_path, original)
+            print(f"[SUCCESS] Linked {embedded_name} (already downloaded in this run)")
+            yield "linked"
+            continue
+        try:
+            embedded_response, resume_path = request_file(session, embedded_url, manifest, method)
+            if embedded_response.status_code == 304:
+                embedded_response.close()
+                if owner:
+                    store.release(embedded_url, os.path.join(manifest.root, manifest.filename(embedded_url)))
+                print(f"[INFO] {embedded_name} is unchanged, skipping")
+                yield "unchanged"
+                continue
+            if not embedded_response.ok:
+                embedded_response.close()
+                embedded_response.raise_for_status()
+            reason = None
+            if file_filter and not resume_path:
+                extension = get_file_extension(embedded_response, embedded_url).lower()
+                reason = file_filter.check_response(file_name, embedded_response, extension)
+            if reason:
+                embedded_response.close()
+                if owner:
+                    store.release(embedded_url, None)
+                report_excluded(embedded_name, embedded_url, reason)
+                yield "excluded"
+                continue
+        except Exception:
+            if owner:
+                store.release(embedded_url, None)
+            raise
+        yield Transfer(embedded_name, embedded_url, embedded_response, resume_path or file_path,
+                       resume=bool(resume_path), claimed_url=embedded_url if owner else None)
+
+def finish_course(course_name, course_path, download_count, excluded=0):
+    """
+    Reports the per-course download count and removes the course directory if nothing was saved.
+    Returns whether the course is done: it produced files, or the filters excluded all it has.
+    """
+    print(f"[INFO] Downloaded {download_count} files for {course_name}"
+          + (f" ({excluded} excluded by the filters)" if excluded else ""))
+    EVENTS.emit("course", course=course_name, files=download_count, excluded=excluded)
+    if download_count == 0:
+        # Interrupted transfers keep their .part files for --sync to resume, and the directory with them
+        if os.path.isdir(course_path) and not os.listdir(course_path):
+            os.rmdir(course_path)
+        return excluded > 0
+    return True
+
+class RateLimiter:
+    """Token bucket: lets rate requests per second through on average, in bursts of up to burst."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waited = 0.0
+        self._lock = Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+                self.waited += delay
+            time.sleep(delay)
+
+class ConcurrencyController:
+    """
+    AIMD limit on the requests in flight to one host. The limit grows by one after a window of
+    limit healthy responses (latency within latency_factor of the best seen so far) and halves
+    on throttling (429/503) or timeouts, at most once per cool-down, during which it does not grow.
+    """
+
+    def __init__(self, maximum, minimum=1, initial=2, latency_factor=2.0, cooldown=1.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = max(minimum, min(initial, maximum))
+        self.peak_limit = self.limit
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.active = 0
+        self.throttled = 0
+        self.latency = None  # Smoothed time to response headers
+        self.best_latency = None
+        self._healthy = 0
+        self._last_decrease = 0.0
+        self._cond = Condition()
+
+    def acquire(self):
+        """Blocks until fewer than limit requests are in flight."""
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def record(self, latency=None, throttled=False):
+        """Feeds back one response: its latency in seconds, or that the server pushed back."""
+        with self._cond:
+            if throttled:
+                self.throttled += 1
+                self._healthy = 0
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit // 2)
+                    self._last_decrease = now
+                return
+            if latency is None:
+                return
+            if time.monotonic() - self._last_decrease < self.cooldown:
+                # Requests sent before the cut say nothing about the new limit
+                return
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self.best_latency = min(self.best_latency or self.latency, self.latency)
+            if self.latency > self.latency_factor * self.best_latency:
+                # Queueing on the server: hold the limit
+                self._healthy = 0
+                return
+            self._healthy += 1
+            if self._healthy >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.peak_limit = max(self.peak_limit, self.limit)
+                self._healthy = 0
+                self._cond.notify_all()
+
+class FeedbackRetry(Retry):
+    """
+    Retry that reports every 429/503 answer to the ConcurrencyController of the request being
+    sent as soon as it arrives, not once the Retry-After sleeps of the attempts after it are over.
+    """
+    sending = local()  # .controller of the request this thread is sending, .reported once told
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        controller = getattr(self.sending, "controller", None)
+        if controller and response is not None and response.status in (429, 503):
+            controller.record(throttled=True)
+            self.sending.reported = True
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+class TransportAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport for the whole session: a keep-alive pool of pool_size connections per host
+    (a request that finds them all busy waits until a response is closed), default connect/read
+    timeouts, and retries with exponential backoff on RETRY_STATUSES that honour Retry-After.
+    With rate, requests to a host pass a RateLimiter; with adaptive, a ConcurrencyController
+    per host decides how many of the pool's connections may be in use at once.
+    Counts how the pool was used, see stats().
+    """
+
+    def __init__(self, pool_size, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, rate=None, adaptive=True):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.rate = rate
+        self.adaptive = adaptive
+        self._lock = Lock()
+        self._limiters = {}
+        self._controllers = {}
+        self.requests = 0
+        self.retried = 0
+        self.timeouts = 0
+        self.peak_busy = 0
+        # Status retries only apply to idempotent methods, so a login POST is never repeated
+        retry = FeedbackRetry(total=retries, connect=retries, read=retries, status=retries, other=0,
+                      backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUSES,
+                      respect_retry_after_header=True, raise_on_status=False)
+        super().__init__(pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+
+    def _host_controls(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if self.rate and host not in self._limiters:
+                self._limiters[host] = RateLimiter(self.rate)
+            if self.adaptive and host not in self._controllers:
+                self._controllers[host] = ConcurrencyController(self.pool_size)
+            return self._limiters.get(host), self._controllers.get(host)
+
+    def send(self, request, stream=False, timeout=None, **kwargs):
+        limiter, controller = self._host_controls(request.url)
+        if controller:
+            controller.acquire()
+        if limiter:
+            limiter.acquire()
+        self._sample_busy()
+        with self._lock:
+            self.requests += 1
+        start = time.monotonic()
+        FeedbackRetry.sending.controller = controller
+        FeedbackRetry.sending.reported = False
+        try:
+            response = super().send(request, stream=stream, timeout=timeout or self.timeout, **kwargs)
+        except requests.exceptions.ConnectionError as e:
+            # Timeouts that used up the retries arrive as a ConnectionError wrapping MaxRetryError
+            reason = getattr(e.args[0] if e.args else None, "reason", None)
+            timed_out = isinstance(e, requests.exceptions.Timeout) or isinstance(reason, PoolTimeoutError)
+            if timed_out:
+                with self._lock:
+                    self.timeouts += 1
+            if controller:
+                controller.record(throttled=timed_out)
+                controller.release()
+            EVENTS.emit("request", method=request.method, url=redact_url(request.url), status=None,
+                        error="timeout" if timed_out else type(e).__name__)
+            raise
+        except Exception as e:
+            if controller:
+                controller.release()
+            EVENTS.emit("request", method=request.method, url=redact_url(request.url), status=None,
+                        error=type(e).__name__)
+            raise
+
+        ttfb = time.monotonic() - start
+        history = getattr(getattr(response.raw, "retries", None), "history", ())
+        EVENTS.emit("request", method=request.method, url=redact_url(request.url), status=response.status_code,
+                    ttfb=round(ttfb, 4), retries=len(history))
+        with self._lock:
+            self.retried += len(history)
+        if controller:
+            # Throttling the retries already reported arrived with FeedbackRetry
+            throttled = not FeedbackRetry.sending.reported and (
+                response.status_code in (429, 503) or any(attempt.status in (429, 503) for attempt in history))
+            pushed_back = throttled or any(isinstance(attempt.error, PoolTimeoutError) for attempt in history)
+            controller.record(None if history else ttfb, throttled=pushed_back)
+            self._release_with_connection(response, controller)
+        return response
+
+    def _release_with_connection(self, response, controller):
+        # The request stays in flight until its connection goes back to the pool: at once for
+        # a read body, when the response is closed for a streamed one
+        raw = response.raw
+        release_conn = raw.release_conn
+        once = Lock()
+
+        def release():
+            release_conn()
+            if once.acquire(blocking=False):
+                controller.release()
+
+        raw.release_conn = release
+        if raw.isclosed() or getattr(raw, "_connection", None) is None:
+            release()
+
+    def _pools(self):
+        pools = self.poolmanager.pools
+        return [pool for pool in (pools.get(key) for key in list(pools.keys())) if pool is not None]
+
+    def _busy(self, total=False):
+        # Connections checked out of a host's pool: held by a request or an unread response
+        busy = [pool.pool.maxsize - pool.pool.qsize() for pool in self._pools() if pool.pool]
+        return sum(busy) if total else max(busy, default=0)
+
+    def _sample_busy(self):
+        busy = self._busy()
+        with self._lock:
+            self.peak_busy = max(self.peak_busy, busy)
+
+    def stats(self):
+        """
+        Returns the pool's counters so far: requests sent, connections opened, peak connections
+        in use, retried attempts, timeouts, and connections still held by unreleased responses.
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "connections": sum(pool.num_connections for pool in self._pools()),
+                "pool_size": self._pool_maxsize,
+                "peak_busy": self.peak_busy,
+                "retried": self.retried,
+                "timeouts": self.timeouts,
+                "unreleased": self._busy(total=True),
+                "limit": max((c.limit for c in self._controllers.values()), default=self.pool_size),
+                "peak_limit": max((c.peak_limit for c in self._controllers.values()), default=self.pool_size),
+                "throttled": sum(c.throttled for c in self._controllers.values()),
+                "rate_wait": sum(l.waited for l in self._limiters.values()),
+            }
+
+def format_pool_stats(stats):
+    """One-line summary of TransportAdapter.stats()."""
+    attempts = stats["requests"] + stats["retried"]
+    reused = max(0, 1 - stats["connections"] / attempts) if attempts else 0
+    return (f"{stats['requests']} requests over {stats['connections']} connections ({reused:.0%} reused), "
+            f"peak {stats['peak_busy']}/{stats['pool_size']} busy per host, {stats['retried']} retried, "
+            f"{stats['timeouts']} timed out, {stats['unreleased']} unreleased; "
+            f"concurrency {stats['limit']} (peak {stats['peak_limit']}), {stats['throttled']} throttled, "
+            f"{stats['rate_wait']:.1f}s waited for the rate limit")
+
+def configure_transport(session, pool_size, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, rate=None, adaptive=True):
+    """Mounts a fresh TransportAdapter on session for http and https and returns it."""
+    adapter = TransportAdapter(pool_size, timeout, retries, rate, adaptive)
+    for prefix in ("https://", "http://"):
+        old = session.adapters.get(prefix)
+        session.mount(prefix, adapter)
+        if old is not None and old is not adapter and old not in session.adapters.values():
+            old.close()
+    return adapter
+
+class PipelineStage:
+    """
+    One stage of the download pipeline: worker threads consuming a bounded queue.
+    A full queue blocks the stage feeding it, so fast stages cannot run far ahead of slow ones.
+    Keeps queue depth and throughput counters for the progress report.
+    """
+
+    def __init__(self, name, handler, workers, maxsize):
+        self.name = name
+        self.handler = handler
+        self.queue = queue.Queue(maxsize)
+        self.threads = [Thread(target=self._run, daemon=True) for _ in range(workers)]
+        self._lock = Lock()
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item):
+        self.queue.put(item)
+        with self._lock:
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self.handler(item)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                print(f"[ERROR] {self.name} stage failed: {str(e)}")
+            with self._lock:
+                self.processed += 1
+
+    def close(self):
+        """Waits until everything queued so far is processed and stops the workers."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.finished = time.perf_counter()
+
+    def stats(self):
+        """Returns the stage counters: items processed and failed, current and peak queue depth, items/s."""
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        with self._lock:
+            return {
+                "stage": self.name,
+                "processed": self.processed,
+                "failed": self.failed,
+                "queued": self.queue.qsize(),
+                "max_depth": self.max_depth,
+                "per_second": self.processed / elapsed if elapsed > 0 else 0.0,
+            }
+
+def format_stage_stats(stages):
+    return " | ".join(
+        f"{s['stage']}: {s['processed']} done, {s['queued']} queued (peak {s['max_depth']}), {s['per_second']:.1f}/s"
+        for s in (stage.stats() for stage in stages)
+    )
+
+def download_courses(session, course_links, output_dir, max_workers=8, per_host_limit=4,
+                     manifest=None, archive=None, dedup=True, report_interval=15, api=None,
+                     timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, rate=None, adaptive=True, budget=None,
+                     file_filter=None, estimate=None):
+    """Downloads course_links through the staged pipeline; returns how many courses produced files."""
+    transport = configure_transport(session, min(per_host_limit, max_workers), timeout, retries, rate, adaptive)
+    discovered = discover_courses(api, course_links, bool(file_filter and file_filter.sections)) if api else {}
+    if budget and discovered:
+        selected = sum(details.get("size") or 0 for _, resources in discovered.values()
+                       for file_name, _, details in resources
+                       if not (file_filter and file_filter.check(file_name, **details)))
+        if selected:
+            budget.check(selected, f"{len(discovered)} courses")
+    store = ContentStore() if dedup and estimate is None else None
+    method = "GET" if estimate is None else "HEAD"
+    courses = {}
+    lock = Lock()
+    # An open Transfer holds a connection until a download worker has read it, and a worker whose
+    # transfer dropped needs a connection to resume it: open at most one Transfer per download worker
+    transfer_slots = Semaphore(max_workers)
+
+    def count_file(course_path, excluded=False):
+        with lock:
+            courses[course_path][2 if excluded else 1] += 1
+
+    def handle_page(course_url):
+        print(f"\n[INFO] Processing course: {course_url}")
+        try:
+            if course_url in discovered:
+                course_name, resources = discovered[course_url]
+            else:
+                course_name, resources = parse_course_page(session, course_url)
+        except Exception as e:
+            print(f"[ERROR] Course processing failed: {str(e)}")
+            return
+        if not course_name:
+            return
+
+        # Create course directory (archive entries and estimates need none)
+        course_path = os.path.join(output_dir, sanitize_filename(course_name))
+        if not archive and estimate is None:
+            os.makedirs(course_path, exist_ok=True)
+        with lock:
+            courses.setdefault(course_path, [course_name, 0, 0])
+        if estimate is not None:
+            estimate.add_course(course_path, course_name)
+        for file_name, file_url, details in resources:
+            reason = file_filter.check(file_name, **details) if file_filter else None
+            if reason:
+                report_excluded(file_name, file_url, reason)
+                count_file(course_path, excluded=True)
+                if estimate is not None:
+                    estimate.add(course_path, "excluded")
+            elif estimate is not None and details.get("size") is not None and not manifest:
+                # The listing already gives the size, the estimate needs no request
+                estimate.add(course_path, "downloaded", details["size"], file_url)
+                count_file(course_path)
+            else:
+                resource_stage.put((file_name, file_url, course_path))
+
+    def handle_resource(job):
+        file_name, file_url, course_path = job
+        try:
+            print(f"[downloading] {file_name} from {file_url}")
+            items = open_resource(session, file_name, file_url, course_path, manifest, archive, store,
+                                  file_filter, method)
+            while True:
+                # Each step sends at most one request that can turn into a Transfer
+                transfer_slots.acquire()
+                item = None
+                try:
+                    item = next(items, None)
+                finally:
+                    if not isinstance(item, Transfer):
+                        transfer_slots.release()
+                if item is None:
+                    break
+                if estimate is not None:
+                    if isinstance(item, Transfer):
+                        item.response.close()
+                        transfer_slots.release()
+                        item = ("downloaded", response_length(item.response), item.response.url)
+                    else:
+                        item = (item,)
+                    estimate.add(course_path, *item)
+                    count_file(course_path, excluded=item[0] == "excluded")
+                elif isinstance(item, Transfer):
+                    item.course_path = course_path
+                    download_stage.put(item)
+                elif item == "excluded":
+                    count_file(course_path, excluded=True)
+                else:
+                    EVENTS.emit("file", result=item, url=redact_url(file_url))
+                    count_file(course_path)
+        except Exception as e:
+            print(f"[ERROR] Failed to download {file_name}: {str(e)}")
+
+    def handle_download(transfer):
+        try:
+            if complete_transfer(session, transfer, manifest, archive, store, budget):
+                count_file(transfer.course_path)
+        finally:
+            transfer_slots.release()
+
+    page_stage = PipelineStage("pages", handle_page, min(4, max(1, len(course_links))), 0)
+    resource_stage = PipelineStage("resources", handle_resource, max_workers, 4 * max_workers)
+    download_stage = PipelineStage("downloads", handle_download, max_workers, max_workers)
+    stages = (page_stage, resource_stage, download_stage)
+    for stage in stages:
+        stage.start()
+
+    # Periodic progress line while the pipeline runs
+    done = Event()
+
+    def report():
+        while not done.wait(report_interval):
+            print(f"[PIPELINE] {format_stage_stats(stages)}")
+    Thread(target=report, daemon=True).start()
+
+    for course_url in course_links:
+        page_stage.put(course_url)
+    # Each stage is drained only after everything feeding it has finished
+    for stage in stages:
+        stage.close()
+    done.set()
+    print(f"[PIPELINE] {format_stage_stats(stages)}")
+    print(f"[POOL] {format_pool_stats(transport.stats())}")
+
+    if estimate is not None:
+        return sum(1 for _, download_count, _ in courses.values() if download_count)
+    completed = 0
+    for course_path, (course_name, download_count, excluded) in courses.items():
+        try:
+            if finish_course(course_name, course_path, download_count, excluded):
+                completed += 1
+        except Exception as e:
+            print(f"[ERROR] Course processing failed: {str(e)}")
+    if store and store.linked_bytes:
+        print(f"[INFO] Deduplication saved {store.linked_bytes / (1024 * 1024):.1f} MB of duplicate files")
+    return completed
+
+def extract_embedded_files(response):
+    """Returns the absolute .../mod_resource/content/ URLs embedded in an already fetched page."""
+    start = time.monotonic()
+
+    # Find all embedded files with the structure .../mod_resource/content/
+    images, links = [], []
+    for element in iter_html(response):
+        if element.tag == "img" and "mod_resource/content" in (element.get("src") or ""):
+            images.append(element.get("src"))
+        elif element.tag == "a" and "mod_resource/content" in (element.get("href") or ""):
+            links.append(element.get("href"))
+    embedded_files = images + links
+    EVENTS.emit("page", kind="resource", url=redact_url(response.url), links=len(embedded_files),
+                seconds=round(time.monotonic() - start, 4))
+
+    # Ensure URLs are absolute
+    return [urljoin(response.url, url) for url in embedded_files]
+
+# Resource classification runs for every link, so its patterns are compiled once
+HEADER_PARAM_PATTERN = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+QUOTED_PAIR_PATTERN = re.compile(r'\\(.)')
+INVALID_FILENAME_CHARS = re.compile(r'[<>:"/\\|?*]')
+
+def parse_header_value(value):
+    """
+    Splits a Content-Type or Content-Disposition header into its lower-case main value
+    (media type or disposition) and a dict of its parameters, with quoted values unquoted.
+    """
+    main, _, params = (value or "").partition(";")
+    parsed = {}
+    for name, param in HEADER_PARAM_PATTERN.findall(";" + params):
+        param = param.strip()
+        if param.startswith('"'):
+            param = QUOTED_PAIR_PATTERN.sub(r"\1", param[1:-1])
+        parsed[name.lower()] = param
+    return main.strip().lower(), parsed
+
+def media_type_of(content_type):
+    """Returns the lower-case media type of a Content-Type header ("text/html; charset=utf-8" -> "text/html")."""
+    return (content_type or "").partition(";")[0].strip().lower()
+
+def url_extension(url):
+    """Returns the lower-case extension of a URL's path, ignoring the query ("" if it has none)."""
+    path = url.partition("?")[0].partition("#")[0]
+    if "://" in path and path.count("/") < 3:
+        # No path after the host ("https://example.org" has no extension)
+        return ""
+    return os.path.splitext(path)[1].lower()
+
+def is_file_response(response):
+    """
+    Tells a downloadable file from an HTML page by its media type, or failing that its
+    Content-Disposition or URL: anything but an HTML page sent as an attachment is a file.
+    """
+    media_type = media_type_of(response.headers.get("Content-Type"))
+    if media_type == "text/html":
+        return False
+    if media_type in FILE_MIME_TYPES or media_type.startswith(FILE_MIME_VARIANTS):
+        return True
+    if media_type.partition("/")[0] in FILE_MAIN_TYPES:
+        return True
+    content_disposition = response.headers.get("Content-Disposition")
+    if parse_header_value(content_disposition)[0] == "attachment":
+        return True
+    filename = content_disposition_filename(content_disposition) or ""
+    return url_extension(response.url) in FILE_EXTENSIONS or os.path.splitext(filename)[1].lower() in FILE_EXTENSIONS
+
+def content_disposition_filename(content_disposition):
+    """
+    Returns the file name from a Content-Disposition header, or None.
+    The RFC 5987 form (filename*=UTF-8''na%C3%AFve.pdf) is preferred over plain filename=.
+    """
+    _, params = parse_header_value(content_disposition)
+    extended = params.get("filename*")
+    if extended and extended.count("'") >= 2:
+        charset, _, encoded = extended.split("'", 2)
+        try:
+            return unquote(encoded, encoding=charset or "utf-8", errors="replace")
+        except LookupError:
+            # Unknown charset
+            return unquote(encoded, errors="replace")
+    filename = params.get("filename")
+    return unquote(filename) if filename else None  # Decode URL-encoded filenames
 
 def get_file_extension(response, file_url):
     """
-    Extracts the file extension from the URL or Content-Disposition header.
+    Extracts the file extension from the Content-Disposition header, the URL or the media type.
     Returns the extension (e.g., ".pdf") or a default extension if not found.
     """
     # Try to get the extension from the Content-Disposition header
-    content_disposition = response.headers.get("Content-Disposition", "")
-    if content_disposition:
-        # Extract filename from Content-Disposition header
-        filename_match = re.findall('filename="([^"]+)"', content_disposition)
-        if filename_match:
-            filename = unquote(filename_match[0])  # Decode URL-encoded filenames
-            _, extension = os.path.splitext(filename)
-            if extension:
-                return extension
-    
-    # Try to get the extension from the URL
-    parsed_url = urlparse(file_url)
-    _, extension = os.path.splitext(parsed_url.path)
+    filename = content_disposition_filename(response.headers.get("Content-Disposition"))
+    if filename:
+        _, extension = os.path.splitext(filename)
+        if extension:
+            return extension
+
+    # Then from the URL, if it names a known file type (not e.g. view.php)
+    extension = url_extension(file_url)
+    if extension in FILE_EXTENSIONS:
+        return extension
+
+    # Then from the media type
+    media_type = media_type_of(response.headers.get("Content-Type"))
+    if FILE_MIME_TYPES.get(media_type, ".bin") != ".bin":
+        return FILE_MIME_TYPES[media_type]
     if extension:
         return extension
-    
+
     # Fallback to a default extension if no extension is found
     return ".bin"
 
 def sanitize_filename(filename):
     """Cleans invalid characters from filenames."""
-    return re.sub(r'[<>:"/\\|?*]', '_', filename).strip()
+    return INVALID_FILENAME_CHARS.sub("_", filename).strip()
+
+def compression_for(name, content_type=None, compresslevel=6):
+    """
+    Picks the ZIP method for a member: STORED for already compressed formats,
+    DEFLATED at compresslevel for everything else (text, PDF, ...).
+    """
+    if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS or media_type_of(content_type) in STORED_MIME_TYPES:
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, compresslevel
 
-def create_zip(output_dir, zip_name):
-    """Creates a .zip file of the output directory."""
+def deflate_member(file_path, compresslevel, spool_limit=32 * 1024 * 1024):
+    """
+    Compresses one file into a raw deflate stream (as stored inside a ZIP).
+    zlib releases the GIL, so several members can be deflated on separate cores.
+    Returns the CRC-32, the original size and the spooled compressed data.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_limit)
+    crc = 0
+    size = 0
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            spool.write(compressor.compress(block))
+    spool.write(compressor.flush())
+    return crc, size, spool
+
+def write_precompressed(zipf, zinfo, crc, size, spool):
+    """Appends a member that deflate_member already compressed to an open ZipFile."""
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = spool.tell()
+    spool.seek(0)
+    write_raw_member(zipf, zinfo, spool)
+
+def write_raw_member(zipf, zinfo, source):
+    """
+    Appends zinfo to an open ZipFile with the next zinfo.compress_size bytes of source as its data.
+    Only with ZIPFILE_INTERNALS.
+    """
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    # zipfile has no public API for raw members, so this mirrors what ZipFile.write does internally
+    with zipf._lock:
+        zipf._writecheck(zinfo)
+        zipf._didModify = True
+        zipf.fp.seek(zipf.start_dir)
+        zinfo.header_offset = zipf.fp.tell()
+        zipf.fp.write(zinfo.FileHeader(zip64))
+        remaining = zinfo.compress_size
+        while remaining:
+            chunk = source.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise zipfile.BadZipFile(f"{zinfo.filename}: compressed data is truncated")
+            zipf.fp.write(chunk)
+            remaining -= len(chunk)
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+        zipf.start_dir = zipf.fp.tell()
+
+def copy_raw_member(zipf, source, raw, member, arcname=None):
+    """
+    Appends member of the ZipFile source, whose file is also open as raw, to zipf (as arcname),
+    copying its compressed data as is (or, without ZIPFILE_INTERNALS, its data recompressed).
+    """
+    zinfo = zipfile.ZipInfo(arcname or member.filename, member.date_time)
+    zinfo.compress_type = member.compress_type
+    zinfo.create_system = member.create_system
+    zinfo.external_attr = member.external_attr
+    if not ZIPFILE_INTERNALS:
+        with source.open(member) as data, \
+                zipf.open(zinfo, "w", force_zip64=member.file_size >= zipfile.ZIP64_LIMIT) as entry:
+            shutil.copyfileobj(data, entry, 1024 * 1024)
+        return
+    zinfo.CRC = member.CRC
+    zinfo.file_size = member.file_size
+    zinfo.compress_size = member.compress_size
+    # The data starts after the member's local header, whose name and extra field vary in length
+    raw.seek(member.header_offset)
+    header = raw.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    raw.seek(member.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+    write_raw_member(zipf, zinfo, raw)
+
+def merge_archives(zip_paths, zip_name, volume_size=None):
+    """
+    Combines the ZIP archives in zip_paths into zip_name (in volumes of volume_size if given),
+    copying every member's compressed data as is. A top-level folder that an earlier archive
+    already has is renamed <folder>_<n>, n being the archive's position.
+    Returns the number of members written and the paths of the archive.
+    """
+    owners = {}
+    count = 0
+    required = sum(os.path.getsize(zip_path) for zip_path in zip_paths)
+    zip_dir = existing_parent(os.path.dirname(os.path.abspath(zip_name)))
+    if required + DISK_HEADROOM > shutil.disk_usage(zip_dir).free:
+        raise DiskSpaceError(f"{zip_name} needs {required / (1024 * 1024):.1f} MB, "
+                             f"only {shutil.disk_usage(zip_dir).free / (1024 * 1024):.1f} MB free")
+    volumes = ZipVolumes(zip_name, volume_size)
     try:
-        # Check if the output directory is empty
-        if not os.listdir(output_dir):
-            print(f"[ERROR] Cannot create ZIP: Directory '{output_dir}' is empty.")
-            return False
-        with zipfile.ZipFile(zip_name, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(output_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, output_dir)
-                    zipf.write(file_path, arcname)
-        print(f"[SUCCESS] Created ZIP archive: {zip_name}")
-        return True
+        for index, zip_path in enumerate(zip_paths, 1):
+            renamed = {}
+            with zipfile.ZipFile(zip_path) as source, open(zip_path, "rb") as raw:
+                for member in source.infolist():
+                    top, separator, rest = member.filename.partition("/")
+                    if top not in renamed:
+                        renamed[top] = top if owners.setdefault(top, index) == index else f"{top}_{index}"
+                    arcname = renamed[top] + separator + rest
+                    copy_raw_member(volumes.for_member(arcname, member.compress_size), source, raw, member, arcname)
+                    count += 1
+    finally:
+        volumes.close()
+    EVENTS.emit("archive", path=zip_name, members=count, bytes=sum(os.path.getsize(path) for path in volumes.paths))
+    return count, volumes.paths
+
+def archive_members(output_dir, root=None):
+    """
+    Lists the files of output_dir to archive as (file_path, arcname, link_target) in directory
+    order, arcnames relative to root (output_dir by default). link_target is the arcname of an
+    earlier hardlink to the same file, whose data the member shares, or None.
+    """
+    members = []
+    inodes = {}
+    for folder, _, files in os.walk(output_dir):
+        for file in files:
+            if file == MANIFEST_NAME or file.endswith((PARTIAL_SUFFIX, CHECKPOINT_SUFFIX)):
+                continue
+            file_path = os.path.join(folder, file)
+            arcname = os.path.relpath(file_path, root or output_dir)
+            link_target = None
+            file_stat = os.stat(file_path)
+            if file_stat.st_nlink > 1:
+                link_target = inodes.setdefault((file_stat.st_dev, file_stat.st_ino), arcname)
+                if link_target == arcname:
+                    link_target = None
+            members.append((file_path, arcname, link_target))
+    return members
+
+def check_archive_space(members, archive_name):
+    """Raises DiskSpaceError unless the archive directory has room for the members stored uncompressed."""
+    required = sum(os.path.getsize(file_path) for file_path, _, link_target in members if not link_target)
+    archive_dir = existing_parent(os.path.dirname(os.path.abspath(archive_name)))
+    if required + DISK_HEADROOM > shutil.disk_usage(archive_dir).free:
+        raise DiskSpaceError(f"{archive_name} needs up to {required / (1024 * 1024):.1f} MB, "
+                             f"only {shutil.disk_usage(archive_dir).free / (1024 * 1024):.1f} MB free")
+
+def describe_archive(paths):
+    """Names the archive in paths for messages: its file, or its first and last volume."""
+    if len(paths) == 1:
+        return paths[0]
+    return f"{paths[0]} ... {os.path.basename(paths[-1])} ({len(paths)} volumes)"
+
+def create_zip(output_dir, zip_name, compresslevel=6, workers=None, volume_size=None, root=None, links=False):
+    """
+    Creates a .zip file of the output directory, split into volumes if volume_size is given.
+    Already compressed formats are stored, the rest is deflated in parallel on `workers`
+    threads (all cores by default, one without ZIPFILE_INTERNALS) and appended in directory order.
+    Hardlinked duplicates are stored as copies, or with links once, the other names becoming
+    link entries (see ZipVolumes).
+    Returns the paths of the archive, or [] if it could not be created.
+    """
+    try:
+        members = archive_members(output_dir, root)
+        # Interrupted transfers (.part files) and the sync manifest are not archived
+        if not members:
+            print(f"[ERROR] Cannot create ZIP: Directory '{output_dir}' has no downloaded files.")
+            return []
+        if not links:
+            members = [(file_path, arcname, None) for file_path, arcname, _ in members]
+        # Stored members take their full size, so that much must be free before the archive is started
+        check_archive_space(members, zip_name)
+
+        workers = workers or os.cpu_count() or 1
+        volumes = ZipVolumes(zip_name, volume_size, links)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # Deflate ahead of the writer, but only a bounded window of members at a time
+                pending = {}
+                window = 2 * workers
+                for index, (file_path, arcname, link_target) in enumerate(members):
+                    for ahead in range(index, min(index + window, len(members))):
+                        ahead_path, ahead_name, ahead_link = members[ahead]
+                        method, _ = compression_for(ahead_name, compresslevel=compresslevel)
+                        if ahead not in pending and not ahead_link and method == zipfile.ZIP_DEFLATED and \
+                                ZIPFILE_INTERNALS:
+                            pending[ahead] = pool.submit(deflate_member, ahead_path, compresslevel)
+
+                    if link_target:
+                        volumes.add_link(arcname, link_target)
+                    elif index in pending:
+                        crc, size, spool = pending.pop(index).result()
+                        with spool:
+                            write_precompressed(volumes.for_member(arcname, spool.tell()),
+                                                zipfile.ZipInfo.from_file(file_path, arcname), crc, size, spool)
+                    else:
+                        method, level = compression_for(arcname, compresslevel=compresslevel)
+                        volumes.for_member(arcname, os.path.getsize(file_path)).write(
+                            file_path, arcname, compress_type=method, compresslevel=level)
+        finally:
+            volumes.close()
+        print(f"[SUCCESS] Created ZIP archive: {describe_archive(volumes.paths)}")
+        EVENTS.emit("archive", path=zip_name, members=len(members),
+                    bytes=sum(os.path.getsize(path) for path in volumes.paths))
+        return volumes.paths
     except Exception as e:
         print(f"[ERROR] ZIP creation failed: {str(e)}")
-        return False
+        return []
+
+def create_tar(output_dir, tar_name, compresslevel=6, volume_size=None, root=None):
+    """
+    Creates a zstd-compressed tar of the output directory (--format tar.zst), cut into pieces
+    of volume_size if given. zstd compresses on all cores; hardlinked duplicates are stored once,
+    as tar hard links. Returns the paths of the archive, or [] if it could not be created.
+    """
+    try:
+        members = archive_members(output_dir, root)
+        if not members:
+            print(f"[ERROR] Cannot create archive: Directory '{output_dir}' has no downloaded files.")
+            return []
+        check_archive_space(members, tar_name)
+        tarf, output = open_tar_zst(tar_name, compresslevel, volume_size)
+        try:
+            for file_path, arcname, _ in members:
+                # tarfile itself turns later names of a hardlinked file into links to the first
+                tarf.add(file_path, arcname.replace(os.sep, "/"), recursive=False)
+        finally:
+            tarf.close()
+        print(f"[SUCCESS] Created archive: {describe_archive(output.paths)}")
+        EVENTS.emit("archive", path=tar_name, members=len(members),
+                    bytes=sum(os.path.getsize(path) for path in output.paths))
+        return output.paths
+    except Exception as e:
+        print(f"[ERROR] Archive creation failed: {str(e)}")
+        return []
+
+def course_signature(course_dir, options):
+    """Fingerprints the files of a course directory (names, sizes, modification times) and the archive options."""
+    digest = hashlib.sha256(json.dumps(options).encode("utf-8"))
+    for file_path, arcname, link_target in archive_members(course_dir):
+        file_stat = os.stat(file_path)
+        digest.update(f"{arcname}\0{file_stat.st_size}\0{file_stat.st_mtime_ns}\0{link_target}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+def create_course_archives(output_dir, archive_dir, archive_format="zip", compresslevel=6, volume_size=None,
+                           links=False):
+    """
+    Creates an archive per course directory of output_dir in archive_dir (--per-course).
+    A course whose files are the same as when its archive was made keeps that archive, so with
+    --sync only the courses that changed are archived again; ARCHIVE_STATE_NAME in archive_dir
+    remembers which files each archive was made from.
+    Returns the paths of all course archives, or [] if none could be created.
+    """
+    state_path = os.path.join(archive_dir, ARCHIVE_STATE_NAME)
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    os.makedirs(archive_dir, exist_ok=True)
+    paths = []
+    unchanged = courses = 0
+    for course in sorted(os.listdir(output_dir)):
+        course_dir = os.path.join(output_dir, course)
+        # A course left with nothing but interrupted transfers has nothing to archive yet
+        if not os.path.isdir(course_dir) or not archive_members(course_dir):
+            continue
+        courses += 1
+        signature = course_signature(course_dir, [archive_format, compresslevel, volume_size, links])
+        entry = state.get(course) or {}
+        if entry.get("signature") == signature and all(os.path.exists(path) for path in entry["paths"]):
+            paths.extend(entry["paths"])
+            unchanged += 1
+            continue
+        for path in entry.get("paths", []):
+            if os.path.exists(path):
+                os.remove(path)
+        course_archive = os.path.join(archive_dir, course + ARCHIVE_EXTENSIONS[archive_format])
+        created = create_archive(course_dir, course_archive, archive_format, compresslevel, volume_size,
+                                 root=output_dir, links=links)
+        if created:
+            state[course] = {"signature": signature, "paths": created}
+            paths.extend(created)
+        else:
+            state.pop(course, None)
+    try:
+        with open(state_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=1)
+        os.replace(state_path + ".tmp", state_path)
+    except Exception as e:
+        print(f"[ERROR] Failed to save {state_path}: {str(e)}")
+    if unchanged:
+        print(f"[INFO] {unchanged} course archive(s) unchanged, kept as they are")
+    if not courses:
+        print(f"[ERROR] Cannot create archives: Directory '{output_dir}' has no downloaded files.")
+    return paths
+
+def create_archive(output_dir, archive_name, archive_format="zip", compresslevel=6, volume_size=None,
+                   per_course=False, root=None, links=False):
+    """
+    Archives the output directory as --format, --volume-size, --per-course and --zip-links ask;
+    per-course archives go to a directory named after archive_name without its extension.
+    Returns the paths of the archive(s), or [] if nothing could be created.
+    """
+    if per_course:
+        return create_course_archives(output_dir, split_archive_name(archive_name)[0], archive_format,
+                                      compresslevel, volume_size, links)
+    if archive_format == "tar.zst":
+        return create_tar(output_dir, archive_name, compresslevel, volume_size, root)
+    return create_zip(output_dir, archive_name, compresslevel, volume_size=volume_size, root=root, links=links)
 
 def get_unique_output_dir(base_dir):
     """Returns a unique directory name by appending a number if the base directory already exists."""
@@ -421,13 +3062,24 @@ def get_unique_output_dir(base_dir):
         counter += 1
     return output_dir
 
+def split_archive_name(name):
+    """Splits an archive name into base and extension, keeping ".tar.zst" whole."""
+    if name.lower().endswith(ARCHIVE_EXTENSIONS["tar.zst"]):
+        return name[:-len(ARCHIVE_EXTENSIONS["tar.zst"])], name[-len(ARCHIVE_EXTENSIONS["tar.zst"]):]
+    return os.path.splitext(name)
+
+def archive_exists(name):
+    """Whether an archive called name is already there, whole, in volumes or as a --per-course directory."""
+    candidates = (name, volume_path(name, 1), volume_path(name, 1, "tar.zst"), split_archive_name(name)[0])
+    return any(os.path.exists(path) for path in candidates)
+
 def get_unique_filename(base_name):
     counter = 1
-    file_name, file_extension = os.path.splitext(base_name)  # Split name and extension
+    file_name, file_extension = split_archive_name(base_name)  # Split name and extension
     unique_name = base_name
 
     # Check if the file already exists
-    while os.path.exists(unique_name):
+    while archive_exists(unique_name):
         unique_name = f"{file_name}_{counter}{file_extension}"  # Append number before extension
         counter += 1
 
@@ -450,6 +3102,12 @@ def play_music(mp3_file):
             print(f"[ERROR] Music file '{mp3_path}' not found!")
             return
 
+        # Keep pygame from printing its banner on import
+        os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+        mixer = load_extra("pygame.mixer")
+        if not mixer:
+            return
+
         print(f"[INFO] Playing background music: {mp3_path}")
         mixer.init()
         mixer.music.load(mp3_path)
@@ -463,32 +3121,632 @@ def play_music(mp3_file):
 
 def goodbuy(session,user_name,image_url):
     if user_name and image_url:        
-        # Download and display the user's image
-        image_path = download_user_image(session, image_url)
+        # Download and display the user's image (skipped without the extras)
+        image_path = download_user_image(session, image_url) if load_extra("PIL.Image") and load_extra("numpy") else None
         if image_path:
             display_image_in_console(image_path)
             os.remove(image_path)  # Clean up the temporary image file 
         print(f"\nPaldies, ka izmantojāt manu programmu, {user_name}. Novēlu jums jauku dienu!")
         
 
+# Exit statuses of batch mode
+EXIT_OK = 0  # Every requested course produced files (or was already up to date)
+EXIT_PARTIAL = 1  # The archive was created, but some courses produced nothing
+EXIT_USAGE = 2  # Bad arguments, config file or missing credentials
+EXIT_LOGIN_FAILED = 3
+EXIT_NO_FILES = 4  # No courses found or nothing downloaded
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Moodle\\Estudijas Downloader")
+    parser.add_argument("--sync", action="store_true",
+                        help="keep the output directory between runs and only download files that changed")
+    parser.add_argument("--no-staging", action="store_true",
+                        help="stream downloads straight into the ZIP archive without writing them to disk first")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="keep a separate copy of files that several courses or pages share")
+    parser.add_argument("--zip-links", action="store_true",
+                        help="store shared files in a ZIP archive once, other copies as symbolic links; unzip and "
+                             "7-Zip restore them on Linux and macOS, Windows Explorer does not")
+    parser.add_argument("--discovery", choices=("html", "api"), default="html",
+                        help="find course files by scraping course pages (default) or through Moodle's "
+                             "web-service API, falling back to scraping where the API is disabled")
+    parser.add_argument("--compress-level", type=int, default=6, choices=range(0, 10), metavar="0-9",
+                        help="deflate level for compressible files, media and archives are always stored; "
+                             "the zstd level with --format tar.zst (default: 6)")
+    parser.add_argument("--format", dest="archive_format", choices=tuple(ARCHIVE_EXTENSIONS), default="zip",
+                        help="archive format: zip, or a tar compressed with zstd on all cores, which needs the "
+                             "zstandard package (default: %(default)s)")
+    parser.add_argument("--volume-size", type=size_argument, metavar="SIZE",
+                        help='split the archive into volumes of at most SIZE, e.g. "2G"; ZIP volumes open on their '
+                             "own, tar.zst volumes are joined with cat before extracting")
+    parser.add_argument("--per-course", action="store_true",
+                        help="write an archive per course into a directory named after --zip-name; with --sync "
+                             "only the courses that changed are archived again")
+
+    parser.add_argument("--workers", type=int, default=8,
+                        help="simultaneous resource requests and transfers for the whole run (default: %(default)s)")
+    parser.add_argument("--per-host", type=int, default=8,
+                        help="most connections to one host, at most --workers; how many are used adapts to the "
+                             "server's latency and throttling (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=10,
+                        help="most requests per second to one host, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--fixed-concurrency", action="store_true",
+                        help="always use --per-host connections instead of adapting to the server")
+    parser.add_argument("--timeout", type=float, default=HTTP_TIMEOUT[1],
+                        help="seconds to wait for a server to send data before retrying (default: %(default)s)")
+    parser.add_argument("--retries", type=int, default=HTTP_RETRIES,
+                        help="retries of a request answered with 429 or 5xx, with backoff and Retry-After "
+                             "(default: %(default)s)")
+    parser.add_argument("--events", metavar="FILE",
+                        help="append a JSON line per request, transfer, page and phase of the run to FILE")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write the run's metrics to FILE in the Prometheus text format")
+    parser.add_argument("--session-cache", metavar="FILE",
+                        help="keep the login encrypted in FILE and reuse it until Moodle ends the session "
+                             "(key: LUSCRAPER_CACHE_KEY or FILE.key, needs the cryptography package)")
+    parser.add_argument("--no-extras", action="store_true",
+                        help="skip the background music and farewell portrait (pygame, Pillow and numpy are not loaded)")
+
+    filters = parser.add_argument_group("file selection", "which files of the courses to download; files are "
+                                                          "skipped before their contents are transferred")
+    filters.add_argument("--include-ext", metavar="EXTS", help='only download these extensions, e.g. "pdf,docx"')
+    filters.add_argument("--exclude-ext", metavar="EXTS", help='never download these extensions, e.g. "mp4,zip"')
+    filters.add_argument("--include-type", metavar="TYPES",
+                         help="only download these types: " + ", ".join(FILE_CLASSES))
+    filters.add_argument("--exclude-type", metavar="TYPES", help='never download these types, e.g. "video,audio"')
+    filters.add_argument("--max-size", type=size_argument, metavar="SIZE",
+                         help='skip files larger than SIZE, e.g. "200M" or "1.5G"')
+    filters.add_argument("--section", action="append", metavar="SECTION",
+                         help='only download from course sections with this number or name pattern, e.g. "3" '
+                              'or "Week 1*" (can be repeated)')
+    filters.add_argument("--name", action="append", metavar="PATTERN",
+                         help='only download resources whose name matches PATTERN, e.g. "*lecture*" (can be repeated)')
+    filters.add_argument("--exclude-name", action="append", metavar="PATTERN",
+                         help="skip resources whose name matches PATTERN (can be repeated)")
+    filters.add_argument("--dry-run", action="store_true",
+                         help="download nothing, print the files each course would get and their estimated size")
+
+    batch = parser.add_argument_group("batch mode", "run without any prompts, e.g. from cron; the password is "
+                                                    "read from the LUSCRAPER_PASSWORD environment variable "
+                                                    "(only needed without a valid --session-cache)")
+    batch.add_argument("--batch", action="store_true", help="run headless and exit with a status code (0 = success)")
+    batch.add_argument("--config", metavar="FILE",
+                       help="JSON file with default values for these options, e.g. "
+                            '{"username": "ab12345", "all_courses": true, "sync": true}')
+    batch.add_argument("--username", help="Moodle username (default: LUSCRAPER_USERNAME)")
+    batch.add_argument("--courses", metavar="IDS", help='course ids, id ranges or links, e.g. "11674,13600-13605"')
+    batch.add_argument("--all-courses", action="store_true", help="download every course you are enrolled in")
+    batch.add_argument("--site", default="https://estudijas.lu.lv", help="Moodle site (default: %(default)s)")
+    batch.add_argument("--output-dir", default="MoodleDownloads", help="staging directory (default: %(default)s)")
+    batch.add_argument("--zip-name", default="Courses_Data.zip", help="archive name (default: %(default)s)")
+    batch.add_argument("--report", metavar="FILE", help="write a JSON summary of the run to FILE")
+    batch.add_argument("--shards", type=int, default=1, metavar="N",
+                       help="split the courses across N processes, each logged in with its own session, and "
+                            "merge their archives; --rate is shared between them (default: %(default)s)")
+    batch.add_argument("--shard", type=int, help=argparse.SUPPRESS)  # Set on the processes --shards starts
+    batch.add_argument("--accounts", metavar="FILE",
+                       help='JSON file giving several accounts their courses, e.g. {"ab12345": "11674,13600-13605", '
+                            '"cd67890": "all"}; each account runs in its own --shards processes and logs in with '
+                            'LUSCRAPER_PASSWORD_<USERNAME> (default: LUSCRAPER_PASSWORD)')
+
+    args = parser.parse_args(argv)
+    if args.config:
+        # Values from the config file become defaults, so the command line still wins
+        try:
+            with open(args.config, "r", encoding="utf-8") as f:
+                values = {key.replace("-", "_"): value for key, value in json.load(f).items()}
+        except Exception as e:
+            parser.error(f"cannot read config file {args.config}: {str(e)}")
+        unknown = sorted(key for key in values if key not in vars(args) or key == "config")
+        if unknown:
+            parser.error(f"unsupported keys in {args.config}: {', '.join(unknown)}")
+        for key in ("courses", "include_ext", "exclude_ext", "include_type", "exclude_type"):
+            if isinstance(values.get(key), list):
+                values[key] = ",".join(map(str, values[key]))
+        for key in ("section", "name", "exclude_name"):
+            if values.get(key) is not None and not isinstance(values[key], list):
+                values[key] = [values[key]]
+            if values.get(key):
+                values[key] = list(map(str, values[key]))
+        parser.set_defaults(**values)
+        args = parser.parse_args(argv)
+
+    args.site = args.site.rstrip("/")
+    if args.accounts is not None:
+        if not args.batch or args.dry_run:
+            parser.error("--accounts needs --batch and cannot be combined with --dry-run")
+        if args.username or args.courses or args.all_courses:
+            parser.error("--accounts lists each account's courses, so it cannot be combined with "
+                         "--username, --courses or --all-courses")
+        try:
+            args.accounts = load_accounts(args.accounts, args.site)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.sync and args.no_staging:
+        parser.error("--sync needs the output directory, so it cannot be combined with --no-staging")
+    if args.workers < 1 or args.per_host < 1 or args.timeout <= 0 or args.retries < 0 or args.rate < 0:
+        parser.error("--workers and --per-host must be at least 1, --timeout positive, --retries and --rate not negative")
+    if args.shards < 1 or (args.shards > 1 and not args.batch):
+        parser.error("--shards must be at least 1, and more than 1 needs --batch")
+    if (args.shards > 1 or args.accounts) and (args.archive_format != "zip" or args.per_course):
+        parser.error("--shards and --accounts merge ZIP archives, so they cannot be combined with "
+                     "--format tar.zst or --per-course")
+    if args.per_course and args.no_staging:
+        parser.error("--per-course archives the output directory, so it cannot be combined with --no-staging")
+    if args.per_course and os.path.abspath(split_archive_name(args.zip_name)[0]) == os.path.abspath(args.output_dir):
+        parser.error("--per-course writes to a directory named after --zip-name, which must differ from --output-dir")
+    if args.zip_links and args.archive_format != "zip":
+        parser.error("--zip-links only applies to ZIP archives, tar.zst always stores shared files as hard links")
+    if args.volume_size is not None and args.volume_size < 1024 * 1024:
+        parser.error("--volume-size must be at least 1M")
+    if args.archive_format == "tar.zst":
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            parser.error("--format tar.zst needs the zstandard package (pip install zstandard)")
+        if split_archive_name(args.zip_name)[1].lower() == ".zip":
+            args.zip_name = split_archive_name(args.zip_name)[0] + ARCHIVE_EXTENSIONS["tar.zst"]
+    if args.batch and not (args.courses or args.all_courses or args.accounts):
+        parser.error("--batch needs --courses, --all-courses or --accounts")
+    unknown_types = sorted(set(split_list(args.include_type) + split_list(args.exclude_type)) - set(FILE_CLASSES))
+    if unknown_types:
+        parser.error(f"unknown file types {', '.join(unknown_types)}, choose from {', '.join(FILE_CLASSES)}")
+    if args.courses:
+        try:
+            parse_course_ids(args.courses, args.site)
+        except ValueError as e:
+            parser.error(str(e))
+    return args
+
+def create_session(config):
+    session = requests.Session()
+    session.headers.update({
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+    })
+    configure_transport(session, config["per_host_limit"], config["timeout"], config["retries"],
+                        config["rate"], config["adaptive"])
+    return session
+
+def run_downloads(session, course_links, config, args, api=None):
+    """
+    Downloads course_links and packs them into config["zip_name"] as the options ask
+    (--sync, --no-staging, --no-dedup, the archive and the file selection options).
+    Returns the number of courses that produced files and the paths of the archive(s) created.
+    """
+    file_filter = FileFilter.from_args(args)
+    manifest = None
+    if args.sync:
+        # Sync mode reuses the same directory and remembers what it already has
+        manifest = SyncManifest(os.path.join(config["output_dir"], MANIFEST_NAME))
+    elif not args.no_staging:
+        config["output_dir"] = get_unique_output_dir(config["output_dir"])
+    if not args.no_staging:
+        print(f"[INFO] Using output directory: {config['output_dir']}")
+    kept_bytes = manifest.stored_bytes() if manifest else 0
+    budget = DiskBudget(config["output_dir"], config["zip_name"], staged=not args.no_staging, archived_bytes=kept_bytes)
+
+    if args.no_staging:
+        # Files go straight into the archive, nothing is written to the output directory
+        if args.archive_format == "tar.zst":
+            archive = TarStreamWriter(config["zip_name"], config["output_dir"], compresslevel=args.compress_level,
+                                      volume_size=args.volume_size)
+        else:
+            archive = ZipStreamWriter(config["zip_name"], config["output_dir"], compresslevel=args.compress_level,
+                                      volume_size=args.volume_size, links=args.zip_links)
+        with EVENTS.phase("download"):
+            try:
+                completed = download_courses(session, course_links, config["output_dir"],
+                                             config["max_workers"], config["per_host_limit"], archive=archive,
+                                             dedup=not args.no_dedup, api=api,
+                                             timeout=config["timeout"], retries=config["retries"],
+                                             rate=config["rate"], adaptive=config["adaptive"], budget=budget,
+                                             file_filter=file_filter)
+            except DiskSpaceError as e:
+                print(f"[ERROR] {str(e)}")
+                completed = 0
+            archive.close()
+        if archive.file_count:
+            print(f"[SUCCESS] Created archive: {describe_archive(archive.paths)}")
+            return completed, archive.paths
+        print("[ERROR] No files were downloaded.")
+        for path in archive.paths:
+            os.remove(path)
+        return completed, []
+
+    # Download files for all courses at once
+    with EVENTS.phase("download"):
+        try:
+            completed = download_courses(session, course_links, config["output_dir"],
+                                         config["max_workers"], config["per_host_limit"], manifest,
+                                         dedup=not args.no_dedup, api=api,
+                                         timeout=config["timeout"], retries=config["retries"],
+                                         rate=config["rate"], adaptive=config["adaptive"], budget=budget,
+                                         file_filter=file_filter)
+        except DiskSpaceError as e:
+            print(f"[ERROR] {str(e)}")
+            return 0, []
+    if manifest:
+        manifest.save()
+
+    # Create final archive
+    print("\n[INFO] Creating archive...")
+    with EVENTS.phase("zip"):
+        archives = create_archive(config["output_dir"], config["zip_name"], args.archive_format,
+                                  args.compress_level, args.volume_size, args.per_course, links=args.zip_links)
+    if not archives:
+        return completed, []
+    if args.sync:
+        print(f"[INFO] Keeping output directory for the next sync: {config['output_dir']}")
+    else:
+        try:
+            shutil.rmtree(config["output_dir"])
+            print(f"[INFO] Deleted (previously created) output directory: {config['output_dir']}")
+        except Exception as e:
+            print(f"[ERROR] Failed to delete output directory: {str(e)}")
+    return completed, archives
+
+def run_estimate(session, course_links, config, args, api=None):
+    """
+    --dry-run: selects the files of course_links as a real run with the same options would, and
+    prints how many each course would download and their estimated size, without saving anything.
+    With --sync, files unchanged since the last run are not counted.
+    Returns the per-course totals (see DownloadEstimate).
+    """
+    manifest = SyncManifest(os.path.join(config["output_dir"], MANIFEST_NAME)) if args.sync else None
+    estimate = DownloadEstimate()
+    with EVENTS.phase("estimate"):
+        download_courses(session, course_links, config["output_dir"], config["max_workers"], config["per_host_limit"],
+                         manifest, api=api, timeout=config["timeout"], retries=config["retries"],
+                         rate=config["rate"], adaptive=config["adaptive"], file_filter=FileFilter.from_args(args),
+                         estimate=estimate)
+    courses = estimate.report()
+    try:
+        budget = DiskBudget(config["output_dir"], config["zip_name"], staged=not args.no_staging)
+        budget.check(sum(totals["bytes"] for totals in courses), "the selected files")
+    except DiskSpaceError as e:
+        print(f"[WARNING] {str(e)}")
+    return courses
+
+def write_report(report_path, report):
+    try:
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    except Exception as e:
+        print(f"[ERROR] Failed to write report {report_path}: {str(e)}")
+
+def load_accounts(accounts, base_url):
+    """
+    Reads an --accounts assignment (a JSON file name, or the object itself from a --config file)
+    into {username: courses}, where courses is a --courses list or "all" for every enrolled course.
+    Raises ValueError if it cannot be read or names invalid courses.
+    """
+    if isinstance(accounts, str):
+        try:
+            with open(accounts, "r", encoding="utf-8") as f:
+                accounts = json.load(f)
+        except Exception as e:
+            raise ValueError(f"cannot read accounts file {accounts}: {str(e)}")
+    if not isinstance(accounts, dict) or not accounts:
+        raise ValueError('--accounts must map each username to its courses, e.g. {"ab12345": "all"}')
+    assigned = {}
+    for username, courses in accounts.items():
+        if not isinstance(courses, (str, int, list)):
+            raise ValueError(f'--accounts gives {username} neither a course list nor "all"')
+        courses = ",".join(map(str, courses)) if isinstance(courses, list) else str(courses).strip()
+        if courses != "all":
+            parse_course_ids(courses, base_url)
+        assigned[username] = courses
+    return assigned
+
+def account_password(username):
+    """Returns the password of username: LUSCRAPER_PASSWORD_<USERNAME> if set, else LUSCRAPER_PASSWORD."""
+    return os.environ.get("LUSCRAPER_PASSWORD_" + re.sub(r"[^A-Z0-9]", "_", username.upper())) or \
+        os.environ.get("LUSCRAPER_PASSWORD")
+
+def batch_username(args):
+    """Returns the batch user, or None (after printing why) if the run cannot log in."""
+    username = args.username or os.environ.get("LUSCRAPER_USERNAME")
+    if not username or not (os.environ.get("LUSCRAPER_PASSWORD") or args.session_cache):
+        print("[ERROR] Batch mode needs --username (or LUSCRAPER_USERNAME) and the LUSCRAPER_PASSWORD environment variable")
+        return None
+    return username
+
+def batch_login(args, config, username):
+    """
+    Logs username in without prompts, reusing the --session-cache entry while it is valid
+    (a shard keeps its own entry, so every shard has a session of its own).
+    Returns (session, api), or None if the login failed.
+    """
+    password = account_password(username)
+    cache_user = username if args.shard is None else f"{username}#shard{args.shard}"
+    session = create_session(config)
+    cache = SessionCache(args.session_cache) if args.session_cache else None
+    cached = (resume_session(session, cache, args.site, cache_user) if cache else None) or {}
+    if not cached:
+        if not password:
+            print("[ERROR] No valid saved session, set LUSCRAPER_PASSWORD to log in")
+            return None
+        with EVENTS.phase("login"):
+            logged_in = login_to_moodle(session, config["login_url"], username, password)
+        if not logged_in:
+            return None
+
+    api = None
+    if args.discovery == "api" or args.all_courses or args.accounts:
+        api = MoodleAPI.connect(session, args.site, username, password,
+                                token=cached.get("token"), sesskey=cached.get("sesskey"))
+        if not api:
+            print("[WARNING] Moodle API unavailable, falling back to page scraping")
+    if cache:
+        cache.store(args.site, cache_user, session, user=cached.get("user"),
+                    token=api.token if api else cached.get("token"),
+                    sesskey=api.sesskey if api else cached.get("sesskey"))
+    return session, api
+
+def batch_course_links(args, session, api, courses=None, all_courses=None):
+    """
+    Returns the links of courses (default: --courses) plus, with all_courses (default: --all-courses),
+    every enrolled course, without repeats.
+    """
+    courses = args.courses if courses is None else courses
+    all_courses = args.all_courses if all_courses is None else all_courses
+    course_links = parse_course_ids(courses, args.site) if courses else []
+    if all_courses:
+        enrolled = get_enrolled_courses(session, args.site, api)
+        print(f"[INFO] Found {len(enrolled)} enrolled courses")
+        course_links += enrolled
+    return list(dict.fromkeys(course_links))
+
+def run_batch(args, config):
+    """Runs a whole download without prompts. Returns one of the EXIT_* statuses."""
+    report = {"status": EXIT_USAGE, "courses_requested": 0, "courses_completed": 0, "archive": None}
+    if args.accounts:
+        missing = [username for username in args.accounts if not (account_password(username) or args.session_cache)]
+        if missing:
+            print(f"[ERROR] No password for {', '.join(missing)}, set LUSCRAPER_PASSWORD_<USERNAME> or LUSCRAPER_PASSWORD")
+            return finish_batch(args, report)
+        return run_sharded(args, config, args.accounts, report)
+    username = batch_username(args)
+    if not username:
+        return finish_batch(args, report)
+    if args.shards > 1 and not args.dry_run:
+        return run_sharded(args, config, {username: None}, report)
+
+    login = batch_login(args, config, username)
+    if not login:
+        report["status"] = EXIT_LOGIN_FAILED
+        return finish_batch(args, report)
+    session, api = login
+
+    course_links = batch_course_links(args, session, api)
+    report["courses_requested"] = len(course_links)
+    if not course_links:
+        print("[ERROR] No courses to download.")
+        report["status"] = EXIT_NO_FILES
+        return finish_batch(args, report)
+
+    if args.dry_run:
+        courses = run_estimate(session, course_links, config, args, api if args.discovery == "api" else None)
+        report["courses_completed"] = len(courses)
+        report["estimate"] = courses
+        report["status"] = EXIT_OK if len(courses) == len(course_links) else EXIT_PARTIAL if courses else EXIT_NO_FILES
+        return finish_batch(args, report)
+
+    completed, archives = run_downloads(session, course_links, config, args,
+                                        api if args.discovery == "api" else None)
+    report["courses_completed"] = completed
+    if not archives:
+        report["status"] = EXIT_NO_FILES
+    else:
+        set_report_archives(report, archives)
+        report["status"] = EXIT_OK if completed == len(course_links) else EXIT_PARTIAL
+    return finish_batch(args, report)
+
+def set_report_archives(report, paths):
+    """Records the archive files of a run: "archive" is the archive if it is a single file, "archives" lists them all."""
+    report["archives"] = [os.path.abspath(path) for path in paths]
+    report["archive"] = report["archives"][0] if len(paths) == 1 else None
+
+def shard_of(course_link, shards):
+    """Picks the shard of a course by its id, so a course stays in the same shard from run to run."""
+    course_id = course_id_from_url(course_link)
+    return (course_id if course_id is not None else zlib.crc32(course_link.encode("utf-8"))) % shards
+
+def shard_command(args, username, shard, course_links, paths, processes):
+    """Returns the command line of the batch process that downloads one shard's courses (of processes in all)."""
+    command = [sys.executable] if getattr(sys, "frozen", False) else [sys.executable, os.path.abspath(__file__)]
+    command += ["--batch", "--site", args.site, "--username", username, "--shard", str(shard),
+                "--courses", ",".join(str(course_id_from_url(link) or link) for link in course_links),
+                "--output-dir", paths["dir"], "--zip-name", paths["zip"], "--report", paths["report"],
+                "--discovery", args.discovery, "--compress-level", str(args.compress_level),
+                "--workers", str(args.workers), "--per-host", str(args.per_host),
+                # The shards talk to the same server, so they split its --rate between them
+                "--rate", str(args.rate / processes), "--timeout", str(args.timeout), "--retries", str(args.retries)]
+    for option in ("sync", "no_staging", "no_dedup", "zip_links", "fixed_concurrency"):
+        if getattr(args, option):
+            command.append("--" + option.replace("_", "-"))
+    for option in ("events", "session_cache"):
+        if getattr(args, option):
+            command += ["--" + option.replace("_", "-"), os.path.abspath(getattr(args, option))]
+    for option in ("include_ext", "exclude_ext", "include_type", "exclude_type", "max_size"):
+        if getattr(args, option) is not None:
+            command += ["--" + option.replace("_", "-"), str(getattr(args, option))]
+    for option in ("section", "name", "exclude_name"):
+        for value in getattr(args, option) or ():
+            command += ["--" + option.replace("_", "-"), value]
+    return command
+
+def merge_manifests(shard_dirs, root):
+    """Writes one --sync manifest in root listing the files of every shard's manifest."""
+    entries = {}
+    for shard_dir in shard_dirs:
+        try:
+            with open(os.path.join(shard_dir, MANIFEST_NAME), "r", encoding="utf-8") as f:
+                shard_entries = json.load(f)
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            print(f"[WARNING] Skipping unreadable manifest of {shard_dir}: {str(e)}")
+            continue
+        prefix = os.path.relpath(shard_dir, root)
+        for url, entry in shard_entries.items():
+            entries[url] = dict(entry, filename=os.path.join(prefix, entry["filename"]))
+    manifest = SyncManifest(os.path.join(root, MANIFEST_NAME))
+    manifest.entries = entries
+    manifest.save()
+    return len(entries)
+
+def run_sharded(args, config, accounts, report):
+    """
+    Splits the courses of every account across --shards batch processes, each logged in with its
+    own session and writing its own directory and archive, then merges their archives into
+    config["zip_name"] (and, with --sync, their manifests into one). accounts maps each username
+    to its --accounts courses, or to None for --courses and --all-courses. Returns one of the EXIT_* statuses.
+    """
+    plan, failed, assigned = [], [], set()
+    for username, courses in accounts.items():
+        all_courses = args.all_courses if courses is None else courses == "all"
+        login = None
+        if all_courses:
+            login = batch_login(args, config, username)
+            if not login:
+                print(f"[ERROR] Login as {username} failed, skipping its courses")
+                failed.append(username)
+                continue
+        links = batch_course_links(args, *(login or (None, None)), courses=None if courses == "all" else courses,
+                                   all_courses=all_courses)
+        # A course listed for several accounts is downloaded once, by the first of them
+        links = [link for link in links if link not in assigned]
+        assigned.update(links)
+        plan.append((username, links))
+    course_links = [link for _, links in plan for link in links]
+    report["courses_requested"] = len(course_links)
+    if failed and args.accounts:
+        report["accounts_failed"] = failed
+    if not course_links:
+        print("[ERROR] No courses to download.")
+        report["status"] = EXIT_LOGIN_FAILED if failed else EXIT_NO_FILES
+        return finish_batch(args, report)
+
+    groups = []
+    for username, links in plan:
+        account_groups = [[] for _ in range(args.shards)]
+        for course_link in links:
+            account_groups[shard_of(course_link, args.shards)].append(course_link)
+        groups += [(username, shard, links) for shard, links in enumerate(account_groups) if links]
+    # Sync mode keeps every shard's directory, and so its manifest, for the next run
+    root = os.path.abspath(config["output_dir"] if args.sync else get_unique_output_dir(config["output_dir"]))
+    os.makedirs(root, exist_ok=True)
+    print(f"[INFO] Downloading {len(course_links)} courses in {len(groups)} shards"
+          f"{f' for {len(plan)} accounts' if args.accounts else ''}, logs in {root}")
+
+    shards = []
+    with EVENTS.phase("download"):
+        for username, shard, links in groups:
+            name = f"{sanitize_filename(username)}-shard-{shard}" if args.accounts else f"shard-{shard}"
+            paths = {key: os.path.join(root, name + suffix)
+                     for key, suffix in (("dir", ""), ("zip", ".zip"), ("report", ".json"), ("log", ".log"))}
+            for stale in (paths["zip"], paths["report"]):
+                if os.path.exists(stale):
+                    os.remove(stale)
+            log = open(paths["log"], "w", encoding="utf-8")
+            process = subprocess.Popen(shard_command(args, username, shard, links, paths, len(groups)),
+                                       stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+            shards.append((username, shard, links, paths, process, log))
+        for username, shard, links, paths, process, log in shards:
+            process.wait()
+            log.close()
+
+    archives = []
+    report["shards"] = []
+    for username, shard, links, paths, process, log in shards:
+        try:
+            with open(paths["report"], "r", encoding="utf-8") as f:
+                shard_report = json.load(f)
+        except Exception:
+            shard_report = {"status": process.returncode, "courses_completed": 0, "archive": None}
+        if shard_report.get("archive"):
+            archives.append(shard_report["archive"])
+        report["shards"].append(dict({"account": username} if args.accounts else {}, shard=shard,
+                                     status=shard_report["status"], courses_requested=len(links),
+                                     courses_completed=shard_report.get("courses_completed", 0)))
+        label = f"Shard {shard} of {username}" if args.accounts else f"Shard {shard}"
+        if shard_report["status"] == EXIT_OK:
+            print(f"[INFO] {label}: downloaded {len(links)} courses")
+        else:
+            print(f"[ERROR] {label} exited with status {shard_report['status']}, see {paths['log']}")
+    report["courses_completed"] = sum(shard["courses_completed"] for shard in report["shards"])
+
+    if not archives:
+        statuses = {shard["status"] for shard in report["shards"]}
+        report["status"] = EXIT_LOGIN_FAILED if statuses == {EXIT_LOGIN_FAILED} else EXIT_NO_FILES
+        return finish_batch(args, report)
+    print("\n[INFO] Merging shard archives...")
+    try:
+        with EVENTS.phase("zip"):
+            members, paths = merge_archives(archives, config["zip_name"], args.volume_size)
+            if args.sync:
+                merge_manifests([paths["dir"] for _, _, _, paths, _, _ in shards], root)
+    except Exception as e:
+        print(f"[ERROR] Merging shard archives failed: {str(e)}")
+        report["status"] = EXIT_NO_FILES
+        return finish_batch(args, report)
+    print(f"[SUCCESS] Created ZIP archive: {describe_archive(paths)} ({members} files from {len(archives)} shards)")
+    for archive in archives:
+        os.remove(archive)
+
+    set_report_archives(report, paths)
+    complete = report["courses_completed"] == len(course_links) and not failed
+    report["status"] = EXIT_OK if complete else EXIT_PARTIAL
+    if complete and not args.sync:
+        shutil.rmtree(root, ignore_errors=True)
+    return finish_batch(args, report)
+
+def finish_batch(args, report):
+    """Prints the one-line result of a batch run, writes the --report file and returns the status."""
+    finish_instrumentation(args.metrics)
+    print(f"[RESULT] {json.dumps(report)}")
+    if args.report:
+        write_report(args.report, report)
+    return report["status"]
+
 def main():
+    args = parse_args()
+
     # Configuration
     config = {
-        "login_url": "https://estudijas.lu.lv/login/index.php",
-        "output_dir": "MoodleDownloads",
-        "zip_name": "Courses_Data.zip",
-        "music_file": "slow.mp3"  # Path to the background music file	
+        "login_url": f"{args.site}/login/index.php",
+        "output_dir": args.output_dir,
+        "zip_name": args.zip_name,
+        "music_file": "slow.mp3",  # Path to the background music file
+        "max_workers": args.workers,  # Simultaneous transfers for the whole run
+        "per_host_limit": args.per_host,  # Simultaneous transfers to a single host
+        "timeout": (HTTP_TIMEOUT[0], args.timeout),  # Seconds to connect, and to wait for data
+        "retries": args.retries,  # Retries of a request answered with 429/5xx
+        "rate": args.rate or None,  # Requests per second to a single host
+        "adaptive": not args.fixed_concurrency  # Grow/shrink per_host_limit's share with the server's health
     }
     
-    config["zip_name"] = get_unique_filename(config["zip_name"])
+    if not (args.per_course and args.sync):
+        # A --per-course --sync run updates the course archives of the last one
+        config["zip_name"] = get_unique_filename(config["zip_name"])
+    EXTRAS["enabled"] = not args.no_extras
+    if args.events:
+        try:
+            EVENTS.open(args.events)
+        except Exception as e:
+            print(f"[ERROR] Cannot open event log {args.events}: {str(e)}")
+            return EXIT_USAGE
 
+    if args.batch:
+        return run_batch(args, config)
 
     print("\t\tMoodle\\Estudijas Downloader")
     print("\t\t===========================")
     print("This program downloads all files (materials) from the courses provided via links.")
     print("You will be prompted to enter course links, login credentials, and a password,\n\
 and the program will securely download and save the files for you.")
-    print(f"All downloaded files will be saved to a ZIP archive named '{config["zip_name"]}'.\
+    print(f"All downloaded files will be saved to an archive named '{config['zip_name']}'.\
 This archive will be created in the same directory as the program.")
     print("IMPORTANT: Your data is confidential.\
 \n\t- The program does not store, share, or transmit your password or any other personal information.\
@@ -497,58 +3755,66 @@ This archive will be created in the same directory as the program.")
 
     print("Here is an example of the link:\nhttps://estudijas.lu.lv/course/view.php?id=11674")
 
-    session = requests.Session()
-    session.headers.update({
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    })
+    session = create_session(config)
 
-    course_links = get_course_links()
+    course_links = parse_course_ids(args.courses, args.site) if args.courses else get_course_links()
     if not course_links:
         print("[ERROR] No course links provided!")
         return
    
     # Get login credentials from the user
-    username = input("Enter your username: ").strip()
-    while True:
+    username = args.username or input("Enter your username: ").strip()
+    password = None
+    cache = SessionCache(args.session_cache) if args.session_cache else None
+    cached = (resume_session(session, cache, args.site, username) if cache else None) or {}
+    while not cached:
         password = getpass("Enter your password (or press Enter to exit): ").strip()
         if not password:  # If Enter is pressed without typing a password
             print("[INFO] Login canceled by user. Exiting...")
             return
 
         # Attempt to log in
-        if login_to_moodle(session, config["login_url"], username, password):
+        with EVENTS.phase("login"):
+            logged_in = login_to_moodle(session, config["login_url"], username, password)
+        if logged_in:
             break  # Exit the loop if login is successful
         else:
             print("[INFO] Please try again or press Enter to exit.")
    
-    music_thread = Thread(target=play_music, args=(config["music_file"],))
-    music_thread.daemon = True  # Ensure the thread stops when the main program exits
-    music_thread.start()
+    if EXTRAS["enabled"]:
+        music_thread = Thread(target=play_music, args=(config["music_file"],))
+        music_thread.daemon = True  # Ensure the thread stops when the main program exits
+        music_thread.start()
     
-    config["output_dir"] = get_unique_output_dir(config["output_dir"])
-    print(f"[INFO] Using output directory: {config['output_dir']}")
-
     # Get user info and display farewell message
-    user_name, image_url = get_user_info(session)
-
-    # Download files for each course
-    for course_url in course_links:
-        print(f"\n[INFO] Processing course: {course_url}")
-        download_files_from_course(session, course_url, config["output_dir"])
+    user_name, image_url = cached.get("user") or get_user_info(session, args.site)
+
+    api = None
+    if args.discovery == "api":
+        api = MoodleAPI.connect(session, args.site, username, password,
+                                token=cached.get("token"), sesskey=cached.get("sesskey"))
+        if not api:
+            print("[WARNING] Moodle API unavailable, falling back to page scraping")
+    if cache:
+        # A profile that could not be read is looked up again next time
+        cache.store(args.site, username, session, user=[user_name, image_url] if user_name else None,
+                    token=api.token if api else cached.get("token"),
+                    sesskey=api.sesskey if api else cached.get("sesskey"))
+
+    if args.dry_run:
+        run_estimate(session, course_links, config, args, api)
+        finish_instrumentation(args.metrics)
+        input("\nPress Enter to exit...")
+        return
 
-    # Create final ZIP archive
-    print("\n[INFO] Creating ZIP archive...")
-    if create_zip(config["output_dir"], config["zip_name"]):
+    _, archived = run_downloads(session, course_links, config, args, api)
+    finish_instrumentation(args.metrics)
+    if archived:
         print("\n[SUCCESS] Script completed successfully!")
-        try:
-            shutil.rmtree(config["output_dir"])
-            print(f"[INFO] Deleted (previously created) output directory: {config['output_dir']}")
-        except Exception as e:
-            print(f"[ERROR] Failed to delete output directory: {str(e)}")
         goodbuy(session,user_name,image_url)
     else:
         print("[WARNING] Script completed with some errors")
     input("\nPress Enter to exit...")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
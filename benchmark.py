@@ -0,0 +1,1311 @@
+"""
+Offline benchmarks for LUscraper101. Nothing here talks to estudijas.lu.lv.
+
+    python benchmark.py zip [--courses 4] [--files 40] [--scale 1.0]
+    python benchmark.py startup [--repeat 5]
+    python benchmark.py classify [--links 100000]
+    python benchmark.py html [--activities 2000,10000,40000]
+    python benchmark.py writer [--size-mb 256] [--repeat 3]
+    python benchmark.py pipeline [--courses 4] [--files 20] [--latency 0.02] [--save FILE] [--baseline FILE]
+    python benchmark.py shards [--shards 1,2,4,8] [--rates 0,20] [--accounts 2]
+    python benchmark.py filters [--courses 4] [--files 25] [--scale 0.25]
+    python benchmark.py resume [--courses 3] [--files 10] [--drop-after 65536]
+    python benchmark.py api [--courses 4] [--files 25] [--scale 0.1]
+    python benchmark.py throttle [--pool 8] [--limit 3] [--seconds 4]
+    python benchmark.py session [--courses 2] [--files 5]
+    python benchmark.py archive [--courses 8] [--files 20] [--scale 0.5] [--volume-mb 16]
+"""
+import argparse
+import collections
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, unquote, urlparse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import LUscraper101 as scraper
+
+
+# Extension mix of a typical course: mostly PDFs and slides, a few large recordings
+SYNTHETIC_FILES = [
+    (".pdf", 0.30, 2 * 1024 * 1024),
+    (".pptx", 0.15, 4 * 1024 * 1024),
+    (".docx", 0.10, 512 * 1024),
+    (".txt", 0.10, 256 * 1024),
+    (".jpg", 0.15, 1024 * 1024),
+    (".mp4", 0.05, 40 * 1024 * 1024),
+    (".zip", 0.05, 8 * 1024 * 1024),
+    (".csv", 0.10, 1024 * 1024),
+]
+
+# Moodle's file type icon for each of them (theme/image.php/.../f/<icon>)
+MOODLE_ICONS = {".pdf": "pdf", ".pptx": "powerpoint", ".docx": "document", ".txt": "text", ".jpg": "jpeg",
+                ".mp4": "mpeg", ".zip": "archive", ".csv": "spreadsheet"}
+
+WORDS = b"lekcija studiju kurss uzdevums moodle pdf resource lapa datu fails".split()
+
+
+def synthetic_body(extension, size, rng):
+    """Returns bytes that compress roughly like a real file of that type."""
+    if extension in scraper.STORED_EXTENSIONS:
+        return rng.randbytes(size)
+    # Text-like content: repetitive words with some noise, close to PDFs and documents
+    out = bytearray()
+    while len(out) < size:
+        out += b" ".join(rng.choice(WORDS) for _ in range(64)) + b"\n"
+        out += rng.randbytes(16)
+    return bytes(out[:size])
+
+
+def make_course_tree(root, courses, files, scale, seed=1):
+    """Fills root with course directories of synthetic files. Returns the total byte count."""
+    rng = random.Random(seed)
+    total = 0
+    for course in range(courses):
+        course_path = os.path.join(root, f"Course {course + 1}")
+        os.makedirs(course_path, exist_ok=True)
+        for index in range(files):
+            extension, _, mean_size = rng.choices(SYNTHETIC_FILES, weights=[w for _, w, _ in SYNTHETIC_FILES])[0]
+            size = max(1, int(rng.expovariate(1 / mean_size) * scale))
+            with open(os.path.join(course_path, f"Resource {index}{extension}"), "wb") as f:
+                f.write(synthetic_body(extension, size, rng))
+            total += size
+    return total
+
+
+def legacy_create_zip(output_dir, zip_name):
+    """The original create_zip: everything deflated at the default level on one thread."""
+    with zipfile.ZipFile(zip_name, "w", zipfile.ZIP_DEFLATED) as zipf:
+        for root, _, files in os.walk(output_dir):
+            for file in files:
+                file_path = os.path.join(root, file)
+                zipf.write(file_path, os.path.relpath(file_path, output_dir))
+    return True
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def bench_zip(args):
+    work_dir = tempfile.mkdtemp(prefix="luscraper_bench_")
+    try:
+        tree = os.path.join(work_dir, "MoodleDownloads")
+        total = make_course_tree(tree, args.courses, args.files, args.scale)
+        print(f"Synthetic tree: {args.courses * args.files} files, {total / 1024 / 1024:.1f} MB, "
+              f"{os.cpu_count()} cores")
+        print(f"{'variant':<28}{'wall s':>10}{'MB/s':>10}{'archive MB':>12}")
+
+        variants = [("legacy create_zip", lambda z: legacy_create_zip(tree, z))]
+        for level in (1, 6, 9):
+            variants.append((f"create_zip level {level}", lambda z, level=level: scraper.create_zip(tree, z, level)))
+        variants.append(("create_zip level 6, 1 thread", lambda z: scraper.create_zip(tree, z, 6, workers=1)))
+
+        for name, build in variants:
+            zip_name = os.path.join(work_dir, "bench.zip")
+            elapsed = timed(build, zip_name)
+            size = os.path.getsize(zip_name)
+            print(f"{name:<28}{elapsed:>10.2f}{total / 1024 / 1024 / elapsed:>10.1f}{size / 1024 / 1024:>12.1f}")
+            os.remove(zip_name)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# Import statements timed in a fresh interpreter each; the first is what the module used to do
+STARTUP_VARIANTS = [
+    ("eager extras (old module)",
+     "import contextlib, io\n"
+     "with contextlib.redirect_stdout(io.StringIO()):\n"
+     "    from pygame import mixer\n"
+     "from PIL import Image\n"
+     "import numpy\n"
+     "import LUscraper101"),
+    ("LUscraper101", "import LUscraper101"),
+    ("LUscraper101 + load_extra", "import LUscraper101\n"
+     "for name in ('pygame.mixer', 'PIL.Image', 'numpy'):\n"
+     "    LUscraper101.load_extra(name)"),
+    ("python only", "pass"),
+]
+
+STARTUP_PROBE = """
+import resource, time, json
+start = time.perf_counter()
+exec(compile({code!r}, "<startup>", "exec"))
+elapsed = time.perf_counter() - start
+try:
+    # ru_maxrss keeps the parent's peak across fork/exec on Linux, VmHWM does not
+    with open("/proc/self/status") as f:
+        peak = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+except OSError:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps([elapsed, peak]))
+"""
+
+
+def bench_startup(args):
+    env = dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1")
+    here = os.path.dirname(os.path.abspath(__file__))
+    print(f"{'variant':<30}{'import ms':>12}{'peak RSS MB':>14}")
+    for name, code in STARTUP_VARIANTS:
+        times, peaks = [], []
+        for _ in range(args.repeat):
+            result = subprocess.run([sys.executable, "-c", STARTUP_PROBE.format(code=code)],
+                                    cwd=here, env=env, capture_output=True, text=True, check=True)
+            elapsed, maxrss = json.loads(result.stdout.strip().splitlines()[-1])
+            times.append(elapsed)
+            peaks.append(maxrss)
+        # Both peak figures are in KiB on Linux
+        print(f"{name:<30}{statistics.median(times) * 1000:>12.1f}{max(peaks) / 1024:>14.1f}")
+
+
+# (Content-Type, Content-Disposition, URL path) shapes seen on Moodle resource links
+SYNTHETIC_LINKS = [
+    ("application/pdf", 'inline; filename="Lekcija {n}.pdf"', "/pluginfile.php/{n}/mod_resource/content/1/Lekcija%20{n}.pdf"),
+    ("application/vnd.openxmlformats-officedocument.presentationml.presentation",
+     "attachment; filename*=UTF-8''Prezent%C4%81cija%20{n}.pptx", "/pluginfile.php/{n}/mod_resource/content/2/file.pptx"),
+    ("text/html; charset=utf-8", None, "/mod/resource/view.php"),
+    ("application/octet-stream", None, "/pluginfile.php/{n}/mod_resource/content/1/dati_{n}.csv"),
+    ("video/mp4", 'attachment; filename="ieraksts {n}.mp4"', "/pluginfile.php/{n}/mod_resource/content/3/ieraksts.mp4"),
+    ("text/plain; charset=utf-8", None, "/pluginfile.php/{n}/mod_resource/content/1/readme"),
+]
+
+
+def synthetic_link_corpus(count, seed=1):
+    """Returns (file name, response stand-in) pairs with the headers the classifier reads."""
+    rng = random.Random(seed)
+    corpus = []
+    for n in range(count):
+        content_type, disposition, path = rng.choice(SYNTHETIC_LINKS)
+        headers = CaseInsensitiveDict({"Content-Type": content_type})
+        if disposition:
+            headers["Content-Disposition"] = disposition.format(n=n)
+        url = f"https://estudijas.lu.lv{path.format(n=n)}?id={n}"
+        corpus.append((f"Resource {n}: week <{n % 16}>", SimpleNamespace(url=url, headers=headers)))
+    return corpus
+
+
+def legacy_classify(file_name, response):
+    """The original per-link checks: linear any() scans and regexes compiled on every call."""
+    content_type = response.headers.get("Content-Type", "").lower()
+    is_file = (
+        any(ct in content_type for ct in scraper.FILE_MIME_TYPES)
+        or any(response.url.lower().endswith(ext) for ext in scraper.FILE_EXTENSIONS)
+    )
+    if not is_file or "text/html" in content_type:
+        return None
+    extension = ".bin"
+    filename_match = re.findall('filename="([^"]+)"', response.headers.get("Content-Disposition", ""))
+    if filename_match:
+        extension = os.path.splitext(unquote(filename_match[0]))[1] or extension
+    if extension == ".bin":
+        extension = os.path.splitext(urlparse(response.url).path)[1] or extension
+    return re.sub(r'[<>:"/\\|?*]', '_', file_name + extension).strip()
+
+
+def classify(file_name, response):
+    if not scraper.is_file_response(response):
+        return None
+    return scraper.sanitize_filename(file_name + scraper.get_file_extension(response, response.url))
+
+
+def bench_classify(args):
+    corpus = synthetic_link_corpus(args.links)
+    print(f"Synthetic corpus: {args.links} links")
+    print(f"{'variant':<22}{'total s':>10}{'us/link':>10}{'links/s':>12}")
+    for name, func in (("legacy any() scans", legacy_classify), ("classifier", classify)):
+        start = time.perf_counter()
+        for file_name, response in corpus:
+            func(file_name, response)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<22}{elapsed:>10.3f}{elapsed / args.links * 1e6:>10.2f}{args.links / elapsed:>12.0f}")
+
+
+def write_course_page(path, activities, seed=1):
+    """
+    Writes a Moodle-shaped course page: the page-header-headings title, then weekly sections of
+    activities, each a mod/resource (or forum) link with an instancename span and a paragraph of
+    inline description. Returns the number of mod/resource links on it.
+    """
+    rng = random.Random(seed)
+    resources = 0
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<!DOCTYPE html><html><head><title>Kurss</title><script>var M = {cfg: {}};</script></head><body>'
+                '<div class="page-header-headings"><h1 class="h2">Datu strukt\u016bras un algoritmi</h1></div>'
+                '<div class="course-content"><ul class="weeks">')
+        for n in range(activities):
+            if n % 50 == 0:
+                f.write(f'{"</ul></li>" if n else ""}<li class="section main"><h3>Ned\u0113\u013ca {n // 50 + 1}</h3><ul class="section">')
+            module = "resource" if n % 4 else "forum"
+            resources += module == "resource"
+            text = " ".join(rng.choice(WORDS).decode() for _ in range(rng.randint(60, 300)))
+            f.write(f'<li class="activity {module} modtype_{module}" id="module-{n}"><div class="activityinstance">'
+                    f'<a class="aalink" href="https://estudijas.lu.lv/mod/{module}/view.php?id={n}">'
+                    f'<img src="https://estudijas.lu.lv/theme/image.php/icon" class="iconlarge activityicon" alt="">'
+                    f'<span class="instancename">Lekcija {n}<span class="accesshide"> Fails</span></span></a></div>'
+                    f'<div class="contentafterlink"><p>{text}</p></div></li>')
+        f.write('</ul></li></ul></div><footer>Moodle</footer></body></html>')
+    return resources
+
+
+HTML_PROBE = """
+import functools, json, time
+from types import SimpleNamespace
+import LUscraper101 as scraper
+from lxml import html
+start = time.perf_counter()
+if {streaming!r}:
+    with open({path!r}, "rb") as f:
+        response = SimpleNamespace(url="https://estudijas.lu.lv/course/view.php?id=1",
+                                   headers={{"Content-Type": "text/html; charset=utf-8"}},
+                                   iter_content=lambda chunk_size: iter(functools.partial(f.read, chunk_size), b""))
+        name, resources = scraper.parse_course_html(response)
+else:
+    # What parse_course_page used to do with response.text
+    with open({path!r}, "rb") as f:
+        tree = html.fromstring(f.read().decode("utf-8"))
+    name = " ".join(tree.xpath('//*[contains(@class, "page-header-headings")]//text()')).strip()
+    resources = [(link.xpath('.//span[@class="instancename"]/text()')[0].strip(), link.get("href"))
+                 for link in tree.xpath('//a[contains(@href, "mod/resource")]')]
+elapsed = time.perf_counter() - start
+with open("/proc/self/status") as f:
+    peak = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+print(json.dumps([elapsed, peak, len(resources)]))
+"""
+
+
+def bench_html(args):
+    env = dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1")
+    here = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix="luscraper-html-")
+    try:
+        print(f"{'activities':>10}{'page MB':>9}  {'variant':<12}{'parse s':>9}{'peak RSS MB':>13}{'links':>8}")
+        for activities in args.activities:
+            path = os.path.join(work_dir, f"course-{activities}.html")
+            expected = write_course_page(path, activities)
+            size = os.path.getsize(path) / 1e6
+            for name, streaming in (("fromstring", False), ("streaming", True)):
+                result = subprocess.run([sys.executable, "-c", HTML_PROBE.format(path=path, streaming=streaming)],
+                                        cwd=here, env=env, capture_output=True, text=True, check=True)
+                elapsed, peak, links = json.loads(result.stdout.strip().splitlines()[-1])
+                note = "" if links == expected else f"  (expected {expected})"
+                print(f"{activities:>10}{size:>9.1f}  {name:<12}{elapsed:>9.2f}{peak / 1024:>13.1f}{links:>8}{note}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+class BodyServer:
+    """Local HTTP server answering every GET with size bytes of one repeated random block."""
+
+    def __init__(self, size):
+        block = random.Random(1).randbytes(1024 * 1024)
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "video/mp4")
+                self.send_header("Content-Length", str(size))
+                self.send_header("ETag", f'"body-{size}"')
+                self.send_header("Accept-Ranges", "bytes")
+                self.end_headers()
+                remaining = size
+                while remaining:
+                    self.wfile.write(block[:min(remaining, len(block))])
+                    remaining -= min(remaining, len(block))
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}/pluginfile.php/1/mod_resource/content/1/video.mp4"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def legacy_save_stream(session, url, response, file_path):
+    """The 8 KiB write loop save_stream used before: hash and write every iter_content chunk."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(file_path + ".part", "wb") as f:
+        for chunk in response.iter_content(chunk_size=8192):
+            digest.update(chunk)
+            size += len(chunk)
+            f.write(chunk)
+    os.replace(file_path + ".part", file_path)
+    return size, digest.hexdigest()
+
+
+def bench_writer(args):
+    size = int(args.size_mb * 1024 * 1024)
+    server = BodyServer(size)
+    work_dir = tempfile.mkdtemp(prefix="luscraper-writer-")
+    session = requests.Session()
+    variants = [("8 KiB loop", legacy_save_stream), ("tuned writer", scraper.save_stream)]
+    try:
+        print(f"One {args.size_mb:g} MB body from a local server, {args.repeat} runs each (median, CPU includes the server thread)")
+        print(f"{'variant':<14}{'wall s':>9}{'CPU s':>8}{'MB/s':>9}{'chunk KiB':>11}")
+        for name, save in variants:
+            walls, cpus = [], []
+            for run in range(args.repeat):
+                file_path = os.path.join(work_dir, f"video{run}.mp4")
+                start, cpu = time.perf_counter(), time.process_time()
+                with session.get(server.url, stream=True) as response:
+                    written, _ = save(session, server.url, response, file_path)
+                walls.append(time.perf_counter() - start)
+                cpus.append(time.process_time() - cpu)
+                if written != size:
+                    raise RuntimeError(f"{name} wrote {written} of {size} bytes")
+                os.remove(file_path)
+            chunk = 8192 if save is legacy_save_stream else scraper.transfer_chunk_size(size)
+            wall = statistics.median(walls)
+            print(f"{name:<14}{wall:>9.2f}{statistics.median(cpus):>8.2f}{args.size_mb / wall:>9.0f}{chunk // 1024:>11}")
+    finally:
+        server.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def moodle_size(size):
+    """Formats a size the way Moodle's display_size() does ("1.2MB", "512KB", "10 bytes")."""
+    for unit, scale in (("GB", 1024 ** 3), ("MB", 1024 ** 2), ("KB", 1024)):
+        if size >= scale:
+            return f"{round(size / scale, 1)}{unit}"
+    return f"{size} bytes"
+
+
+class FakeMoodle:
+    """
+    Local Moodle stand-in for the pipeline benchmark: the login form with a logintoken, a
+    dashboard and profile listing the courses, course pages with page-header-headings and
+    mod/resource links, resource views that redirect to pluginfile.php (or, every html_every-th
+    resource, a page embedding its mod_resource/content file) and file bodies with ETag and
+    Range support. Counts the requests and body bytes it served.
+
+    With session_lock, every login gets its own MoodleSession and the pages of one session are
+    served one at a time, as Moodle's session locking does (pluginfile.php releases the lock).
+    Course pages group the resources into sections of five, each shown with its file type icon
+    (unless icons is off) and, with details, its size.
+
+    Faults for the resume code: with drop_after, the first transfer of every file body longer
+    than that is cut off after drop_after bytes; without ranges, file bodies have no Range
+    support; with gzip, compressible files are sent gzip-encoded to clients that accept it,
+    and a Range then counts bytes of the encoded body, as mod_deflate does.
+
+    Web services: with api="token", /login/token.php issues a token for the REST endpoint, with
+    api="sesskey" it refuses and only the AJAX endpoint answers (authorised by the dashboard's
+    sesskey). Both serve the calls --discovery api and --all-courses make from the same courses;
+    without api they answer servicenotavailable. paths counts the requests per URL path.
+
+    With throttle, a GET that arrives while throttle requests are already being answered gets
+    throttle_status (503 or 429) with Retry-After: 1 instead, counted in throttled.
+
+    expire_sessions() ends every MoodleSession handed out so far: pages requested with one redirect
+    to the login form, and core_session_time_remaining answers userid 0 for it, as for a guest.
+    Any username and password log in, and users counts the logins per username.
+    """
+
+    def __init__(self, courses, files, scale, latency=0.0, html_every=5, seed=1, session_lock=False,
+                 icons=True, details=False, drop_after=None, ranges=True, gzip=False, api=None,
+                 throttle=None, throttle_status=503):
+        rng = random.Random(seed)
+        self.api = api
+        self.throttle = throttle
+        self.throttle_status = throttle_status
+        self.latency = latency
+        self.session_lock = session_lock
+        self.icons = icons
+        self.details = details
+        self.drop_after = drop_after
+        self.ranges = ranges
+        self.gzip = gzip
+        self.encoded = {}
+        self.session_locks = {}
+        self.issued = set()
+        self.expired = set()
+        self.courses = {}
+        self.files = {}
+        # Bodies are tiled from one text-like and one random block, so any size is cheap to serve
+        self.blocks = {False: synthetic_body(".txt", 1024 * 1024, rng), True: rng.randbytes(1024 * 1024)}
+        mime_types = {extension: mime for mime, extension in scraper.FILE_MIME_TYPES.items()}
+        file_id = 1
+        for course in range(2, courses + 2):  # Course 1 is the site front page in Moodle
+            self.courses[course] = []
+            for index in range(files):
+                extension, _, mean_size = rng.choices(SYNTHETIC_FILES, weights=[w for _, w, _ in SYNTHETIC_FILES])[0]
+                size = max(1, int(rng.expovariate(1 / mean_size) * scale))
+                embedded = html_every and index % html_every == html_every - 1
+                self.files[file_id] = {
+                    "name": f"Resource {course}-{index}", "filename": f"resource{file_id}{extension}",
+                    "size": size, "type": mime_types.get(extension, "application/octet-stream"),
+                    "stored": extension in scraper.STORED_EXTENSIONS, "embedded": embedded,
+                }
+                self.courses[course].append(file_id)
+                file_id += 1
+        self.total_bytes = sum(f["size"] for f in self.files.values())
+        self.lock = threading.Lock()
+        self.reset()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        # Clients close the connection of a file they skip after its headers, that is no server error
+        self.server.handle_error = lambda request, client_address: None
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes_served = 0
+            self.sessions = 0
+            self.users = collections.Counter()
+            self.range_requests = 0
+            self.dropped = set()
+            self.paths = collections.Counter()
+            self.in_flight = 0
+            self.throttled = 0
+
+    def expire_sessions(self):
+        with self.lock:
+            self.expired |= self.issued
+
+    def session_of(self, headers):
+        """Returns the MoodleSession cookie of a request, or None."""
+        session = re.search(r"MoodleSession=([^;]+)", headers.get("Cookie", ""))
+        return session.group(1) if session else None
+
+    def lock_for(self, headers):
+        """Returns the lock serialising the pages of the request's MoodleSession (a new one without a session)."""
+        session = self.session_of(headers)
+        if not session:
+            return threading.Lock()
+        with self.lock:
+            return self.session_locks.setdefault(session, threading.Lock())
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def body(self, file_id):
+        info = self.files[file_id]
+        block = self.blocks[info["stored"]]
+        prefix = f"resource {file_id}\n".encode()  # Keeps every file distinct for deduplication
+        data = prefix + block * (info["size"] // len(block) + 1)
+        return data[:info["size"]]
+
+    def encoded_body(self, file_id):
+        """Returns the gzip-encoded body of a file, compressed once."""
+        with self.lock:
+            if file_id not in self.encoded:
+                self.encoded[file_id] = gzip.compress(self.body(file_id), 1)
+            return self.encoded[file_id]
+
+    def web_service(self, function, args, session=None):
+        """
+        Returns the result of a web-service call made with the MoodleSession session, or None for
+        a function the site does not offer.
+        """
+        if function == "core_session_time_remaining":
+            with self.lock:
+                live = session in self.issued and session not in self.expired
+            return {"userid": 2, "timeremaining": 7200} if live else {"userid": 0, "timeremaining": 0}
+        if function == "core_course_get_enrolled_courses_by_timeline_classification":
+            return {"courses": [{"id": course, "fullname": f"Course {course}"} for course in self.courses],
+                    "nextoffset": len(self.courses)}
+        if function == "core_course_get_courses_by_field":
+            ids = {int(course) for course in str(args.get("value", "")).split(",") if course}
+            return {"courses": [{"id": course, "fullname": f"Course {course}", "shortname": f"C{course}"}
+                                for course in self.courses if course in ids], "warnings": []}
+        if function == "mod_resource_get_resources_by_courses":
+            ids = {int(course) for course in args.get("courseids", [])}
+            resources = []
+            for course in sorted(ids & set(self.courses)):
+                for index, file_id in enumerate(self.courses[course]):
+                    info = self.files[file_id]
+                    resources.append({
+                        "id": file_id, "coursemodule": file_id, "course": course, "name": info["name"],
+                        "section": index // 5 + 1,
+                        "contentfiles": [{
+                            "filename": info["filename"], "filepath": "/", "filesize": info["size"],
+                            "fileurl": f"{self.url}/webservice/pluginfile.php/{file_id}/mod_resource/content/1/"
+                                       f"{info['filename']}",
+                            "mimetype": info["type"], "sortorder": 1,
+                        }],
+                    })
+            return {"resources": resources, "warnings": []}
+        return None
+
+    def sections(self, course):
+        """Returns the course page's sections of activities, Moodle 4 style (icon before the link)."""
+        out = []
+        for index, file_id in enumerate(self.courses[course]):
+            info = self.files[file_id]
+            if index % 5 == 0:
+                number = index // 5 + 1
+                out.append(f'{"</ul></li>" if index else ""}<li id="section-{number}" class="section main">'
+                           f'<h3 class="sectionname">Week {number}</h3><ul class="section">')
+            # Without file type icons (e.g. a theme that shows the generic module icon) only the headers tell the type
+            icon = (f'/theme/image.php/boost/core/1/f/{MOODLE_ICONS.get(os.path.splitext(info["filename"])[1], "unknown")}'
+                    if self.icons else "/theme/image.php/boost/resource/1/monologo")
+            details = f'<span class="resourcelinkdetails">{moodle_size(info["size"])}</span>' if self.details else ""
+            out.append(f'<li class="activity resource modtype_resource"><div class="activityiconcontainer">'
+                       f'<img src="{icon}" class="activityicon" alt=""></div>'
+                       f'<a href="/mod/resource/view.php?id={file_id}"><span class="instancename">'
+                       f'{info["name"]}<span class="accesshide"> File</span></span></a>{details}</li>')
+        return "".join(out) + ("</ul></li>" if out else "")
+
+    def _handler(self):
+        moodle = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_body(self, status, body, content_type="text/html; charset=utf-8", headers=()):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+                    with moodle.lock:
+                        moodle.bytes_served += len(body)
+
+            def send_page(self, text, headers=()):
+                self.send_body(200, f"<html><body>{text}</body></html>".encode(), headers=headers)
+
+            def send_json(self, data):
+                self.send_body(200, json.dumps(data).encode(), "application/json")
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                with moodle.lock:
+                    moodle.requests += 1
+                    moodle.paths[url.path] += 1
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if url.path == "/login/index.php":
+                    with moodle.lock:
+                        moodle.sessions += 1
+                        moodle.users.update(parse_qs(body.decode()).get("username", []))
+                        session = f"bench{moodle.sessions}" if moodle.session_lock else "bench"
+                        moodle.issued.add(session)
+                        moodle.expired.discard(session)
+                    return self.send_page('<a href="/login/logout.php">Log out</a>',
+                                          [("Set-Cookie", f"MoodleSession={session}; Path=/")])
+                if url.path == "/login/token.php" and moodle.api == "token":
+                    return self.send_json({"token": "benchtoken", "privatetoken": None})
+                if url.path == "/login/token.php":
+                    return self.send_json({"error": "Web services must be enabled in Advanced features.",
+                                           "errorcode": "enablewsdescription"})
+                if url.path == "/webservice/rest/server.php" and moodle.api == "token":
+                    form = parse_qs(body.decode())
+                    if form.get("wstoken") != ["benchtoken"]:
+                        return self.send_json({"exception": "moodle_exception", "errorcode": "invalidtoken",
+                                               "message": "Invalid token - token not found"})
+                    # courseids[0]=2&courseids[1]=3 -> {"courseids": ["2", "3"]}
+                    args = {}
+                    for key, values in form.items():
+                        name, indexed, _ = key.partition("[")
+                        if indexed:
+                            args.setdefault(name, []).append(values[0])
+                        else:
+                            args[name] = values[0]
+                    result = moodle.web_service(form.get("wsfunction", [""])[0], args, moodle.session_of(self.headers))
+                    if result is None:
+                        return self.send_json({"exception": "dml_missing_record_exception",
+                                               "errorcode": "invalidrecord", "message": "Can't find data record"})
+                    return self.send_json(result)
+                if url.path == "/lib/ajax/service.php":
+                    answers = []
+                    for call in json.loads(body):
+                        # core_session_time_remaining is open to anyone, as on Moodle
+                        allowed = call["methodname"] == "core_session_time_remaining" or \
+                            (moodle.api and parse_qs(url.query).get("sesskey") == ["bench"])
+                        result = moodle.web_service(call["methodname"], call.get("args", {}),
+                                                    moodle.session_of(self.headers)) if allowed else None
+                        answers.append({"error": False, "data": result} if result is not None else
+                                       {"error": True, "exception": {"errorcode": "servicenotavailable",
+                                                                     "message": "Web service is not available"}})
+                    return self.send_json(answers)
+                # No web services: --discovery api falls back to scraping
+                self.send_body(200, b'{"error": "disabled", "errorcode": "servicenotavailable"}', "application/json")
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                with moodle.lock:
+                    moodle.requests += 1
+                    moodle.paths[urlparse(self.path).path] += 1
+                    busy = moodle.throttle is not None and moodle.in_flight >= moodle.throttle
+                    if busy:
+                        moodle.throttled += 1
+                    else:
+                        moodle.in_flight += 1
+                if busy:
+                    return self.send_body(moodle.throttle_status, b"Server busy", headers=[("Retry-After", "1")])
+                page_lock = None
+                if moodle.session_lock and not self.path.startswith("/pluginfile.php/"):
+                    page_lock = moodle.lock_for(self.headers)
+                    page_lock.acquire()
+                try:
+                    if moodle.latency:
+                        time.sleep(moodle.latency)
+                    self.answer()
+                finally:
+                    if page_lock:
+                        page_lock.release()
+                    with moodle.lock:
+                        moodle.in_flight -= 1
+
+            def answer(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                course_links = "".join(f'<a href="/course/view.php?id={course}">Course {course}</a>'
+                                       for course in moodle.courses)
+                if url.path == "/login/index.php":
+                    return self.send_page('<form><input name="logintoken" value="benchtoken"></form>')
+                with moodle.lock:
+                    expired = moodle.session_of(self.headers) in moodle.expired
+                if expired:
+                    return self.send_body(303, b"", headers=[("Location", "/login/index.php")])
+                if url.path == "/my/":
+                    return self.send_page(f'<script>M.cfg = {{"sesskey":"bench"}};</script>{course_links}')
+                if url.path == "/user/profile.php":
+                    return self.send_page('<div class="page-header-image mr-2">'
+                                          '<img src="/user/icon/maker/f1" title="Bench User"></div>')
+                if url.path == "/course/view.php" and int(query["id"][0]) in moodle.courses:
+                    course = int(query["id"][0])
+                    return self.send_page(f'<div class="page-header-headings"><h1>Course {course}</h1></div>'
+                                          f'<ul class="topics">{moodle.sections(course)}</ul>')
+                if url.path == "/mod/resource/view.php" and int(query["id"][0]) in moodle.files:
+                    file_id = int(query["id"][0])
+                    file_url = f"/pluginfile.php/{file_id}/mod_resource/content/1/{moodle.files[file_id]['filename']}"
+                    if moodle.files[file_id]["embedded"]:
+                        return self.send_page(f'<div class="resourcecontent"><a href="{file_url}">Open</a></div>')
+                    return self.send_body(303, b"", headers=[("Location", file_url)])
+                if url.path.startswith("/pluginfile.php/"):
+                    return self.send_file(int(url.path.split("/")[2]))
+                self.send_body(404, b"Not found")
+
+            def send_file(self, file_id):
+                info = moodle.files[file_id]
+                etag = f'"bench-{file_id}-{info["size"]}"'
+                headers = [("ETag", etag), ("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT"),
+                           ("Content-Disposition", f'inline; filename="{info["filename"]}"')]
+                if moodle.ranges:
+                    headers.append(("Accept-Ranges", "bytes"))
+                if self.headers.get("If-None-Match") == etag:
+                    return self.send_body(304, b"", info["type"], headers)
+                body = moodle.body(file_id)
+                if moodle.gzip and not info["stored"] and "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = moodle.encoded_body(file_id)
+                    headers.append(("Content-Encoding", "gzip"))
+                status = 200
+                match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+                if moodle.ranges and match and int(match.group(1)) < len(body):
+                    start = int(match.group(1))
+                    headers.append(("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}"))
+                    status, body = 206, body[start:]
+                    with moodle.lock:
+                        moodle.range_requests += 1
+                with moodle.lock:
+                    drop = moodle.drop_after and self.command == "GET" and len(body) > moodle.drop_after \
+                        and file_id not in moodle.dropped
+                    if drop:
+                        moodle.dropped.add(file_id)
+                if not drop:
+                    return self.send_body(status, body, info["type"], headers)
+                # Announce the whole body, then hang up part-way through it
+                self.send_response(status)
+                self.send_header("Content-Type", info["type"])
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body[:moodle.drop_after])
+                self.wfile.flush()
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                with moodle.lock:
+                    moodle.bytes_served += moodle.drop_after
+
+        return Handler
+
+
+# Runs LUscraper101.main() in a fresh interpreter and reports its own peak RSS
+PIPELINE_RUNNER = """
+import json, resource, sys
+sys.argv = ["LUscraper101.py"] + json.loads(sys.argv[1])
+import LUscraper101
+status = LUscraper101.main()
+try:
+    with open("/proc/self/status") as f:
+        peak = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+except OSError:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({"status": status, "peak_kib": peak}), file=sys.stderr)
+"""
+
+
+def run_pipeline(moodle, work_dir, options, check=None, courses=("--all-courses",)):
+    """
+    Runs one batch download of courses against moodle. Returns wall time, client peak RSS and server
+    counters. check, if given, is called with the paths of the archive before they are removed.
+    """
+    argv = ["--batch", "--site", moodle.url, *courses, "--no-extras",
+            "--output-dir", os.path.join(work_dir, "MoodleDownloads"), "--zip-name", "bench.zip",
+            "--metrics", os.path.join(work_dir, "bench.prom")] + options
+    env = dict(os.environ, LUSCRAPER_USERNAME="bench", LUSCRAPER_PASSWORD="bench")
+    here = os.path.dirname(os.path.abspath(__file__))
+    moodle.reset()
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", PIPELINE_RUNNER, json.dumps(argv)],
+                            cwd=work_dir, env=dict(env, PYTHONPATH=here), capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    try:
+        report = json.loads(result.stderr.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        raise RuntimeError(f"pipeline run failed:\n{result.stdout[-2000:]}\n{result.stderr[-2000:]}")
+    if report["status"] != scraper.EXIT_OK:
+        raise RuntimeError(f"pipeline run exited with status {report['status']}:\n{result.stdout[-2000:]}")
+    # bench.zip, bench.tar.zst or their volumes
+    paths = sorted(os.path.join(work_dir, name) for name in os.listdir(work_dir)
+                   if name.startswith("bench.") and name != "bench.prom" and os.path.isfile(os.path.join(work_dir, name)))
+    if check:
+        check(paths)
+    archive = 0
+    for path in paths:
+        archive += os.path.getsize(path)
+        os.remove(path)
+    return {"wall": elapsed, "peak_mb": report["peak_kib"] / 1024, "requests": moodle.requests,
+            "served_mb": moodle.bytes_served / 1024 / 1024, "archive_mb": archive / 1024 / 1024}
+
+
+def bench_pipeline(args):
+    moodle = FakeMoodle(args.courses, args.files, args.scale, args.latency, args.html_every)
+    work_dir = tempfile.mkdtemp(prefix="luscraper_bench_")
+    common = ["--workers", str(args.workers), "--rate", str(args.rate)]
+    variants = [
+        ("staged", common),
+        ("no-staging", common + ["--no-staging"]),
+        ("sync, first run", common + ["--sync"]),
+        ("sync, unchanged", common + ["--sync"]),
+    ]
+    results = {}
+    try:
+        print(f"Fake Moodle: {len(moodle.courses)} courses, {len(moodle.files)} files, "
+              f"{moodle.total_bytes / 1024 / 1024:.1f} MB, {args.latency * 1000:.0f} ms latency")
+        print(f"{'variant':<18}{'wall s':>9}{'peak MB':>9}{'requests':>10}{'served MB':>11}{'MB/s':>8}{'archive MB':>12}")
+        for name, options in variants:
+            result = run_pipeline(moodle, work_dir, options)
+            results[name] = result
+            print(f"{name:<18}{result['wall']:>9.2f}{result['peak_mb']:>9.1f}{result['requests']:>10}"
+                  f"{result['served_mb']:>11.1f}{result['served_mb'] / result['wall']:>8.1f}{result['archive_mb']:>12.1f}")
+    finally:
+        moodle.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = [
+            f"{name}: {key} {baseline[name][key]:.2f} -> {result[key]:.2f}"
+            for name, result in results.items() if name in baseline
+            for key in ("wall", "peak_mb", "requests")
+            if result[key] > baseline[name][key] * (1 + args.tolerance)
+        ]
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+def bench_shards(args):
+    moodle = FakeMoodle(args.courses, args.files, args.scale, args.latency, args.html_every, session_lock=True)
+    work_dir = tempfile.mkdtemp(prefix="luscraper_bench_")
+    try:
+        print(f"Fake Moodle: {len(moodle.courses)} courses, {len(moodle.files)} files, "
+              f"{moodle.total_bytes / 1024 / 1024:.1f} MB, {args.latency * 1000:.0f} ms per page, one page per session at a time")
+        print(f"{'rate':>6}{'shards':>8}{'wall s':>9}{'speedup':>9}{'requests':>10}{'req/s':>8}")
+        for rate in args.rates:
+            single = None
+            for shards in args.shards:
+                result = run_pipeline(moodle, work_dir, ["--shards", str(shards), "--workers", str(args.workers),
+                                                         "--rate", str(rate)])
+                single = single or result["wall"]
+                print(f"{rate or '-':>6}{shards:>8}{result['wall']:>9.2f}{single / result['wall']:>9.2f}"
+                      f"{result['requests']:>10}{result['requests'] / result['wall']:>8.1f}")
+        if args.accounts < 2:
+            return
+        # The first accounts get a share of the courses each, the last one the rest through "all"
+        users = [f"bench{account}" for account in range(args.accounts)]
+        course_ids = sorted(moodle.courses)
+        share = len(course_ids) // args.accounts
+        accounts = {user: ",".join(map(str, course_ids[i * share:(i + 1) * share])) for i, user in enumerate(users[:-1])}
+        accounts[users[-1]] = "all"
+        accounts_file = os.path.join(work_dir, "accounts.json")
+        with open(accounts_file, "w", encoding="utf-8") as f:
+            json.dump(accounts, f)
+        expected = sorted(hashlib.sha256(moodle.body(file_id)).hexdigest() for file_id in moodle.files)
+        found = []
+        result = run_pipeline(moodle, work_dir, ["--workers", str(args.workers), "--rate", "0"],
+                              check=lambda paths: found.extend(zip_bodies(paths)), courses=("--accounts", accounts_file))
+        # The "all" account logs in once more to list its courses
+        ok = sorted(found) == expected and all(moodle.users[user] >= 1 for user in users) and \
+            sum(moodle.users.values()) == args.accounts + 1
+        print(f"{args.accounts} accounts, 1 shard each: {result['wall']:.2f} s, {result['requests']} requests, "
+              f"logins {dict(moodle.users)}  {'ok' if ok else 'FAILED'}")
+        if not ok:
+            sys.exit(1)
+    finally:
+        moodle.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def bench_filters(args):
+    moodle = FakeMoodle(args.courses, args.files, args.scale, args.latency, args.html_every)
+    work_dir = tempfile.mkdtemp(prefix="luscraper_bench_")
+    common = ["--workers", str(args.workers), "--rate", "0"]
+    # (name, options, file type icons on the course page, sizes shown on the course page)
+    variants = [
+        ("everything", [], True, False),
+        ("no video, by icon", ["--exclude-type", "video"], True, False),
+        ("no video, by headers", ["--exclude-type", "video"], False, False),
+        ("pdf only", ["--include-ext", "pdf"], True, False),
+        ("max 1 MB, sizes shown", ["--max-size", "1M"], True, True),
+        ("dry run", ["--dry-run"], True, False),
+        ("dry run, sizes shown", ["--dry-run"], True, True),
+    ]
+    try:
+        videos = sum(info["size"] for info in moodle.files.values() if info["filename"].endswith(".mp4"))
+        print(f"Fake Moodle: {len(moodle.courses)} courses, {len(moodle.files)} files, "
+              f"{moodle.total_bytes / 1024 / 1024:.1f} MB ({videos / 1024 / 1024:.1f} MB of video), "
+              f"{args.latency * 1000:.0f} ms latency")
+        print(f"{'variant':<24}{'wall s':>8}{'requests':>10}{'served MB':>11}{'archive MB':>12}")
+        for name, options, icons, details in variants:
+            moodle.icons, moodle.details = icons, details
+            result = run_pipeline(moodle, work_dir, common + options)
+            print(f"{name:<24}{result['wall']:>8.2f}{result['requests']:>10}{result['served_mb']:>11.1f}"
+                  f"{result['archive_mb']:>12.1f}")
+    finally:
+        moodle.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def zip_bodies(paths):
+    """Returns the SHA-256 of every file member in the ZIP archives at paths."""
+    digests = []
+    for path in paths:
+        with zipfile.ZipFile(path) as zipf:
+            digests += [hashlib.sha256(zipf.read(member)).hexdigest()
+                        for member in zipf.infolist() if not member.is_dir()]
+    return digests
+
+
+def bench_resume(args):
+    """Checks that files survive dropped connections byte for byte, and counts what resuming costs."""
+    moodle = FakeMoodle(args.courses, args.files, args.scale, 0, args.html_every, drop_after=args.drop_after)
+    expected = sorted(hashlib.sha256(moodle.body(file_id)).hexdigest() for file_id in moodle.files)
+    work_dir = tempfile.mkdtemp(prefix="luscraper_bench_")
+    common = ["--workers", str(args.workers), "--rate", "0"]
+    variants = [
+        ("no drops", {"drop_after": None}, []),
+        ("drops, Range", {}, []),
+        ("drops, no Range", {"ranges": False}, []),
+        ("drops, Range, gzip", {"gzip": True}, []),
+        ("drops, Range, no-staging", {}, ["--no-staging"]),
+    ]
+    failed = []
+    try:
+        dropped = sum(info["size"] > args.drop_after for info in moodle.files.values())
+        print(f"Fake Moodle: {len(moodle.files)} files, {moodle.total_bytes / 1024 / 1024:.1f} MB, "
+              f"{dropped} cut off after {args.drop_after} bytes on their first transfer")
+        print(f"{'variant':<28}{'wall s':>8}{'requests':>10}{'ranges':>8}{'served MB':>11}  result")
+        for name, faults, options in variants:
+            moodle.drop_after, moodle.ranges, moodle.gzip = args.drop_after, True, False
+            for key, value in faults.items():
+                setattr(moodle, key, value)
+            found = []
+            result = run_pipeline(moodle, work_dir, common + options, check=lambda paths: found.extend(zip_bodies(paths)))
+            ok = sorted(found) == expected
+            if not ok:
+                failed.append(name)
+            print(f"{name:<28}{result['wall']:>8.2f}{result['requests']:>10}{moodle.range_requests:>8}"
+                  f"{result['served_mb']:>11.1f}  {'identical' if ok else 'CORRUPT'}")
+    finally:
+        moodle.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failed:
+        print(f"FAILED {', '.join(failed)}: archived files differ from the served ones")
+        sys.exit(1)
+
+
+# Pages --discovery api replaces with web-service calls
+SCRAPED_PAGES = ("/course/view.php", "/mod/resource/view.php")
+WEB_SERVICES = ("/webservice/rest/server.php", "/lib/ajax/service.php")
+
+
+def bench_api(args):
+    """Checks that --discovery api lists every file without fetching course or resource pages."""
+    moodle = FakeMoodle(args.courses, args.files, args.scale, args.latency, args.html_every)
+    expected = sorted(hashlib.sha256(moodle.body(file_id)).hexdigest() for file_id in moodle.files)
+    work_dir = tempfile.mkdtemp(prefix="luscraper_bench_")
+    common = ["--workers", str(args.workers), "--rate", "0"]
+    # (name, site's web services, options, whether pages may be scraped)
+    variants = [
+        ("html", None, ["--discovery", "html"], True),
+        ("api, token", "token", ["--discovery", "api"], False),
+        ("api, sesskey", "sesskey", ["--discovery", "api"], False),
+        ("api, disabled on the site", None, ["--discovery", "api"], True),
+    ]
+    failed = []
+    try:
+        print(f"Fake Moodle: {len(moodle.courses)} courses, {len(moodle.files)} files, "
+              f"{moodle.total_bytes / 1024 / 1024:.1f} MB, {args.latency * 1000:.0f} ms latency")
+        print(f"{'variant':<28}{'wall s':>8}{'requests':>10}{'pages':>7}{'ws calls':>10}  result")
+        for name, api, options, scrapes in variants:
+            moodle.api = api
+            found = []
+            result = run_pipeline(moodle, work_dir, common + options, check=lambda paths: found.extend(zip_bodies(paths)))
+            pages = sum(moodle.paths[path] for path in SCRAPED_PAGES)
+            calls = sum(moodle.paths[path] for path in WEB_SERVICES)
+            problems = []
+            if sorted(found) != expected:
+                problems.append("files differ")
+            if not scrapes and (pages or not calls):
+                problems.append("pages scraped")
+            if problems:
+                failed.append(name)
+            print(f"{name:<28}{result['wall']:>8.2f}{result['requests']:>10}{pages:>7}{calls:>10}  "
+                  f"{', '.join(problems) or 'ok'}")
+    finally:
+        moodle.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failed:
+        print(f"FAILED {', '.join(failed)}")
+        sys.exit(1)
+
+
+def bench_throttle(args):
+    """
+    Checks that the adaptive concurrency limit backs off while the server throttles above args.limit
+    concurrent requests, hovering around what the server accepts, and climbs back to the pool size
+    once the server stops. Runs once with 503 and once with 429 answers.
+    """
+    moodle = FakeMoodle(1, args.files, args.scale, args.latency, 0)
+    urls = [f"{moodle.url}/pluginfile.php/{file_id}/mod_resource/content/1/{info['filename']}"
+            for file_id, info in moodle.files.items()]
+    digests = {url: hashlib.sha256(moodle.body(file_id)).hexdigest() for url, file_id in zip(urls, moodle.files)}
+    failed = []
+
+    def run_phase(session, transport):
+        """Keeps args.pool threads fetching files for args.seconds, sampling the concurrency limit."""
+        stop = time.monotonic() + args.seconds
+        errors = []
+        limits = []
+
+        def fetch(worker):
+            index = worker
+            while time.monotonic() < stop:
+                url = urls[index % len(urls)]
+                index += args.pool
+                try:
+                    response = session.get(url)
+                    if response.status_code != 200 or hashlib.sha256(response.content).hexdigest() != digests[url]:
+                        errors.append(url)
+                except requests.RequestException:
+                    errors.append(url)
+
+        moodle.reset()
+        threads = [threading.Thread(target=fetch, args=(worker,)) for worker in range(args.pool)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            limits.append(transport.stats()["limit"])
+            time.sleep(0.01)
+        limits.append(transport.stats()["limit"])
+        return errors, limits
+
+    try:
+        print(f"Fake Moodle: {len(urls)} files, {moodle.total_bytes / 1024 / 1024:.1f} MB, "
+              f"{args.latency * 1000:.0f} ms latency, throttling above {args.limit} concurrent requests")
+        print(f"{'phase':<16}{'requests':>10}{'throttled':>11}{'failed':>8}{'limit min':>11}{'mean':>6}{'end':>5}  result")
+        for status in (503, 429):
+            moodle.throttle_status = status
+            session = requests.Session()
+            transport = scraper.configure_transport(session, args.pool)
+            for name, throttle in (("free", None), (f"{status} above {args.limit}", args.limit), ("recovered", None)):
+                moodle.throttle = throttle
+                errors, limits = run_phase(session, transport)
+                mean = statistics.mean(limits)
+                if throttle:
+                    # Additive increase probes one above what the server accepts, then halves again
+                    ok = moodle.throttled and min(limits) < args.pool and mean <= 2 * throttle
+                else:
+                    # At the full pool without the server turning anything away
+                    ok = limits[-1] == args.pool and not moodle.throttled
+                if not ok or errors:
+                    failed.append(f"{status} {name}")
+                print(f"{name:<16}{moodle.requests:>10}{moodle.throttled:>11}{len(errors):>8}{min(limits):>11}"
+                      f"{mean:>6.1f}{limits[-1]:>5}  {'ok' if ok and not errors else 'FAILED'}")
+            print(f"[POOL] {scraper.format_pool_stats(transport.stats())}")
+            session.close()
+    finally:
+        moodle.close()
+    if failed:
+        print(f"FAILED {', '.join(failed)}")
+        sys.exit(1)
+
+
+def bench_session(args):
+    """Checks that --session-cache reuses a live login and logs in again once Moodle has ended it."""
+    try:
+        import cryptography  # noqa: F401
+    except ImportError:
+        print("The session cache needs the cryptography package (pip install cryptography)")
+        sys.exit(1)
+    moodle = FakeMoodle(args.courses, args.files, args.scale, 0, args.html_every)
+    expected = sorted(hashlib.sha256(moodle.body(file_id)).hexdigest() for file_id in moodle.files)
+    work_dir = tempfile.mkdtemp(prefix="luscraper_bench_")
+    options = ["--rate", "0", "--session-cache", os.path.join(work_dir, "sessions.bin")]
+    # (name, whether Moodle ends the cached session first, logins expected)
+    variants = [("first run", False, 1), ("cached session", False, 0), ("session expired", True, 1)]
+    failed = []
+    try:
+        print(f"{'variant':<18}{'wall s':>8}{'requests':>10}{'logins':>8}  result")
+        for name, expire, logins in variants:
+            if expire:
+                moodle.expire_sessions()
+            found = []
+            try:
+                result = run_pipeline(moodle, work_dir, options, check=lambda paths: found.extend(zip_bodies(paths)))
+            except RuntimeError as e:
+                print(f"{name:<18}  run failed: {str(e).splitlines()[0]}")
+                failed.append(name)
+                continue
+            ok = moodle.sessions == logins and sorted(found) == expected
+            if not ok:
+                failed.append(name)
+            print(f"{name:<18}{result['wall']:>8.2f}{result['requests']:>10}{moodle.sessions:>8}  "
+                  f"{'ok' if ok else 'FAILED'}")
+    finally:
+        moodle.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failed:
+        print(f"FAILED {', '.join(failed)}")
+        sys.exit(1)
+
+
+def bench_archive(args):
+    work_dir = tempfile.mkdtemp(prefix="luscraper_bench_")
+    try:
+        tree = os.path.join(work_dir, "MoodleDownloads")
+        total = make_course_tree(tree, args.courses, args.files, args.scale)
+        print(f"Synthetic tree: {args.courses} courses, {args.courses * args.files} files, "
+              f"{total / 1024 / 1024:.1f} MB, {os.cpu_count()} cores")
+        print(f"{'variant':<34}{'wall s':>9}{'MB/s':>9}{'archive MB':>12}{'files':>7}")
+        volume = args.volume_mb * 1024 * 1024
+        per_course = os.path.join(work_dir, "bench.zip")
+
+        def change_one_course():
+            with open(os.path.join(tree, "Course 1", "Resource 0.txt"), "ab") as f:
+                f.write(b"changed\n")
+
+        variants = [
+            ("zip", lambda: scraper.create_archive(tree, os.path.join(work_dir, "bench.zip"))),
+            (f"zip, {args.volume_mb} MB volumes",
+             lambda: scraper.create_archive(tree, os.path.join(work_dir, "bench.zip"), volume_size=volume)),
+            ("tar.zst level 3", lambda: scraper.create_archive(tree, os.path.join(work_dir, "bench.tar.zst"), "tar.zst", 3)),
+            ("tar.zst level 6", lambda: scraper.create_archive(tree, os.path.join(work_dir, "bench.tar.zst"), "tar.zst", 6)),
+            (f"tar.zst level 3, {args.volume_mb} MB volumes",
+             lambda: scraper.create_archive(tree, os.path.join(work_dir, "bench.tar.zst"), "tar.zst", 3, volume)),
+            ("per-course zip, first run", lambda: scraper.create_archive(tree, per_course, per_course=True)),
+            ("per-course zip, unchanged", lambda: scraper.create_archive(tree, per_course, per_course=True)),
+            ("per-course zip, 1 course changed", lambda: scraper.create_archive(tree, per_course, per_course=True)),
+        ]
+        for name, build in variants:
+            if name.endswith("1 course changed"):
+                change_one_course()
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                paths = build()
+                elapsed = time.perf_counter() - start
+            size = sum(os.path.getsize(path) for path in paths)
+            print(f"{name:<34}{elapsed:>9.2f}{total / 1024 / 1024 / elapsed:>9.1f}{size / 1024 / 1024:>12.1f}{len(paths):>7}")
+            if not name.startswith("per-course"):
+                for path in paths:
+                    os.remove(path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # Written while the downloads are still running, from a fake Moodle
+    moodle = FakeMoodle(args.courses, args.files, args.scale, args.latency, 0)
+    work_dir = tempfile.mkdtemp(prefix="luscraper_bench_")
+    common = ["--workers", str(args.workers), "--rate", "0", "--no-staging"]
+    try:
+        print(f"\nFake Moodle: {len(moodle.files)} files, {moodle.total_bytes / 1024 / 1024:.1f} MB, "
+              f"{args.latency * 1000:.0f} ms latency, archived while downloading (--no-staging)")
+        # The fake bodies repeat one block, which zstd's window sees across, so sizes are only compared above
+        print(f"{'variant':<34}{'wall s':>9}{'peak MB':>9}{'MB/s':>9}")
+        for name, options in (("zip", []), ("tar.zst", ["--format", "tar.zst"]),
+                              (f"tar.zst, {args.volume_mb} MB volumes",
+                               ["--format", "tar.zst", "--volume-size", f"{args.volume_mb}M"])):
+            result = run_pipeline(moodle, work_dir, common + options)
+            print(f"{name:<34}{result['wall']:>9.2f}{result['peak_mb']:>9.1f}{result['served_mb'] / result['wall']:>9.1f}")
+    finally:
+        moodle.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    zip_parser = commands.add_parser("zip", help="compare create_zip against the original single-threaded version")
+    zip_parser.add_argument("--courses", type=int, default=4)
+    zip_parser.add_argument("--files", type=int, default=40, help="files per course")
+    zip_parser.add_argument("--scale", type=float, default=1.0, help="multiplier for the file size distribution")
+    zip_parser.set_defaults(func=bench_zip)
+
+    startup_parser = commands.add_parser("startup", help="import time and peak memory with and without the lazy extras")
+    startup_parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per variant")
+    startup_parser.set_defaults(func=bench_startup)
+
+    classify_parser = commands.add_parser("classify", help="time file/page classification over a synthetic link corpus")
+    classify_parser.add_argument("--links", type=int, default=100000)
+    classify_parser.set_defaults(func=bench_classify)
+
+    html_parser = commands.add_parser("html", help="peak memory of parsing multi-MB course pages, whole vs streamed")
+    html_parser.add_argument("--activities", type=lambda value: [int(n) for n in value.split(",")],
+                             default=[2000, 10000, 40000], help="comma-separated activity counts, one page each")
+    html_parser.set_defaults(func=bench_html)
+
+    writer_parser = commands.add_parser("writer", help="throughput of saving one large body, 8 KiB loop vs tuned writer")
+    writer_parser.add_argument("--size-mb", type=float, default=256)
+    writer_parser.add_argument("--repeat", type=int, default=3)
+    writer_parser.set_defaults(func=bench_writer)
+
+    pipeline_parser = commands.add_parser("pipeline", help="run the whole batch download against a local fake Moodle")
+    pipeline_parser.add_argument("--courses", type=int, default=4)
+    pipeline_parser.add_argument("--files", type=int, default=20, help="resources per course")
+    pipeline_parser.add_argument("--scale", type=float, default=0.25, help="multiplier for the file size distribution")
+    pipeline_parser.add_argument("--latency", type=float, default=0.02, help="seconds the server waits before each answer")
+    pipeline_parser.add_argument("--html-every", type=int, default=5,
+                                 help="every n-th resource is a page embedding its file (0: none)")
+    pipeline_parser.add_argument("--workers", type=int, default=8)
+    pipeline_parser.add_argument("--rate", type=float, default=0, help="--rate passed to the scraper (0: no limit)")
+    pipeline_parser.add_argument("--save", metavar="FILE", help="write the results as JSON, e.g. as a CI baseline")
+    pipeline_parser.add_argument("--baseline", metavar="FILE",
+                                 help="exit with status 1 if wall time, peak memory or requests grew beyond --tolerance")
+    pipeline_parser.add_argument("--tolerance", type=float, default=0.25)
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    shards_parser = commands.add_parser("shards", help="scaling of --shards against a fake Moodle with session locking")
+    shards_parser.add_argument("--courses", type=int, default=16)
+    shards_parser.add_argument("--files", type=int, default=5, help="resources per course")
+    shards_parser.add_argument("--scale", type=float, default=0.02, help="multiplier for the file size distribution")
+    shards_parser.add_argument("--latency", type=float, default=0.2, help="seconds the server takes for each page")
+    shards_parser.add_argument("--html-every", type=int, default=5,
+                               help="every n-th resource is a page embedding its file (0: none)")
+    shards_parser.add_argument("--workers", type=int, default=8, help="--workers of every shard")
+    shards_parser.add_argument("--shards", type=lambda value: [int(n) for n in value.split(",")], default=[1, 2, 4, 8],
+                               help="comma-separated shard counts to compare")
+    shards_parser.add_argument("--rates", type=lambda value: [float(n) for n in value.split(",")], default=[0, 20],
+                               help="comma-separated --rate values, 0 for no limit")
+    shards_parser.add_argument("--accounts", type=int, default=2,
+                               help="then run once with --accounts for this many users (0 = skip)")
+    shards_parser.set_defaults(func=bench_shards)
+
+    filters_parser = commands.add_parser("filters", help="bytes and requests saved by the file selection options and --dry-run")
+    filters_parser.add_argument("--courses", type=int, default=4)
+    filters_parser.add_argument("--files", type=int, default=25, help="resources per course")
+    filters_parser.add_argument("--scale", type=float, default=0.25, help="multiplier for the file size distribution")
+    filters_parser.add_argument("--latency", type=float, default=0.02, help="seconds the server waits before answering")
+    filters_parser.add_argument("--html-every", type=int, default=5,
+                                help="every n-th resource is a page embedding its file (0: none)")
+    filters_parser.add_argument("--workers", type=int, default=8)
+    filters_parser.set_defaults(func=bench_filters)
+
+    resume_parser = commands.add_parser("resume", help="check that downloads cut off mid-body are resumed byte for byte")
+    resume_parser.add_argument("--courses", type=int, default=3)
+    resume_parser.add_argument("--files", type=int, default=10, help="resources per course")
+    resume_parser.add_argument("--scale", type=float, default=0.25, help="multiplier for the file size distribution")
+    resume_parser.add_argument("--html-every", type=int, default=5,
+                               help="every n-th resource is a page embedding its file (0: none)")
+    resume_parser.add_argument("--drop-after", type=int, default=64 * 1024,
+                               help="bytes of a file's first transfer sent before the connection is cut")
+    resume_parser.add_argument("--workers", type=int, default=8)
+    resume_parser.set_defaults(func=bench_resume)
+
+    api_parser = commands.add_parser("api", help="check that --discovery api finds every file without scraping pages")
+    api_parser.add_argument("--courses", type=int, default=4)
+    api_parser.add_argument("--files", type=int, default=25, help="resources per course")
+    api_parser.add_argument("--scale", type=float, default=0.1, help="multiplier for the file size distribution")
+    api_parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every page request")
+    api_parser.add_argument("--html-every", type=int, default=5,
+                            help="every n-th resource is a page embedding its file (0 = none)")
+    api_parser.add_argument("--workers", type=int, default=8)
+    api_parser.set_defaults(func=bench_api)
+
+    throttle_parser = commands.add_parser("throttle", help="check that the adaptive concurrency limit backs off and recovers")
+    throttle_parser.add_argument("--files", type=int, default=40)
+    throttle_parser.add_argument("--scale", type=float, default=0.05, help="multiplier for the file size distribution")
+    throttle_parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every request")
+    throttle_parser.add_argument("--pool", type=int, default=8, help="connections per host (the limit's maximum)")
+    throttle_parser.add_argument("--limit", type=int, default=3, help="concurrent requests the server accepts while throttling")
+    throttle_parser.add_argument("--seconds", type=float, default=4, help="length of each phase")
+    throttle_parser.set_defaults(func=bench_throttle)
+
+    session_parser = commands.add_parser("session", help="check that a cached login is reused, and replaced once it expires")
+    session_parser.add_argument("--courses", type=int, default=2)
+    session_parser.add_argument("--files", type=int, default=5, help="resources per course")
+    session_parser.add_argument("--scale", type=float, default=0.1, help="multiplier for the file size distribution")
+    session_parser.add_argument("--html-every", type=int, default=5,
+                                help="every n-th resource is a page embedding its file (0 = none)")
+    session_parser.set_defaults(func=bench_session)
+
+    archive_parser = commands.add_parser("archive", help="archive formats, volumes and per-course re-archiving")
+    archive_parser.add_argument("--courses", type=int, default=8)
+    archive_parser.add_argument("--files", type=int, default=20, help="files per course")
+    archive_parser.add_argument("--scale", type=float, default=0.5, help="multiplier for the file size distribution")
+    archive_parser.add_argument("--volume-mb", type=int, default=16, help="volume size of the split variants")
+    archive_parser.add_argument("--latency", type=float, default=0.02, help="seconds the server waits before answering")
+    archive_parser.add_argument("--workers", type=int, default=8)
+    archive_parser.set_defaults(func=bench_archive)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()